@@ -3,21 +3,59 @@ from controllers.auth_controller import auth_bp
 from controllers.user_controller import user_bp
 from controllers.admin_controller import admin_bp
 from controllers.parking_controller import parking_bp
-from database import init_db
+from controllers.assets_controller import assets_bp
+from controllers.waitlist_controller import waitlist_bp
+from controllers.report_controller import report_bp
+from controllers.api_controller import api_bp
+from utils.assets import fetch_assets_command
+from utils.report_jobs import run_jobs_command
+from utils.db_maintenance import db_maintain_command
+from utils.pricing import refresh_prices_command
+from utils.compression import CompressionMiddleware
+from commands import init_db_command, seed_db_command, replay_events_command
+from config import Config
+import database
+import time
 
-app = Flask(__name__)
-app.secret_key = 'parking-app-secret-key-2024'
+BLUEPRINTS = (auth_bp, user_bp, admin_bp, parking_bp, assets_bp, waitlist_bp, report_bp, api_bp)
 
-# Register blueprints
-app.register_blueprint(auth_bp)
-app.register_blueprint(user_bp)
-app.register_blueprint(admin_bp)
-app.register_blueprint(parking_bp)
+CLI_COMMANDS = (init_db_command, seed_db_command, replay_events_command, fetch_assets_command,
+                run_jobs_command, db_maintain_command, refresh_prices_command)
 
-@app.route('/')
 def index():
     return render_template('main.html')
 
+def create_app(config=Config):
+    started = time.perf_counter()
+    
+    app = Flask(__name__)
+    app.config.from_object(config)
+    
+    # Register blueprints
+    for blueprint in BLUEPRINTS:
+        app.register_blueprint(blueprint)
+    app.add_url_rule('/', 'index', index)
+    
+    for command in CLI_COMMANDS:
+        app.cli.add_command(command)
+    
+    # Only a PRAGMA read when the schema is already current
+    database.configure(app.config['DATABASE_URL'], app.config['DATABASE_SHARDS'],
+                       app.config['DATABASE_BUSY_TIMEOUT'])
+    applied = database.init_db()
+    if applied:
+        app.logger.warning('Applied %d schema migration(s) to %s', applied, app.config['DATABASE_URL'])
+    
+    # Compress HTML/JSON/CSS/JS responses for clients that accept it
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                         min_size=app.config['COMPRESSION_MIN_SIZE'],
+                                         level=app.config['COMPRESSION_LEVEL'])
+    
+    app.config['BOOT_TIME_MS'] = (time.perf_counter() - started) * 1000
+    app.logger.info('App created in %.1f ms', app.config['BOOT_TIME_MS'])
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
-    init_db()
-    app.run(debug=True)
+    app.run(debug=app.config['DEBUG'])
@@ -0,0 +1,391 @@
+"""Stress the booking routes from many processes and check the booking invariants.
+
+Usage: python benchmarks/booking_stress.py [--workers N] [--seconds N] [--lots N]
+                                           [--slots N] [--shards N] [--busy-timeout S]
+                                           [--keep DIR]
+
+Each worker process builds the app against the same fresh SQLite file(s) and
+drives the real routes through Flask test clients: booking (now or later),
+cancelling its own bookings, admin force release, and expiry. Expiry is
+simulated by moving the end of one of the worker's active bookings (and its
+interval index entry) into the past, and loading the dashboard, which runs
+the expiry sweep, only half the time, so other workers get to rebook the
+slot before the sweep sees the old booking.
+
+Connections wait only --busy-timeout seconds for a write lock, so contention
+shows up as lock retries instead of being absorbed by SQLite's busy wait.
+
+Afterwards, once a final sweep has expired any backdated bookings, the
+database must satisfy:
+  - at most one active or held booking per slot, and no overlapping windows
+  - each slot's status matches its active/held booking
+  - lot, floor and zone counters match the slot rows
+  - the interval index holds exactly the active, reserved and held bookings
+
+Prints throughput and lock-retry rates; exits 1 if any invariant is violated.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from utils.availability import to_index_time
+from utils.booking_utils import auto_cancel_expired_bookings
+
+OPERATIONS = {'book': 50, 'cancel': 20, 'release': 15, 'expire': 15}
+MAX_RETRIES = 8
+LIVE_STATUSES = ('active', 'reserved', 'held')
+MAX_REPORTED = 10  # violations printed per invariant
+
+def load_app(db_path, shard_paths, busy_timeout):
+    """Import the app against the stress databases; importing app builds an
+    app from the environment, which must never be the real database"""
+    os.environ.update(DATABASE_URL=db_path, DATABASE_SHARDS=','.join(shard_paths),
+                      RATE_LIMIT_ENABLED='false')
+    from app import create_app
+    from config import Config
+
+    class StressConfig(Config):
+        TESTING = True
+        DATABASE_BUSY_TIMEOUT = busy_timeout
+
+    return create_app, StressConfig
+
+def setup(create_app, config, lots, slots, workers):
+    """Create the schema, the lots and one user per worker"""
+    create_app(config)
+    conn = database.get_db()
+    for number in range(lots):
+        database.create_lot(conn, f'Stress Lot {number + 1}', 'Benchmark', slots, 2.0)
+    conn.executemany('INSERT INTO users (username, email, password, phone) VALUES (?, ?, ?, ?)',
+                     [(f'stress{n}', f'stress{n}@example.com', '!', '') for n in range(workers)])
+    conn.commit()
+    user_ids = [row['id'] for row in conn.execute(
+        "SELECT id FROM users WHERE username LIKE 'stress%' ORDER BY id")]
+    lot_ids = [row['id'] for row in conn.execute('SELECT id FROM parking_lots ORDER BY id')]
+    conn.close()
+    return user_ids, lot_ids
+
+@contextmanager
+def patient_reads():
+    """The harness's own bookkeeping reads wait for locks like the app
+    normally would, so only the routes under test count lock retries"""
+    busy_timeout = database.BUSY_TIMEOUT
+    database.BUSY_TIMEOUT = 5.0
+    try:
+        yield
+    finally:
+        database.BUSY_TIMEOUT = busy_timeout
+
+class Worker:
+    def __init__(self, app, user_id, lot_ids, seed):
+        self.app = app
+        self.user_id = user_id
+        self.lot_ids = lot_ids
+        self.random = random.Random(seed)
+        self.stats = defaultdict(Counter)
+        self.errors = []
+
+        self.user = self.app.test_client()
+        with self.user.session_transaction() as session:
+            session.update(logged_in=True, user_id=user_id, username=f'stress{user_id}')
+        self.admin = self.app.test_client()
+        with self.admin.session_transaction() as session:
+            session.update(admin_logged_in=True, admin_username='admin')
+
+        self.slot_ids = {}
+        with patient_reads():
+            for lot_id in lot_ids:
+                conn = database.get_lot_db(lot_id)
+                self.slot_ids[lot_id] = [row['id'] for row in conn.execute(
+                    'SELECT id FROM parking_slots WHERE parking_lot_id = ?', (lot_id,))]
+                conn.close()
+
+    def _request(self, operation, client, send):
+        """Send a request, retrying when SQLite reports a lock; returns
+        whether the route flashed success"""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                send()
+                break
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                self.stats[operation]['lock_retries'] += 1
+                time.sleep(self.random.uniform(0, 0.005 * 2 ** attempt))
+        else:
+            self.stats[operation]['lock_failures'] += 1
+            return False
+        with client.session_transaction() as session:
+            flashes = session.pop('_flashes', [])
+        return any(category == 'success' for category, _ in flashes)
+
+    def _own_bookings(self, statuses):
+        placeholders = ', '.join('?' * len(statuses))
+        with patient_reads():
+            return [row['id'] for row in database.fan_out_query(f'''
+                SELECT id FROM bookings WHERE user_id = ? AND status IN ({placeholders})
+            ''', [self.user_id, *statuses])]
+
+    def book(self):
+        lot_id = self.random.choice(self.lot_ids)
+        form = {'slot_id': self.random.choice(self.slot_ids[lot_id]), 'vehicle_number': f'ST-{self.user_id}',
+                'vehicle_type': 'car', 'hours': self.random.randint(1, 3)}
+        if self.random.random() < 0.25:
+            start = datetime.now() + timedelta(hours=self.random.randint(1, 6))
+            form['start_time'] = start.strftime('%Y-%m-%dT%H:%M')
+        return self._request('book', self.user, lambda: self.user.post(f'/book/{lot_id}', data=form))
+
+    def cancel(self):
+        booking_ids = self._own_bookings(('active', 'reserved'))
+        if not booking_ids:
+            return None
+        booking_id = self.random.choice(booking_ids)
+        return self._request('cancel', self.user, lambda: self.user.get(f'/cancel-booking/{booking_id}'))
+
+    def release(self):
+        lot_id = self.random.choice(self.lot_ids)
+        with patient_reads():
+            conn = database.get_lot_db(lot_id)
+            taken = [row['id'] for row in conn.execute('''
+                SELECT id FROM parking_slots WHERE parking_lot_id = ? AND status IN ('occupied', 'held')
+            ''', (lot_id,))]
+            conn.close()
+        if not taken:
+            return None
+        slot_id = self.random.choice(taken)
+        return self._request('release', self.admin,
+                             lambda: self.admin.post(f'/admin/force-release-slot/{slot_id}'))
+
+    def expire(self):
+        booking_ids = self._own_bookings(('active',))
+        if not booking_ids:
+            return None
+        booking_id = self.random.choice(booking_ids)
+
+        end_time = datetime.now() - timedelta(seconds=1)
+        backdated = []
+
+        def backdate():
+            # Only ever shortens a booking, so it can't create an overlap.
+            # The index entry moves with it: the slot is bookable again as
+            # soon as the end time has passed, sweep or not.
+            conn = database.get_row_db(booking_id)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('''
+                    UPDATE bookings SET end_time = MAX(start_time, ?)
+                    WHERE id = ? AND status = 'active' AND end_time > ?
+                    RETURNING parking_lot_id, slot_id, end_time
+                ''', (end_time, booking_id, end_time)).fetchone()
+                if row:
+                    conn.execute('UPDATE booking_intervals SET end_ts = ? WHERE id = ?',
+                                 (to_index_time(row['end_time']), booking_id))
+                    backdated.append(row)
+                conn.commit()
+            finally:
+                conn.close()
+        self._request('expire', self.user, backdate)
+
+        if not backdated:
+            return False
+        # Half the time, rebook the slot while the old booking still reads
+        # 'active' and leave the sweep to a later request
+        if self.random.random() < 0.5:
+            lot_id, slot_id = backdated[0]['parking_lot_id'], backdated[0]['slot_id']
+            form = {'slot_id': slot_id, 'vehicle_number': f'ST-{self.user_id}', 'vehicle_type': 'car', 'hours': 1}
+            self._request('book', self.user, lambda: self.user.post(f'/book/{lot_id}', data=form))
+            return True
+        self._request('expire', self.user, lambda: self.user.get('/dashboard'))
+
+        with patient_reads():
+            conn = database.get_row_db(booking_id)
+            status = conn.execute('SELECT status FROM bookings WHERE id = ?', (booking_id,)).fetchone()['status']
+            conn.close()
+        return status == 'expired'
+
+    def run(self, deadline):
+        operations = list(OPERATIONS)
+        weights = list(OPERATIONS.values())
+        while time.monotonic() < deadline:
+            operation = self.random.choices(operations, weights)[0]
+            try:
+                result = getattr(self, operation)()
+            except Exception as e:
+                self.stats[operation]['errors'] += 1
+                self.errors.append(f'{operation}: {type(e).__name__}: {e}')
+                continue
+            if result is None:
+                continue
+            self.stats[operation]['requests'] += 1
+            self.stats[operation]['succeeded' if result else 'rejected'] += 1
+
+def run_worker(db_path, shard_paths, busy_timeout, user_id, lot_ids, seed, start_at, seconds, results):
+    create_app, config = load_app(db_path, shard_paths, busy_timeout)
+    worker = Worker(create_app(config), user_id, lot_ids, seed)
+    while time.time() < start_at:
+        time.sleep(0.001)
+    worker.run(time.monotonic() + seconds)
+    results.put(({operation: dict(counts) for operation, counts in worker.stats.items()}, worker.errors[:MAX_REPORTED]))
+
+def _check_shard(conn, shard):
+    violations = defaultdict(list)
+    live = ', '.join(f"'{status}'" for status in LIVE_STATUSES)
+
+    for row in conn.execute('''
+        SELECT slot_id, GROUP_CONCAT(id) as booking_ids FROM bookings
+        WHERE status IN ('active', 'held') GROUP BY slot_id HAVING COUNT(*) > 1
+    '''):
+        violations['one active booking per slot'].append(
+            f'slot {row["slot_id"]} has bookings {row["booking_ids"]}')
+
+    for row in conn.execute(f'''
+        SELECT a.slot_id, a.id as first, b.id as second FROM bookings a
+        JOIN bookings b ON b.slot_id = a.slot_id AND b.id > a.id
+        WHERE a.status IN ({live}) AND b.status IN ({live})
+          AND a.start_time < b.end_time AND b.start_time < a.end_time
+    '''):
+        violations['no overlapping bookings'].append(
+            f'slot {row["slot_id"]}: bookings {row["first"]} and {row["second"]} overlap')
+
+    for row in conn.execute('''
+        SELECT ps.id, ps.status,
+               SUM(b.status = 'active') as active, SUM(b.status = 'held') as held
+        FROM parking_slots ps
+        LEFT JOIN bookings b ON b.slot_id = ps.id AND b.status IN ('active', 'held')
+        WHERE ps.status != 'maintenance'
+        GROUP BY ps.id
+    '''):
+        expected = 'occupied' if row['active'] else 'held' if row['held'] else 'available'
+        if row['status'] != expected:
+            violations['slot status matches bookings'].append(
+                f'slot {row["id"]} is {row["status"]} with {row["active"] or 0} active '
+                f'and {row["held"] or 0} held booking(s)')
+
+    levels = (('parking_lots', 'parking_lot_id', f'shard = {shard}'), ('parking_floors', None, '1'),
+              ('parking_zones', 'zone_id', '1'))
+    for table, key, condition in levels:
+        match = (f'ps.{key} = t.id' if key else
+                 'ps.zone_id IN (SELECT id FROM parking_zones WHERE floor_id = t.id)')
+        for row in conn.execute(f'''
+            SELECT t.id, t.slot_count, t.available_count, t.occupied_count,
+                   COUNT(ps.id) as slots,
+                   COALESCE(SUM(ps.status = 'available'), 0) as available,
+                   COALESCE(SUM(ps.status = 'occupied'), 0) as occupied
+            FROM {table} t LEFT JOIN parking_slots ps ON {match}
+            WHERE {condition}
+            GROUP BY t.id
+        '''):
+            actual = (row['slot_count'], row['available_count'], row['occupied_count'])
+            expected = (row['slots'], row['available'], row['occupied'])
+            if actual != expected:
+                violations['counters match slot rows'].append(
+                    f'{table} {row["id"]}: counters {actual}, rows {expected}')
+
+    for booking_id, in conn.execute(f'''
+        SELECT id FROM bookings WHERE status IN ({live}) EXCEPT SELECT id FROM booking_intervals
+    '''):
+        violations['interval index matches bookings'].append(f'booking {booking_id} is not indexed')
+    for booking_id, in conn.execute(f'''
+        SELECT id FROM booking_intervals EXCEPT SELECT id FROM bookings WHERE status IN ({live})
+    '''):
+        violations['interval index matches bookings'].append(f'booking {booking_id} is indexed but not live')
+
+    return violations
+
+def check_invariants():
+    violations = defaultdict(list)
+    for shard_violations in database.fan_out(_check_shard):
+        for invariant, messages in shard_violations.items():
+            violations[invariant].extend(messages)
+    return violations
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8, help='worker processes')
+    parser.add_argument('--seconds', type=float, default=10.0, help='length of the run')
+    parser.add_argument('--lots', type=int, default=2)
+    parser.add_argument('--slots', type=int, default=8, help='slots per lot; fewer means more contention')
+    parser.add_argument('--shards', type=int, default=0, help='extra shard files (DATABASE_SHARDS)')
+    parser.add_argument('--busy-timeout', type=float, default=0.01,
+                        help='seconds a connection waits for a write lock before it counts as a lock retry')
+    parser.add_argument('--keep', metavar='DIR', help='write the databases to DIR and keep them')
+    args = parser.parse_args()
+
+    directory = args.keep or tempfile.mkdtemp(prefix='booking_stress_')
+    os.makedirs(directory, exist_ok=True)
+    db_path = os.path.join(directory, 'stress.db')
+    shard_paths = [os.path.join(directory, f'stress_shard{n + 1}.db') for n in range(args.shards)]
+    for path in [db_path] + shard_paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+    try:
+        create_app, config = load_app(db_path, shard_paths, args.busy_timeout)
+        user_ids, lot_ids = setup(create_app, config, args.lots, args.slots, args.workers)
+
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1 + 0.2 * args.workers  # let every worker finish booting
+        processes = [multiprocessing.Process(target=run_worker,
+                                             args=(db_path, shard_paths, args.busy_timeout, user_id, lot_ids, n, start_at,
+                                                   args.seconds, results))
+                     for n, user_id in enumerate(user_ids)]
+        for process in processes:
+            process.start()
+        stats = defaultdict(Counter)
+        errors = []
+        for _ in processes:
+            worker_stats, worker_errors = results.get()
+            for operation, counts in worker_stats.items():
+                stats[operation].update(counts)
+            errors.extend(worker_errors)
+        for process in processes:
+            process.join()
+
+        print(f'{args.workers} workers, {args.seconds:g}s, {args.lots} lot(s) x {args.slots} slots, '
+              f'{args.shards} extra shard(s)')
+        print(f'{"operation":<10} {"requests":>9} {"req/s":>8} {"ok":>7} {"rejected":>9} '
+              f'{"lock retries":>13} {"retry rate":>11} {"gave up":>8} {"errors":>7}')
+        for operation in OPERATIONS:
+            counts = stats[operation]
+            attempts = counts['requests'] + counts['lock_retries']
+            print(f'{operation:<10} {counts["requests"]:>9} {counts["requests"] / args.seconds:>8.1f} '
+                  f'{counts["succeeded"]:>7} {counts["rejected"]:>9} {counts["lock_retries"]:>13} '
+                  f'{counts["lock_retries"] / attempts if attempts else 0:>11.1%} '
+                  f'{counts["lock_failures"]:>8} {counts["errors"]:>7}')
+        total = sum(counts['requests'] for counts in stats.values())
+        print(f'total {total} requests, {total / args.seconds:.1f} req/s')
+        for error in errors[:MAX_REPORTED]:
+            print(f'  error: {error}')
+
+        # Bookings backdated without a sweep afterwards are settled first, as
+        # the next page load would; the sweep compares whole seconds
+        time.sleep(1)
+        with create_app(config).app_context():
+            auto_cancel_expired_bookings()
+        violations = check_invariants()
+        print()
+        if not violations:
+            print('All invariants hold.')
+        for invariant, messages in violations.items():
+            print(f'VIOLATED: {invariant} ({len(messages)})')
+            for message in messages[:MAX_REPORTED]:
+                print(f'  {message}')
+        return 1 if violations or errors else 0
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
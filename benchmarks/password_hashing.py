@@ -0,0 +1,41 @@
+"""Logins per second per core for each password hashing setting.
+
+Usage: python benchmarks/password_hashing.py [METHOD ...] [--seconds N]
+
+Each login costs one check_password_hash call, so single-threaded verifies
+per second is the login throughput one core can sustain.
+"""
+import argparse
+import time
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_METHODS = [
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha256:100000',
+    'scrypt:32768:8:1',
+    'scrypt:16384:8:1',
+]
+
+def logins_per_second(method, seconds):
+    stored = generate_password_hash('benchmark-password', method)
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        check_password_hash(stored, 'benchmark-password')
+        count += 1
+    return count / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('methods', nargs='*', default=DEFAULT_METHODS)
+    parser.add_argument('--seconds', type=float, default=2.0, help='time spent per method')
+    args = parser.parse_args()
+
+    print(f'{"method":<26} {"logins/s/core":>14} {"ms/login":>10}')
+    for method in args.methods:
+        rate = logins_per_second(method, args.seconds)
+        print(f'{method:<26} {rate:>14.1f} {1000 / rate:>10.1f}')
+
+if __name__ == '__main__':
+    main()
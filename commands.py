@@ -0,0 +1,26 @@
+import click
+from database import get_db, init_db, seed_db
+from utils.booking_events import rebuild_aggregates
+
+@click.command('init-db')
+def init_db_command():
+    """Create or migrate the database schema."""
+    applied = init_db()
+    click.echo(f'Database schema up to date ({applied} migration(s) applied).')
+
+@click.command('seed-db')
+def seed_db_command():
+    """Insert the sample parking lots into an empty database."""
+    added = seed_db()
+    if added:
+        click.echo(f'Added {added} sample parking lots.')
+    else:
+        click.echo('Parking lots already exist, nothing to seed.')
+
+@click.command('replay-events')
+def replay_events_command():
+    """Rebuild the booking aggregates by replaying the booking event log."""
+    conn = get_db()
+    applied = rebuild_aggregates(conn)
+    conn.close()
+    click.echo(f'Replayed {applied} booking event(s).')
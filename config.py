@@ -3,17 +3,101 @@ import os
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'parking-app-secret-key-2024'
     DATABASE_URL = os.environ.get('DATABASE_URL') or 'parking_system.db'
+    # Extra database files for per-lot sharding, comma separated. New lots go
+    # to the shard holding the fewest; empty keeps everything in DATABASE_URL.
+    DATABASE_SHARDS = [path for path in (os.environ.get('DATABASE_SHARDS') or '').split(',') if path]
+    DATABASE_BUSY_TIMEOUT = 5.0  # seconds to wait for another connection's write lock
     
     # Admin credentials
     ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME') or 'admin'
     ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD') or 'admin123'
     
+    # Password hashing: any Werkzeug method string, e.g. 'pbkdf2:sha256:600000'
+    # or 'scrypt:32768:8:1'. Existing hashes are upgraded on the next login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:600000'
+    # Concurrent hashes per worker process. The cap applies to each gunicorn
+    # worker separately, so by default the host's cores are split between
+    # the WEB_CONCURRENCY workers (see gunicorn.conf.py).
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or
+                                max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY') or 1)))
+    PASSWORD_HASH_QUEUE_LIMIT = 64  # hashing requests allowed to wait per worker process
+    PASSWORD_HASH_QUEUE_TIMEOUT = 5  # seconds to wait for a queue slot
+    
     # App settings
     DEBUG = os.environ.get('FLASK_DEBUG', 'True').lower() == 'true'
     
+    # Fleet bulk booking
+    BULK_BOOKING_MAX_VEHICLES = 200
+    
+    # Waitlist for full lots
+    WAITLIST_HOLD_MINUTES = 10  # how long an offered slot is held for the waiter
+    WAITLIST_LOYALTY_STEP = 5  # finished bookings per loyalty tier
+    
+    # Audit log (utils/audit.py)
+    AUDIT_BATCH_SIZE = 100  # buffered events that trigger a flush
+    AUDIT_FLUSH_SECONDS = 2.0  # longest an event waits in the buffer
+    AUDIT_BUFFER_MAX = 10000  # events kept per worker while the catalog is unavailable
+    AUDIT_DURABLE_ACTIONS = ('slot.force_release', 'lot.delete')  # written in the action's own transaction
+    AUDIT_PAGE_SIZE = 50
+    
+    # Idempotency-Key retention for booking, cancel and force-release requests
+    IDEMPOTENCY_KEY_TTL_HOURS = 24
+    
+    # Demand pricing (utils/pricing.py); run `flask refresh-prices` after changing these
+    PRICING_ENABLED = os.environ.get('PRICING_ENABLED', 'True').lower() == 'true'
+    # (lowest occupancy, price multiplier) per demand band, in increasing order
+    PRICING_OCCUPANCY_BANDS = ((0.0, 0.9), (0.5, 1.0), (0.8, 1.25), (0.95, 1.5))
+    # Price multiplier for each hour of the day: off-peak nights, busier rush hours
+    PRICING_HOUR_MULTIPLIERS = (0.8,) * 6 + (1.0,) + (1.2,) * 3 + (1.0,) * 6 + (1.2,) * 3 + (1.0,) * 3 + (0.8,) * 2
+    PRICING_SURGE_HORIZON_HOURS = 2  # bookings starting later than this ignore current occupancy
+    PRICING_FUTURE_BAND = 1  # band used for them
+    
+    # Nearest-lot search (utils/geo.py)
+    NEAREST_LOTS_LIMIT = 6  # lots shown on the dashboard
+    NEAREST_START_KM = 1  # first search radius, doubled until enough lots are found
+    NEAREST_MAX_KM = 50
+    
+    # Occupancy analytics
+    OCCUPANCY_WORKERS = int(os.environ.get('OCCUPANCY_WORKERS') or os.cpu_count() or 1)
+    OCCUPANCY_PARALLEL_MIN_DAYS = 60  # lot-days to recompute before using the process pool
+    OCCUPANCY_MAX_DAYS = 366
+    
+    # Background report jobs (run by `flask run-jobs`)
+    REPORTS_DIR = os.environ.get('REPORTS_DIR') or 'reports'
+    REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS') or 2)
+    REPORT_RESULT_TTL_HOURS = 24  # downloads are deleted after this
+    REPORT_POLL_INTERVAL = 1.0  # seconds an idle worker waits between checks
+    REPORT_STALE_SECONDS = 300  # running jobs without progress for this long are retried
+    
+    # flask db-maintain
+    DB_MAINTENANCE_SECONDS = 5  # longest any step may hold or wait for a lock, per file
+    DB_VACUUM_STEP_PAGES = 256  # pages freed per incremental vacuum transaction
+    DB_ANALYSIS_LIMIT = 1000  # rows ANALYZE samples per index
+    
     # Pagination
     BOOKINGS_PER_PAGE = 20
+    API_PAGE_SIZE = 20
+    API_MAX_PAGE_SIZE = 100
+    API_BATCH_MAX_REQUESTS = 20
     
     # Auto-refresh intervals (in seconds)
     DASHBOARD_REFRESH_INTERVAL = 30
     USER_DASHBOARD_REFRESH_INTERVAL = 60
+    
+    # Response compression (gzip, or brotli when installed)
+    COMPRESSION_MIN_SIZE = 500  # bytes; smaller responses are sent as-is
+    COMPRESSION_LEVEL = 6
+    
+    # Booking admission control (token buckets shared by all workers)
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+    RATE_LIMIT_DATABASE = os.environ.get('RATE_LIMIT_DATABASE') or 'rate_limits.db'
+    RATE_LIMIT_LOCK_TIMEOUT = 0.25  # seconds before failing open
+    RATE_LIMIT_BUCKET_TTL = 3600  # must exceed burst / rate for every bucket
+    BOOKING_USER_BURST = 5
+    BOOKING_USER_RATE = 1 / 12  # tokens per second: 5 bookings per minute
+    BOOKING_LOT_BURST = 30
+    BOOKING_LOT_RATE = 5
+    BULK_BOOKING_USER_BURST = 200  # vehicles; at least BULK_BOOKING_MAX_VEHICLES
+    BULK_BOOKING_USER_RATE = 200 / 3600  # vehicles per second: a full fleet per hour
+    CANCEL_USER_BURST = 5
+    CANCEL_USER_RATE = 1 / 12
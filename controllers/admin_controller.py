@@ -1,8 +1,14 @@
-from flask import Blueprint, request, redirect, session, flash, render_template, jsonify, make_response
-from database import get_db
+from flask import Blueprint, request, redirect, session, flash, render_template, jsonify, current_app
+from database import get_db, get_lot_db, fan_out_query, SHARD, create_lot, sync_lot
+from utils.pricing import refresh_lot_prices
+from utils.idempotency import new_key
+from utils.audit import audit, flush_audit, query_log, ACTIONS
+from utils.geo import parse_coordinates
+from utils.rate_limit import get_rate_limit_counters
+from utils.lot_layout import resolve_level
+from utils.booking_events import apply_new_events, get_status_counts, get_daily_revenue, get_revenue
+from utils.occupancy import refresh_occupancy, occupancy_report
 from datetime import datetime, timedelta
-import csv
-import io
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -19,27 +25,26 @@ def admin_dashboard():
         return auth_check
     
     conn = get_db()
+    apply_new_events(conn)
     
     # Get statistics
     stats = {}
     stats['total_lots'] = conn.execute('SELECT COUNT(*) FROM parking_lots WHERE deleted_at IS NULL').fetchone()[0]
-    stats['total_slots'] = conn.execute('SELECT COUNT(*) FROM parking_slots ps JOIN parking_lots pl ON ps.parking_lot_id = pl.id WHERE pl.deleted_at IS NULL').fetchone()[0]
-    stats['available_slots'] = conn.execute('SELECT COUNT(*) FROM parking_slots ps JOIN parking_lots pl ON ps.parking_lot_id = pl.id WHERE ps.status = "available" AND pl.deleted_at IS NULL').fetchone()[0]
-    stats['occupied_slots'] = conn.execute('SELECT COUNT(*) FROM parking_slots ps JOIN parking_lots pl ON ps.parking_lot_id = pl.id WHERE ps.status = "occupied" AND pl.deleted_at IS NULL').fetchone()[0]
-    stats['total_revenue'] = conn.execute('SELECT COALESCE(SUM(total_cost), 0) FROM bookings WHERE status IN ("active", "completed")').fetchone()[0]
-    
-    # Get parking lots with slot counts
-    lots = conn.execute('''
-        SELECT p.*, 
-               COUNT(ps.id) as total_slots,
-               SUM(CASE WHEN ps.status = 'available' THEN 1 ELSE 0 END) as available_slots,
-               SUM(CASE WHEN ps.status = 'occupied' THEN 1 ELSE 0 END) as occupied_slots
+    stats['total_revenue'] = get_revenue(conn)
+    
+    # Get parking lots with slot counts, from the shard holding each lot
+    lots = fan_out_query('''
+        SELECT p.id, p.name, p.location, p.price_per_hour, p.created_at,
+               p.slot_count as total_slots,
+               p.available_count as available_slots,
+               p.occupied_count as occupied_slots
         FROM parking_lots p
-        LEFT JOIN parking_slots ps ON p.id = ps.parking_lot_id
-        WHERE p.deleted_at IS NULL
-        GROUP BY p.id
+        WHERE p.deleted_at IS NULL AND p.shard = ?
         ORDER BY p.name
-    ''').fetchall()
+    ''', [SHARD], key=lambda lot: lot['name'])
+    stats['total_slots'] = sum(lot['total_slots'] for lot in lots)
+    stats['available_slots'] = sum(lot['available_slots'] for lot in lots)
+    stats['occupied_slots'] = sum(lot['occupied_slots'] for lot in lots)
     
     # Get chart data for dashboard
     chart_data = get_dashboard_chart_data(conn)
@@ -58,24 +63,25 @@ def add_lot():
         location = request.form['location']
         total_slots = int(request.form['total_slots'])
         price_per_hour = float(request.form['price_per_hour'])
+        floors = max(1, int(request.form.get('floors') or 1))
+        zones_per_floor = max(1, int(request.form.get('zones_per_floor') or 1))
+        try:
+            latitude, longitude = parse_coordinates(request.form.get('latitude'), request.form.get('longitude'))
+        except ValueError:
+            flash('Invalid coordinates! Enter both latitude and longitude, or neither.', 'error')
+            return redirect('/admin/add-lot')
         
         conn = get_db()
-        cursor = conn.execute('''
-            INSERT INTO parking_lots (name, location, total_slots, price_per_hour)
-            VALUES (?, ?, ?, ?)
-        ''', (name, location, total_slots, price_per_hour))
-        
-        lot_id = cursor.lastrowid
         
-        # Create slots for the lot
-        for slot_num in range(1, total_slots + 1):
-            conn.execute('''
-                INSERT INTO parking_slots (parking_lot_id, slot_number, status)
-                VALUES (?, ?, 'available')
-            ''', (lot_id, slot_num))
+        # Add the lot to the catalog and create its floors, zones and slots
+        lot_id = create_lot(conn, name, location, total_slots, price_per_hour, floors, zones_per_floor,
+                            latitude, longitude)
+        audit('lot.create', 'lot', lot_id, {'name': name, 'total_slots': total_slots,
+                                            'price_per_hour': price_per_hour}, conn=conn)
         
         conn.commit()
         conn.close()
+        refresh_lot_prices(lot_id)
         
         flash(f'Parking lot "{name}" created successfully with {total_slots} slots!', 'success')
         return redirect('/admin/dashboard')
@@ -94,15 +100,25 @@ def edit_lot(lot_id):
         name = request.form['name']
         location = request.form['location']
         price_per_hour = float(request.form['price_per_hour'])
+        try:
+            latitude, longitude = parse_coordinates(request.form.get('latitude'), request.form.get('longitude'))
+        except ValueError:
+            conn.close()
+            flash('Invalid coordinates! Enter both latitude and longitude, or neither.', 'error')
+            return redirect(f'/admin/edit-lot/{lot_id}')
         
         conn.execute('''
             UPDATE parking_lots 
-            SET name = ?, location = ?, price_per_hour = ?
+            SET name = ?, location = ?, price_per_hour = ?, latitude = ?, longitude = ?
             WHERE id = ?
-        ''', (name, location, price_per_hour, lot_id))
+        ''', (name, location, price_per_hour, latitude, longitude, lot_id))
+        audit('lot.edit', 'lot', lot_id, {'name': name, 'location': location,
+                                          'price_per_hour': price_per_hour}, conn=conn)
         
         conn.commit()
+        sync_lot(conn, lot_id)
         conn.close()
+        refresh_lot_prices(lot_id)
         
         flash('Parking lot updated successfully!', 'success')
         return redirect('/admin/dashboard')
@@ -130,8 +146,10 @@ def delete_lot(lot_id):
         SET deleted_at = CURRENT_TIMESTAMP 
         WHERE id = ?
     ''', (lot_id,))
+    audit('lot.delete', 'lot', lot_id, conn=conn)
     
     conn.commit()
+    sync_lot(conn, lot_id)
     conn.close()
     
     flash('Parking lot deleted successfully!', 'success')
@@ -150,13 +168,20 @@ def all_bookings():
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
     
+    # Users live in the catalog, bookings on the shards
     conn = get_db()
+    user_query = 'SELECT id, username, email FROM users'
+    user_params = []
+    if search_user:
+        user_query += ' WHERE username LIKE ? OR email LIKE ?'
+        user_params.extend([f'%{search_user}%', f'%{search_user}%'])
+    users = {user['id']: user for user in conn.execute(user_query, user_params)}
+    conn.close()
     
     # Build query with filters
     query = '''
-        SELECT b.*, u.username, u.email, p.name as lot_name, p.location, ps.slot_number
+        SELECT b.*, p.name as lot_name, p.location, ps.slot_number
         FROM bookings b
-        JOIN users u ON b.user_id = u.id
         JOIN parking_lots p ON b.parking_lot_id = p.id
         JOIN parking_slots ps ON b.slot_id = ps.id
         WHERE 1=1
@@ -164,8 +189,8 @@ def all_bookings():
     params = []
     
     if search_user:
-        query += ' AND (u.username LIKE ? OR u.email LIKE ?)'
-        params.extend([f'%{search_user}%', f'%{search_user}%'])
+        query += f' AND b.user_id IN ({", ".join("?" * len(users)) or "NULL"})'
+        params.extend(users)
     
     if search_lot:
         query += ' AND p.name LIKE ?'
@@ -183,10 +208,13 @@ def all_bookings():
         query += ' AND DATE(b.created_at) <= ?'
         params.append(date_to)
     
-    query += ' ORDER BY b.created_at DESC'
+    query += ' ORDER BY b.created_at DESC, b.id DESC'
     
-    bookings = conn.execute(query, params).fetchall()
-    conn.close()
+    bookings = []
+    for booking in fan_out_query(query, params, key=lambda b: (b['created_at'], b['id']), reverse=True):
+        user = users.get(booking['user_id'])
+        bookings.append(dict(booking, username=user['username'] if user else '',
+                             email=user['email'] if user else ''))
     
     return render_template('admin/bookings.html', bookings=bookings, 
                          search_user=search_user, search_lot=search_lot, 
@@ -198,83 +226,30 @@ def slot_map(lot_id):
     if auth_check:
         return auth_check
     
-    conn = get_db()
+    conn = get_lot_db(lot_id)
     
     lot = conn.execute('SELECT * FROM parking_lots WHERE id = ? AND deleted_at IS NULL', (lot_id,)).fetchone()
     if not lot:
         flash('Parking lot not found!', 'error')
+        conn.close()
         return redirect('/admin/dashboard')
     
-    slots = conn.execute('''
-        SELECT ps.*, b.vehicle_number, b.end_time
-        FROM parking_slots ps
-        LEFT JOIN bookings b ON ps.id = b.slot_id AND b.status = 'active'
-        WHERE ps.parking_lot_id = ?
-        ORDER BY ps.slot_number
-    ''', (lot_id,)).fetchall()
-    
-    conn.close()
-    
-    return render_template('admin/slot_map.html', lot=lot, slots=slots)
-
-@admin_bp.route('/admin/export-csv')
-def export_csv():
-    auth_check = require_admin()
-    if auth_check:
-        return auth_check
+    view = resolve_level(conn, lot_id, request.args.get('floor', type=int),
+                         request.args.get('zone', type=int))
     
-    export_type = request.args.get('type', 'bookings')
-    
-    conn = get_db()
-    
-    if export_type == 'bookings':
-        data = conn.execute('''
-            SELECT b.id, u.username, u.email, p.name as lot_name, p.location,
-                   ps.slot_number, b.vehicle_number, b.vehicle_type,
-                   b.start_time, b.end_time, b.total_cost, b.status
-            FROM bookings b
-            JOIN users u ON b.user_id = u.id
-            JOIN parking_lots p ON b.parking_lot_id = p.id
-            JOIN parking_slots ps ON b.slot_id = ps.id
-            ORDER BY b.created_at DESC
-        ''').fetchall()
-        
-        filename = f'bookings_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        headers = ['ID', 'Username', 'Email', 'Parking Lot', 'Location', 'Slot', 
-                  'Vehicle Number', 'Vehicle Type', 'Start Time', 'End Time', 'Cost', 'Status']
-    
-    elif export_type == 'lots':
-        data = conn.execute('''
-            SELECT p.id, p.name, p.location, p.total_slots, p.price_per_hour,
-                   COUNT(ps.id) as actual_slots,
-                   SUM(CASE WHEN ps.status = 'available' THEN 1 ELSE 0 END) as available,
-                   SUM(CASE WHEN ps.status = 'occupied' THEN 1 ELSE 0 END) as occupied
-            FROM parking_lots p
-            LEFT JOIN parking_slots ps ON p.id = ps.parking_lot_id
-            WHERE p.deleted_at IS NULL
-            GROUP BY p.id
-        ''').fetchall()
-        
-        filename = f'parking_lots_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        headers = ['ID', 'Name', 'Location', 'Total Slots', 'Price/Hour', 
-                  'Actual Slots', 'Available', 'Occupied']
+    slots = []
+    if view['level'] == 'slots':
+        slots = conn.execute('''
+            SELECT ps.*, b.vehicle_number, b.end_time
+            FROM parking_slots ps
+            LEFT JOIN bookings b ON ps.id = b.slot_id AND b.status = 'active'
+            WHERE ps.zone_id = ?
+            ORDER BY ps.slot_number
+        ''', (view['zone']['id'],)).fetchall()
     
     conn.close()
     
-    # Create CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(headers)
-    
-    for row in data:
-        writer.writerow(row)
-    
-    # Create response
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv'
-    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-    
-    return response
+    return render_template('admin/slot_map.html', lot=lot, slots=slots, view=view, idempotency_key=new_key())
 
 @admin_bp.route('/admin/deleted-lots')
 def deleted_lots():
@@ -300,12 +275,36 @@ def restore_lot(lot_id):
     
     conn = get_db()
     conn.execute('UPDATE parking_lots SET deleted_at = NULL WHERE id = ?', (lot_id,))
+    audit('lot.restore', 'lot', lot_id, conn=conn)
     conn.commit()
+    sync_lot(conn, lot_id)
     conn.close()
     
     flash('Parking lot restored successfully!', 'success')
     return redirect('/admin/deleted-lots')
 
+@admin_bp.route('/admin/audit')
+def audit_log():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    action = request.args.get('action', '')
+    actor = request.args.get('actor', '').strip()
+    before = None
+    if request.args.get('before'):
+        created_at, _, entry_id = request.args['before'].rpartition(',')
+        before = (created_at, int(entry_id)) if created_at and entry_id.isdigit() else None
+    
+    # Include this worker's own recent actions
+    flush_audit()
+    entries, cursor = query_log(action if action in ACTIONS else None, actor or None, before,
+                                current_app.config['AUDIT_PAGE_SIZE'])
+    
+    return render_template('admin/audit_log.html', entries=entries, actions=ACTIONS,
+                           action=action, actor=actor,
+                           next_before=f'{cursor[0]},{cursor[1]}' if cursor else None)
+
 @admin_bp.route('/admin/api/dashboard-data')
 def dashboard_api():
     auth_check = require_admin()
@@ -313,42 +312,82 @@ def dashboard_api():
         return jsonify({'error': 'Unauthorized'}), 401
     
     conn = get_db()
+    apply_new_events(conn)
     chart_data = get_dashboard_chart_data(conn)
     conn.close()
     
     return jsonify(chart_data)
 
+@admin_bp.route('/admin/api/rate-limits')
+def rate_limits_api():
+    auth_check = require_admin()
+    if auth_check:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify(get_rate_limit_counters())
+
+@admin_bp.route('/admin/occupancy')
+def occupancy():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    conn = get_db()
+    lots = conn.execute('SELECT id, name FROM parking_lots WHERE deleted_at IS NULL ORDER BY name').fetchall()
+    conn.close()
+    
+    return render_template('admin/occupancy.html', lots=lots)
+
+@admin_bp.route('/admin/api/occupancy')
+def occupancy_api():
+    auth_check = require_admin()
+    if auth_check:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    # Whole days up to yesterday; today is still changing
+    days = min(request.args.get('days', 28, type=int), current_app.config['OCCUPANCY_MAX_DAYS'])
+    last_day = datetime.now().date() - timedelta(days=1)
+    first_day = last_day - timedelta(days=max(days, 1) - 1)
+    lot_id = request.args.get('lot_id', type=int)
+    
+    conn = get_db()
+    query = 'SELECT id, name FROM parking_lots WHERE deleted_at IS NULL'
+    params = []
+    if lot_id:
+        query += ' AND id = ?'
+        params.append(lot_id)
+    lots = conn.execute(query + ' ORDER BY name', params).fetchall()
+    
+    if lots:
+        refresh_occupancy(conn, [lot['id'] for lot in lots], first_day, last_day,
+                          workers=current_app.config['OCCUPANCY_WORKERS'],
+                          parallel_min_days=current_app.config['OCCUPANCY_PARALLEL_MIN_DAYS'])
+    reports = [dict(id=lot['id'], name=lot['name'], **occupancy_report(conn, lot['id'], first_day, last_day))
+               for lot in lots]
+    conn.close()
+    
+    return jsonify({'first_day': first_day.isoformat(), 'last_day': last_day.isoformat(), 'lots': reports})
+
 def get_dashboard_chart_data(conn):
+    """Chart series; revenue and status come from the event-log aggregates,
+    so callers should apply_new_events() first"""
     # Revenue by day (last 7 days)
-    revenue_data = conn.execute('''
-        SELECT DATE(created_at) as date, SUM(total_cost) as revenue
-        FROM bookings 
-        WHERE created_at >= date('now', '-7 days')
-        AND status IN ('active', 'completed')
-        GROUP BY DATE(created_at)
-        ORDER BY date
-    ''').fetchall()
+    since = (datetime.utcnow() - timedelta(days=7)).strftime('%Y-%m-%d')
+    revenue_data = get_daily_revenue(conn, since)
     
     # Bookings by status
-    status_data = conn.execute('''
-        SELECT status, COUNT(*) as count
-        FROM bookings
-        GROUP BY status
-    ''').fetchall()
+    status_data = get_status_counts(conn)
     
     # Occupancy by parking lot
-    occupancy_data = conn.execute('''
-        SELECT p.name, 
-               COUNT(ps.id) as total_slots,
-               SUM(CASE WHEN ps.status = 'occupied' THEN 1 ELSE 0 END) as occupied_slots
+    occupancy_data = fan_out_query('''
+        SELECT p.name, p.slot_count as total_slots, p.occupied_count as occupied_slots
         FROM parking_lots p
-        LEFT JOIN parking_slots ps ON p.id = ps.parking_lot_id
-        WHERE p.deleted_at IS NULL
-        GROUP BY p.id, p.name
-    ''').fetchall()
+        WHERE p.deleted_at IS NULL AND p.shard = ?
+        ORDER BY p.name
+    ''', [SHARD], key=lambda lot: lot['name'])
     
     return {
-        'revenue': [{'date': row['date'], 'revenue': float(row['revenue'] or 0)} for row in revenue_data],
-        'status': [{'status': row['status'], 'count': row['count']} for row in status_data],
+        'revenue': [{'date': row['day'], 'revenue': float(row['revenue'] or 0)} for row in revenue_data],
+        'status': [{'status': status, 'count': count} for status, count in status_data.items()],
         'occupancy': [{'name': row['name'], 'total': row['total_slots'], 'occupied': row['occupied_slots']} for row in occupancy_data]
     }
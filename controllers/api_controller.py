@@ -0,0 +1,458 @@
+from flask import Blueprint, request, session, jsonify, current_app
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from database import (get_shard_db, get_lot_db, get_row_db, shard_for_lot, shard_for_id,
+                      shard_paths, merge_sorted, SHARD)
+from utils.rate_limit import admit_booking, admit_cancellation
+from utils.availability import free_slots, get_booking_window
+from utils.bulk_booking import validate_vehicle
+from utils.booking_utils import create_booking, cancel_user_booking
+from utils.pricing import quote
+from utils.idempotency import request_key, stored_response, store_response, respond
+from utils.audit import audit
+from utils.geo import parse_coordinates, nearest_lots
+from urllib.parse import urlsplit, parse_qsl
+import base64
+import json
+
+# JSON API for kiosks and the mobile app. Lists use keyset pagination: each
+# page carries an opaque ``next`` cursor naming the last row returned, and
+# the following page starts strictly after it, so pages stay cheap and
+# stable however deep the client goes. ``fields=a,b`` trims every item to
+# the named fields. Reads can be sent together to /batch, which answers
+# them on one connection per shard.
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+LOT_FIELDS = ('id', 'name', 'location', 'latitude', 'longitude', 'price_per_hour', 'total_slots',
+              'available_slots', 'occupied_slots')
+NEAREST_FIELDS = LOT_FIELDS + ('distance_km',)
+SLOT_FIELDS = ('id', 'slot_number', 'zone_id')
+BOOKING_FIELDS = ('id', 'lot_id', 'lot_name', 'slot_id', 'slot_number', 'vehicle_number', 'vehicle_type',
+                  'start_time', 'end_time', 'total_cost', 'price_version', 'status', 'created_at')
+BOOKING_STATUSES = ('active', 'reserved', 'held', 'cancelled', 'expired', 'completed')
+
+BOOKING_QUERY = '''
+    SELECT b.*, p.name as lot_name, ps.slot_number
+    FROM bookings b
+    JOIN parking_lots p ON b.parking_lot_id = p.id
+    JOIN parking_slots ps ON b.slot_id = ps.id
+'''
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def require_login():
+    if 'logged_in' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    return None
+
+class _Reads:
+    """Connections for answering reads, one per shard, opened on first use
+    and shared by every read in a batch"""
+    def __init__(self):
+        self._conns = {}
+
+    def shard(self, shard):
+        if shard not in self._conns:
+            self._conns[shard] = get_shard_db(shard)
+        return self._conns[shard]
+
+    def lot(self, lot_id):
+        return self.shard(shard_for_lot(lot_id))
+
+    def row(self, row_id):
+        return self.shard(shard_for_id(row_id))
+
+    def all(self, query, params, key, reverse=False):
+        """fan_out_query on these connections: rows from every shard, merged by key"""
+        results = [self.shard(shard).execute(query, [shard if param is SHARD else param for param in params]).fetchall()
+                   for shard in range(len(shard_paths()))]
+        return merge_sorted(results, key, reverse)
+
+    def close(self):
+        for conn in self._conns.values():
+            if conn is not None:
+                conn.close()
+
+def _timestamp(value):
+    return str(value)[:19] if value is not None else None
+
+def _lot_json(row):
+    return {'id': row['id'], 'name': row['name'], 'location': row['location'],
+            'latitude': row['latitude'], 'longitude': row['longitude'], 'price_per_hour': row['price_per_hour'], 'total_slots': row['slot_count'],
+            'available_slots': row['available_count'], 'occupied_slots': row['occupied_count']}
+
+def _booking_json(row):
+    return {'id': row['id'], 'lot_id': row['parking_lot_id'], 'lot_name': row['lot_name'],
+            'slot_id': row['slot_id'], 'slot_number': row['slot_number'],
+            'vehicle_number': row['vehicle_number'], 'vehicle_type': row['vehicle_type'],
+            'start_time': _timestamp(row['start_time']), 'end_time': _timestamp(row['end_time']),
+            'total_cost': row['total_cost'], 'price_version': row['price_version'], 'status': row['status'],
+            'created_at': _timestamp(row['created_at'])}
+
+def _fields(args, allowed):
+    """Fields requested with ?fields=, all of them by default"""
+    fields = [field for field in args.get('fields', '').split(',') if field]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ApiError(400, f'unknown field(s) {", ".join(unknown)}; choose from {", ".join(allowed)}')
+    return fields or allowed
+
+def _select(item, fields):
+    return {field: item[field] for field in fields}
+
+def _limit(args):
+    limit = args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def _decode_cursor(args, size):
+    cursor = args.get('after')
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    # Sort key(s) then the row id, each bound straight into the keyset query
+    if (not isinstance(values, list) or len(values) != size
+            or not all(isinstance(value, (str, int, float)) and not isinstance(value, bool)
+                       for value in values[:-1])
+            or not isinstance(values[-1], int) or isinstance(values[-1], bool)):
+        raise ApiError(400, 'invalid cursor')
+    return values
+
+def _page(rows, limit, cursor_of, to_json, fields):
+    """One page of merged rows (fetched with LIMIT limit + 1 per shard)"""
+    items = rows[:limit]
+    return {'items': [_select(to_json(row), fields) for row in items],
+            'next': _encode_cursor(cursor_of(items[-1])) if len(rows) > limit else None}
+
+def _get_lot(conn, lot_id):
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ? AND deleted_at IS NULL', (lot_id,)).fetchone()
+    if not lot:
+        raise ApiError(404, 'Parking lot not found')
+    return lot
+
+def list_lots(reads, args, user_id):
+    """Lots by name, optionally filtered by name/location, price and free slots"""
+    fields = _fields(args, LOT_FIELDS)
+    limit = _limit(args)
+    after = _decode_cursor(args, 2)
+
+    query = 'SELECT * FROM parking_lots p WHERE p.deleted_at IS NULL AND p.shard = ?'
+    params = [SHARD]
+    if args.get('q'):
+        query += ' AND (p.name LIKE ? OR p.location LIKE ?)'
+        params.extend([f'%{args["q"]}%', f'%{args["q"]}%'])
+    if args.get('max_price', type=float) is not None:
+        query += ' AND p.price_per_hour <= ?'
+        params.append(args.get('max_price', type=float))
+    if args.get('available') in ('1', 'true'):
+        query += ' AND p.available_count > 0'
+    if after:
+        query += ' AND (p.name, p.id) > (?, ?)'
+        params.extend(after)
+    query += ' ORDER BY p.name, p.id LIMIT ?'
+    params.append(limit + 1)
+
+    rows = reads.all(query, params, key=lambda row: (row['name'], row['id']))
+    return _page(rows, limit, lambda row: [row['name'], row['id']], _lot_json, fields)
+
+def list_nearest_lots(reads, args, user_id):
+    """Closest lots with free slots to ?lat=&lon=, optionally within
+    ?max_price= and ?max_km=; closest first, one page of up to ?limit="""
+    fields = _fields(args, NEAREST_FIELDS)
+    try:
+        latitude, longitude = parse_coordinates(args.get('lat'), args.get('lon'))
+    except ValueError:
+        latitude = None
+    if latitude is None:
+        raise ApiError(400, 'lat and lon are required, within ±90 and ±180')
+    max_km = args.get('max_km', type=float)
+    if max_km is not None and not 0 < max_km <= current_app.config['NEAREST_MAX_KM']:
+        raise ApiError(400, f"max_km must be above 0 and at most {current_app.config['NEAREST_MAX_KM']}")
+
+    found = nearest_lots(latitude, longitude, _limit(args), args.get('max_price', type=float), max_km)
+    return {'items': [_select(dict(_lot_json(lot), distance_km=round(distance, 3)), fields)
+                      for distance, lot in found]}
+
+def get_lot(reads, args, user_id, lot_id):
+    return _select(_lot_json(_get_lot(reads.lot(lot_id), lot_id)), _fields(args, LOT_FIELDS))
+
+def lot_availability(reads, args, user_id, lot_id):
+    """Slots free for a window: ?start= (ISO 8601, default now), ?hours=, ?zone="""
+    fields = _fields(args, SLOT_FIELDS)
+    hours = args.get('hours', 1, type=int)
+    if not 1 <= hours <= 24:
+        raise ApiError(400, 'hours must be an integer from 1 to 24')
+    try:
+        start_time, end_time = get_booking_window(args.get('start'), hours)
+    except ValueError:
+        raise ApiError(400, 'start must be an ISO 8601 date-time')
+
+    conn = reads.lot(lot_id)
+    _get_lot(conn, lot_id)
+    slots = free_slots(conn, lot_id, start_time, end_time, args.get('zone', type=int))
+    return {'lot_id': lot_id, 'start_time': _timestamp(start_time), 'end_time': _timestamp(end_time),
+            'free': len(slots), 'items': [_select(dict(slot), fields) for slot in slots]}
+
+def lot_quote(reads, args, user_id, lot_id):
+    """Cost preview at current demand: ?start= (ISO 8601, default now), ?hours="""
+    hours = args.get('hours', 1, type=int)
+    if not 1 <= hours <= 24:
+        raise ApiError(400, 'hours must be an integer from 1 to 24')
+    try:
+        start_time, end_time = get_booking_window(args.get('start'), hours)
+    except ValueError:
+        raise ApiError(400, 'start must be an ISO 8601 date-time')
+
+    conn = reads.lot(lot_id)
+    lot = _get_lot(conn, lot_id)
+    price = quote(conn, lot, start_time, hours)
+    return {'lot_id': lot_id, 'start_time': _timestamp(start_time), 'end_time': _timestamp(end_time),
+            'hours': hours, 'base_price_per_hour': lot['price_per_hour'], **price}
+
+def list_bookings(reads, args, user_id):
+    """The user's bookings, newest first, optionally with one ?status="""
+    fields = _fields(args, BOOKING_FIELDS)
+    limit = _limit(args)
+    after = _decode_cursor(args, 2)
+
+    query = BOOKING_QUERY + ' WHERE b.user_id = ?'
+    params = [user_id]
+    if args.get('status'):
+        if args['status'] not in BOOKING_STATUSES:
+            raise ApiError(400, f'status must be one of {", ".join(BOOKING_STATUSES)}')
+        query += ' AND b.status = ?'
+        params.append(args['status'])
+    if after:
+        query += ' AND (b.created_at, b.id) < (?, ?)'
+        params.extend(after)
+    query += ' ORDER BY b.created_at DESC, b.id DESC LIMIT ?'
+    params.append(limit + 1)
+
+    rows = reads.all(query, params, key=lambda row: (row['created_at'], row['id']), reverse=True)
+    return _page(rows, limit, lambda row: [row['created_at'], row['id']], _booking_json, fields)
+
+def _find_booking(conn, booking_id, user_id):
+    booking = conn.execute(BOOKING_QUERY + ' WHERE b.id = ? AND b.user_id = ?', (booking_id, user_id)).fetchone()
+    if not booking:
+        raise ApiError(404, 'Booking not found')
+    return booking
+
+def get_booking(reads, args, user_id, booking_id):
+    conn = reads.row(booking_id)
+    if conn is None:
+        raise ApiError(404, 'Booking not found')
+    return _select(_booking_json(_find_booking(conn, booking_id, user_id)),
+                   _fields(args, BOOKING_FIELDS))
+
+# Endpoint -> handler for the reads that /batch can answer
+READ_HANDLERS = {
+    'api.lots': list_lots,
+    'api.nearest': list_nearest_lots,
+    'api.lot': get_lot,
+    'api.availability': lot_availability,
+    'api.price_quote': lot_quote,
+    'api.bookings': list_bookings,
+    'api.booking': get_booking,
+}
+
+def _answer(reads, handler, args, view_args):
+    """(body, status) of one read"""
+    try:
+        return handler(reads, args, session['user_id'], **view_args), 200
+    except ApiError as e:
+        return {'error': e.message}, e.status
+
+def _read(endpoint, **view_args):
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+
+    reads = _Reads()
+    try:
+        body, status = _answer(reads, READ_HANDLERS[endpoint], request.args, view_args)
+    finally:
+        reads.close()
+    return jsonify(body), status
+
+@api_bp.route('/lots')
+def lots():
+    return _read('api.lots')
+
+@api_bp.route('/lots/nearest')
+def nearest():
+    return _read('api.nearest')
+
+@api_bp.route('/lots/<int:lot_id>')
+def lot(lot_id):
+    return _read('api.lot', lot_id=lot_id)
+
+@api_bp.route('/lots/<int:lot_id>/availability')
+def availability(lot_id):
+    return _read('api.availability', lot_id=lot_id)
+
+@api_bp.route('/lots/<int:lot_id>/quote')
+def price_quote(lot_id):
+    return _read('api.price_quote', lot_id=lot_id)
+
+@api_bp.route('/bookings')
+def bookings():
+    return _read('api.bookings')
+
+@api_bp.route('/bookings/<int:booking_id>')
+def booking(booking_id):
+    return _read('api.booking', booking_id=booking_id)
+
+@api_bp.route('/batch', methods=['POST'])
+def batch():
+    """Answer several reads in one round trip.
+
+    Body: {"requests": [{"path": "/api/v1/lots?limit=5", "params": {...}?}, ...]}
+    Returns {"responses": [{"status": 200, "body": {...}}, ...]} in request order.
+    """
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+
+    data = request.get_json(silent=True) or {}
+    requests = data.get('requests')
+    if not isinstance(requests, list) or not requests:
+        return jsonify({'error': 'requests must be a non-empty list'}), 400
+    if len(requests) > current_app.config['API_BATCH_MAX_REQUESTS']:
+        return jsonify({'error': f"at most {current_app.config['API_BATCH_MAX_REQUESTS']} requests per batch"}), 400
+
+    adapter = current_app.url_map.bind('')
+    reads = _Reads()
+    responses = []
+    try:
+        for item in requests:
+            if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+                responses.append({'status': 400, 'body': {'error': 'each request needs a path'}})
+                continue
+            params = item.get('params') or {}
+            if not isinstance(params, dict):
+                responses.append({'status': 400, 'body': {'error': 'params must be an object'}})
+                continue
+            url = urlsplit(item['path'])
+            args = MultiDict(parse_qsl(url.query))
+            args.update({key: str(value) for key, value in params.items()})
+            try:
+                endpoint, view_args = adapter.match(url.path, method='GET')
+            except HTTPException as e:
+                responses.append({'status': e.code, 'body': {'error': e.name}})
+                continue
+            if endpoint not in READ_HANDLERS:
+                responses.append({'status': 400, 'body': {'error': 'only API reads can be batched'}})
+                continue
+            body, status = _answer(reads, READ_HANDLERS[endpoint], args, view_args)
+            responses.append({'status': status, 'body': body})
+    finally:
+        reads.close()
+
+    return jsonify({'responses': responses})
+
+@api_bp.route('/lots/<int:lot_id>/bookings', methods=['POST'])
+def create(lot_id):
+    """Book a slot. Body: {"vehicle_number", "vehicle_type", "hours",
+    "start_time"?, "slot_id"?}; without slot_id the lowest-numbered free
+    slot is taken. Send an Idempotency-Key header to make retries safe."""
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+
+    data = request.get_json(silent=True) or {}
+    try:
+        vehicle_number, vehicle_type, start_time, end_time, hours = validate_vehicle(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    slot_id = data.get('slot_id')
+    if slot_id is not None and (not isinstance(slot_id, int) or isinstance(slot_id, bool)):
+        return jsonify({'error': 'slot_id must be an integer'}), 400
+
+    conn = get_lot_db(lot_id)
+    key = request_key(f'user:{session["user_id"]}')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.close()
+        return respond(replay)
+
+    admission = admit_booking(session['user_id'], lot_id)
+    if admission:
+        conn.close()
+        return admission
+
+    try:
+        lot = _get_lot(conn, lot_id)
+    except ApiError as e:
+        conn.close()
+        return jsonify({'error': e.message}), e.status
+
+    # Hold the write lock from the availability check to the insert
+    conn.execute('BEGIN IMMEDIATE')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.rollback()
+        conn.close()
+        return respond(replay)
+    if slot_id is None:
+        slots = free_slots(conn, lot_id, start_time, end_time)
+        slot_id = slots[0]['id'] if slots else None
+    booked = slot_id is not None and create_booking(conn, lot, slot_id, session['user_id'], vehicle_number,
+                                                    vehicle_type, start_time, end_time, hours)
+    if not booked:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'no slot free for the requested time'}), 409
+
+    response = {'status': 201, 'body': _booking_json(_find_booking(conn, booked[0], session['user_id']))}
+    store_response(conn, key, response)
+    audit('booking.create', 'booking', booked[0], {'lot_id': lot_id, 'slot_id': slot_id, 'via': 'api'}, conn=conn)
+    conn.commit()
+    conn.close()
+    return respond(response)
+
+@api_bp.route('/bookings/<int:booking_id>', methods=['DELETE'])
+def cancel(booking_id):
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+
+    conn = get_row_db(booking_id)
+    if conn is None:
+        return jsonify({'error': 'Booking not found or already cancelled'}), 404
+    key = request_key(f'user:{session["user_id"]}')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.close()
+        return respond(replay)
+
+    admission = admit_cancellation(session['user_id'])
+    if admission:
+        conn.close()
+        return admission
+
+    conn.execute('BEGIN IMMEDIATE')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.rollback()
+        conn.close()
+        return respond(replay)
+    if not cancel_user_booking(conn, booking_id, session['user_id']):
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': 'Booking not found or already cancelled'}), 404
+
+    response = {'status': 200, 'body': _booking_json(_find_booking(conn, booking_id, session['user_id']))}
+    store_response(conn, key, response)
+    audit('booking.cancel', 'booking', booking_id, {'via': 'api'}, conn=conn)
+    conn.commit()
+    conn.close()
+    return respond(response)
@@ -0,0 +1,29 @@
+from flask import Blueprint, abort, send_from_directory
+from utils.assets import STATIC_DIR, asset_url, file_digest, split_hashed_path
+import os
+
+assets_bp = Blueprint('assets', __name__)
+
+# Hashed URLs change whenever the file does, so browsers may keep them forever
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+# Unhashed files (e.g. webfonts referenced from CSS) are revalidated daily
+SHORT_CACHE = 'public, max-age=86400'
+
+@assets_bp.app_context_processor
+def inject_asset_url():
+    return {'asset_url': asset_url}
+
+@assets_bp.route('/assets/<path:filename>')
+def serve_asset(filename):
+    path, digest = split_hashed_path(filename)
+
+    if not os.path.isfile(os.path.join(STATIC_DIR, path)):
+        abort(404)
+
+    if digest is not None and digest != file_digest(path):
+        # Stale hash from an old page: serve the current file but don't pin it
+        digest = None
+
+    response = send_from_directory(STATIC_DIR, path)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE if digest else SHORT_CACHE
+    return response
@@ -1,6 +1,6 @@
 from flask import Blueprint, request, redirect, session, flash, render_template_string, render_template
-from werkzeug.security import generate_password_hash, check_password_hash
 from database import get_db
+from utils.passwords import hash_password, verify_password, needs_rehash, PasswordHasherBusy
 import re
 
 auth_bp = Blueprint('auth', __name__)
@@ -33,7 +33,13 @@ def register():
             conn.close()
             return redirect('/register')
         
-        hashed_password = generate_password_hash(password)
+        try:
+            hashed_password = hash_password(password)
+        except PasswordHasherBusy:
+            flash('Server is busy, please try again in a moment.', 'error')
+            conn.close()
+            return redirect('/register')
+        
         conn.execute(
             'INSERT INTO users (username, email, password, phone) VALUES (?, ?, ?, ?)',
             (username, email, hashed_password, phone)
@@ -56,7 +62,21 @@ def login():
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         conn.close()
         
-        if user and check_password_hash(user['password'], password):
+        try:
+            valid = user is not None and verify_password(user['password'], password)
+            
+            # Upgrade hashes made under an older hashing policy
+            if valid and needs_rehash(user['password']):
+                conn = get_db()
+                conn.execute('UPDATE users SET password = ? WHERE id = ?',
+                             (hash_password(password), user['id']))
+                conn.commit()
+                conn.close()
+        except PasswordHasherBusy:
+            flash('Server is busy, please try again in a moment.', 'error')
+            return render_template('auth/login.html')
+        
+        if valid:
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['logged_in'] = True
@@ -1,6 +1,14 @@
-from flask import Blueprint, request, redirect, session, flash, render_template_string
-from database import get_db
-from datetime import datetime, timedelta
+from flask import Blueprint, request, redirect, session, flash, render_template_string, jsonify, current_app
+from database import get_lot_db, get_row_db
+from utils.rate_limit import admit_booking, admit_bulk_booking, admit_cancellation
+from utils.availability import unindex_booking, release_slot, free_slots, get_booking_window
+from utils.bulk_booking import book_many
+from utils.booking_utils import create_booking, cancel_user_booking
+from utils.waitlist import offer_freed_slot, release_offer
+from utils.pricing import quote
+from utils.idempotency import new_key, request_key, stored_response, store_response, respond
+from utils.audit import audit
+from datetime import datetime
 
 parking_bp = Blueprint('parking', __name__)
 
@@ -16,7 +24,21 @@ def book_slot(lot_id):
     if auth_check:
         return auth_check
     
-    conn = get_db()
+    conn = get_lot_db(lot_id)
+    
+    if request.method == 'POST':
+        # A double click or retry of a booking that went through is answered
+        # without touching bookings (or the rate limit)
+        key = request_key(f'user:{session["user_id"]}')
+        replay = stored_response(conn, key)
+        if replay:
+            conn.close()
+            return respond(replay)
+        
+        admission = admit_booking(session['user_id'], lot_id)
+        if admission:
+            conn.close()
+            return admission
     
     # Get parking lot details
     lot = conn.execute('SELECT * FROM parking_lots WHERE id = ? AND deleted_at IS NULL', (lot_id,)).fetchone()
@@ -25,52 +47,63 @@ def book_slot(lot_id):
         conn.close()
         return redirect('/dashboard')
     
-    # Get available slots
-    slots = conn.execute('''
-        SELECT * FROM parking_slots 
-        WHERE parking_lot_id = ? AND status = 'available'
-        ORDER BY slot_number
-    ''', (lot_id,)).fetchall()
-    
     if request.method == 'POST':
         vehicle_number = request.form['vehicle_number']
         vehicle_type = request.form['vehicle_type']
         hours = int(request.form['hours'])
         slot_id = int(request.form['slot_id'])
-        
-        # Verify slot is still available
-        slot_check = conn.execute('''
-            SELECT * FROM parking_slots 
-            WHERE id = ? AND status = 'available'
-        ''', (slot_id,)).fetchone()
-        
-        if not slot_check:
-            flash('Selected slot is no longer available!', 'error')
+        try:
+            start_time, end_time = get_booking_window(request.form.get('start_time'), hours)
+        except ValueError:
+            flash('Invalid start time!', 'error')
             conn.close()
             return redirect(f'/book/{lot_id}')
+        starts_now = start_time <= datetime.now()
         
-        # Calculate cost and end time
-        total_cost = lot['price_per_hour'] * hours
-        end_time = datetime.now() + timedelta(hours=hours)
+        # Hold the write lock from the availability check to the insert so
+        # two requests can't both claim the same slot and window
+        conn.execute('BEGIN IMMEDIATE')
         
-        # Create booking
-        cursor = conn.execute('''
-            INSERT INTO bookings (user_id, parking_lot_id, slot_id, vehicle_number,
-                                vehicle_type, end_time, total_cost, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, 'active')
-        ''', (session['user_id'], lot_id, slot_id, vehicle_number, vehicle_type,
-              end_time, total_cost))
+        # A repeat that raced the first attempt to the lock finds its result now
+        replay = stored_response(conn, key)
+        if replay:
+            conn.rollback()
+            conn.close()
+            return respond(replay)
         
-        # Update slot status
-        conn.execute('''
-            UPDATE parking_slots SET status = 'occupied' WHERE id = ?
-        ''', (slot_id,))
+        booked = create_booking(conn, lot, slot_id, session['user_id'], vehicle_number, vehicle_type,
+                                start_time, end_time, hours)
+        if not booked:
+            conn.rollback()
+            flash('Selected slot is no longer available for that time!', 'error')
+            conn.close()
+            return redirect(f'/book/{lot_id}')
+        
+        slot_check = booked[1]
+        if starts_now:
+            message = f'Slot #{slot_check["slot_number"]} booked successfully!'
+        else:
+            message = f'Slot #{slot_check["slot_number"]} reserved from {start_time:%Y-%m-%d %H:%M}!'
+        response = {'flash': [message, 'success'], 'redirect': '/my-bookings'}
+        store_response(conn, key, response)
+        audit('booking.create', 'booking', booked[0], {'lot_id': lot_id, 'slot_id': slot_id}, conn=conn)
         
         conn.commit()
         conn.close()
-        
-        flash(f'Slot #{slot_check["slot_number"]} booked successfully!', 'success')
-        return redirect('/my-bookings')
+        return respond(response)
+    
+    # Get slots free for the requested window (default: the next hour),
+    # limited to one zone when drilling down from the slot map
+    zone_id = request.args.get('zone', type=int)
+    window_start = request.args.get('start', '')
+    window_hours = request.args.get('hours', 1, type=int)
+    try:
+        start_time, end_time = get_booking_window(window_start, window_hours)
+    except ValueError:
+        window_start = ''
+        start_time, end_time = get_booking_window(window_start, window_hours)
+    slots = free_slots(conn, lot_id, start_time, end_time, zone_id)
+    price = quote(conn, lot, start_time, window_hours)
     
     # Generate slots HTML
     slots_html = ''
@@ -95,8 +128,8 @@ def book_slot(lot_id):
     <html>
     <head>
         <title>Book Slot - ParkEasy</title>
-        <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
-        <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
+        <link href="{{ asset_url('bootstrap.css') }}" rel="stylesheet">
+        <link href="{{ asset_url('fontawesome.css') }}" rel="stylesheet">
         <style>
             .slot-card:hover { transform: scale(1.05); }
             .slot-card.selected { background-color: #007bff !important; border: 2px solid #0056b3; }
@@ -131,10 +164,29 @@ def book_slot(lot_id):
                                         <span class="badge bg-success">''' + str(len(slots)) + ''' slots available</span>
                                     </div>
                                     <div>
-                                        <strong class="text-success">${''' + f'{lot["price_per_hour"]:.2f}' + '''}/hour</strong>
+                                        <strong class="text-success">${''' + f'{price["price_per_hour"]:.2f}' + '''}/hour</strong>
+                                        ''' + (f'<br><small class="text-muted">base ${lot["price_per_hour"]:.2f}/hour, '
+                                               f'priced for current demand</small>'
+                                               if price['price_per_hour'] != lot['price_per_hour'] else '') + '''
                                     </div>
                                 </div>
                             </div>
+                            <form method="GET" class="row g-2 align-items-end mb-4">
+                                <input type="hidden" name="zone" value="{{ zone_id or '' }}">
+                                <div class="col-md-5">
+                                    <label class="form-label">Start (leave empty for now)</label>
+                                    <input type="datetime-local" class="form-control" name="start" value="{{ window_start }}">
+                                </div>
+                                <div class="col-md-3">
+                                    <label class="form-label">Hours</label>
+                                    <input type="number" class="form-control" name="hours" min="1" max="24" value="{{ window_hours }}">
+                                </div>
+                                <div class="col-md-4 d-grid">
+                                    <button type="submit" class="btn btn-outline-primary">
+                                        <i class="fas fa-search"></i> Check Availability
+                                    </button>
+                                </div>
+                            </form>
                             ''' + (f'''
                             <div class="mb-4">
                                 <h6><i class="fas fa-th"></i> Available Slots (Click to Select)</h6>
@@ -144,6 +196,8 @@ def book_slot(lot_id):
                             </div>
                             <form method="POST" id="bookingForm">
                                 <input type="hidden" id="slot_id" name="slot_id" required>
+                                <input type="hidden" name="idempotency_key" value="{new_key()}">
+                                <input type="hidden" name="start_time" value="{{{{ window_start }}}}">
                                 
                                 <div class="alert alert-info" id="selectedSlotInfo" style="display: none;">
                                     <strong>Selected Slot:</strong> <span id="selectedSlotNumber"></span>
@@ -168,11 +222,11 @@ def book_slot(lot_id):
                                 <div class="mb-3">
                                     <label class="form-label">Duration (Hours)</label>
                                     <input type="number" class="form-control" id="hours" name="hours"
-                                           min="1" max="24" value="1" required>
+                                           min="1" max="24" value="{window_hours}" required>
                                 </div>
                                 <div class="mb-4">
                                     <div class="alert alert-info">
-                                        <strong>Total Cost:</strong> $<span id="total-cost">{lot['price_per_hour']:.2f}</span>
+                                        <strong>Total Cost:</strong> $<span id="total-cost">{price['total_cost']:.2f}</span>
                                     </div>
                                 </div>
                                 <div class="d-flex justify-content-between">
@@ -188,19 +242,47 @@ def book_slot(lot_id):
                             <div class="text-center py-4">
                                 <i class="fas fa-parking fa-3x text-muted mb-3"></i>
                                 <h5>No Available Slots</h5>
-                                <p class="text-muted">All parking slots are currently occupied.</p>
+                                <p class="text-muted">All parking slots are taken for the selected time.</p>
                                 <a href="/dashboard" class="btn btn-primary">
                                     <i class="fas fa-arrow-left"></i> Back to Dashboard
                                 </a>
                             </div>
-                            ''') + '''
+                            ''') + (f'''
+                            <div class="card border-info mt-3">
+                                <div class="card-body">
+                                    <h6><i class="fas fa-user-clock"></i> Join the Waitlist</h6>
+                                    <p class="text-muted small">We will hold the next free slot for you for
+                                        {current_app.config['WAITLIST_HOLD_MINUTES']} minutes and show it under My Bookings.</p>
+                                    <form method="POST" action="/waitlist/join/{lot['id']}" class="row g-2">
+                                        <div class="col-md-4">
+                                            <input type="text" class="form-control" name="vehicle_number"
+                                                   placeholder="Vehicle number" required>
+                                        </div>
+                                        <div class="col-md-3">
+                                            <select class="form-control" name="vehicle_type" required>
+                                                <option value="car">Car</option>
+                                                <option value="motorcycle">Motorcycle</option>
+                                                <option value="truck">Truck</option>
+                                                <option value="van">Van</option>
+                                            </select>
+                                        </div>
+                                        <div class="col-md-2">
+                                            <input type="number" class="form-control" name="hours" min="1" max="24" value="1" required>
+                                        </div>
+                                        <div class="col-md-3 d-grid">
+                                            <button type="submit" class="btn btn-info">Join Waitlist</button>
+                                        </div>
+                                    </form>
+                                </div>
+                            </div>
+                            ''' if lot['available_count'] == 0 else '') + '''
                         </div>
                     </div>
                 </div>
             </div>
         </div>
         <script>
-        const pricePerHour = ''' + str(lot['price_per_hour']) + ''';
+        const quoteUrl = '/api/v1/lots/''' + str(lot['id']) + '''/quote';
         document.addEventListener('DOMContentLoaded', function() {
             // Handle slot selection
             document.addEventListener('click', function(e) {
@@ -229,22 +311,89 @@ def book_slot(lot_id):
                 }
             });
             
-            // Update cost calculation
+            // Update cost calculation (prices depend on demand and time of day)
             const hoursInput = document.getElementById('hours');
             if (hoursInput) {
                 hoursInput.addEventListener('input', function() {
-                    const hours = parseFloat(this.value) || 1;
-                    const totalCost = (hours * pricePerHour).toFixed(2);
-                    document.getElementById('total-cost').textContent = totalCost;
+                    const hours = parseInt(this.value) || 1;
+                    const start = document.querySelector('input[name="start_time"]').value;
+                    fetch(quoteUrl + '?' + new URLSearchParams({hours: hours, start: start}))
+                        .then(response => response.ok ? response.json() : null)
+                        .then(data => {
+                            if (data && String(data.hours) === hoursInput.value) {
+                                document.getElementById('total-cost').textContent = data.total_cost.toFixed(2);
+                            }
+                        });
                 });
             }
         });
         </script>
         
-        <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
+        <script src="{{ asset_url('bootstrap.js') }}"></script>
     </body>
     </html>
-    ''')
+    ''', zone_id=zone_id, window_start=window_start, window_hours=window_hours)
+
+@parking_bp.route('/api/book/<int:lot_id>/bulk', methods=['POST'])
+def bulk_book(lot_id):
+    """Book a slot for each vehicle in a fleet request, in one transaction.
+
+    Body: {"vehicles": [{"vehicle_number", "vehicle_type", "hours", "start_time"?}, ...],
+           "best_effort": false}
+    """
+    if 'logged_in' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    vehicles = data.get('vehicles')
+    if not isinstance(vehicles, list) or not vehicles:
+        return jsonify({'error': 'vehicles must be a non-empty list'}), 400
+    if len(vehicles) > current_app.config['BULK_BOOKING_MAX_VEHICLES']:
+        return jsonify({'error': f"at most {current_app.config['BULK_BOOKING_MAX_VEHICLES']} vehicles per request"}), 400
+    best_effort = data.get('best_effort', False)
+    if not isinstance(best_effort, bool):
+        return jsonify({'error': 'best_effort must be true or false'}), 400
+    
+    conn = get_lot_db(lot_id)
+    key = request_key(f'user:{session["user_id"]}')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.close()
+        return respond(replay)
+    
+    admission = admit_bulk_booking(session['user_id'], lot_id, len(vehicles))
+    if admission:
+        conn.close()
+        return admission
+    
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ? AND deleted_at IS NULL', (lot_id,)).fetchone()
+    if not lot:
+        conn.close()
+        return jsonify({'error': 'Parking lot not found'}), 404
+    
+    conn.execute('BEGIN IMMEDIATE')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.rollback()
+        conn.close()
+        return respond(replay)
+    
+    results, booked = book_many(conn, lot, session['user_id'], vehicles, best_effort)
+    booked_count = sum(1 for result in results if result['status'] in ('active', 'reserved'))
+    status_code = 200 if booked_count == len(results) else 207 if booked_count else 409
+    response = {'status': status_code, 'body': {'lot_id': lot_id, 'best_effort': best_effort,
+                                                 'booked': booked_count, 'failed': len(results) - booked_count,
+                                                 'results': results}}
+    if booked:
+        store_response(conn, key, response)
+        audit('booking.bulk_create', 'lot', lot_id,
+              {'booking_ids': [result['booking_id'] for result in results if 'booking_id' in result]}, conn=conn)
+        conn.commit()
+    else:
+        conn.rollback()
+    conn.close()
+    
+    return respond(response)
 
 @parking_bp.route('/cancel-booking/<int:booking_id>')
 def cancel_booking(booking_id):
@@ -252,59 +401,97 @@ def cancel_booking(booking_id):
     if auth_check:
         return auth_check
     
-    conn = get_db()
+    conn = get_row_db(booking_id)
+    if conn is None:
+        flash('Booking not found or already cancelled!', 'error')
+        return redirect('/my-bookings')
+    key = request_key(f'user:{session["user_id"]}')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.close()
+        return respond(replay)
     
-    # Get booking details
-    booking = conn.execute('''
-        SELECT * FROM bookings 
-        WHERE id = ? AND user_id = ? AND status = 'active'
-    ''', (booking_id, session['user_id'])).fetchone()
+    admission = admit_cancellation(session['user_id'])
+    if admission:
+        conn.close()
+        return admission
     
-    if booking:
-        # Cancel booking
-        conn.execute('''
-            UPDATE bookings SET status = 'cancelled' WHERE id = ?
-        ''', (booking_id,))
-        
-        # Free up the slot
-        conn.execute('''
-            UPDATE parking_slots SET status = 'available' WHERE id = ?
-        ''', (booking['slot_id'],))
-        
+    # Lock before reading so a concurrent release can't free the slot and
+    # let it be rebooked between this check and the update
+    conn.execute('BEGIN IMMEDIATE')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.rollback()
+        conn.close()
+        return respond(replay)
+    
+    if cancel_user_booking(conn, booking_id, session['user_id']):
+        response = {'flash': ['Booking cancelled successfully!', 'success'], 'redirect': '/my-bookings'}
+        store_response(conn, key, response)
+        audit('booking.cancel', 'booking', booking_id, conn=conn)
         conn.commit()
-        flash('Booking cancelled successfully!', 'success')
     else:
-        flash('Booking not found or already cancelled!', 'error')
+        conn.rollback()
+        response = {'flash': ['Booking not found or already cancelled!', 'error'], 'redirect': '/my-bookings'}
     
     conn.close()
-    return redirect('/my-bookings')
+    return respond(response)
 
 @parking_bp.route('/admin/force-release-slot/<int:slot_id>', methods=['POST'])
 def force_release_slot(slot_id):
     if 'admin_logged_in' not in session:
         return redirect('/admin/login')
     
-    conn = get_db()
+    conn = get_row_db(slot_id)
+    if conn is None:
+        flash('Slot not found!', 'error')
+        return redirect(request.referrer or '/admin/dashboard')
+    key = request_key(f'admin:{session.get("admin_username", "")}')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.close()
+        return respond(replay)
+    
+    conn.execute('BEGIN IMMEDIATE')
+    replay = stored_response(conn, key)
+    if replay:
+        conn.rollback()
+        conn.close()
+        return respond(replay)
+    
+    response = {'flash': ['Slot released successfully!', 'success'],
+                'redirect': request.referrer or '/admin/dashboard'}
     
-    # Get active booking for this slot
+    # Get active booking (or waitlist hold) for this slot
     booking = conn.execute('''
         SELECT * FROM bookings 
-        WHERE slot_id = ? AND status = 'active'
+        WHERE slot_id = ? AND status IN ('active', 'held')
     ''', (slot_id,)).fetchone()
     
+    if booking and booking['status'] == 'held':
+        # Withdraw the waitlist offer; the slot goes to the next waiter
+        entry = conn.execute('SELECT * FROM waitlist_entries WHERE booking_id = ?', (booking['id'],)).fetchone()
+        release_offer(conn, entry, 'cancelled')
+        store_response(conn, key, response)
+        audit('slot.force_release', 'slot', slot_id, {'booking_id': booking['id'], 'status': 'held'}, conn=conn)
+        conn.commit()
+        conn.close()
+        return respond(response)
+    
     if booking:
         # Cancel the booking
         conn.execute('''
             UPDATE bookings SET status = 'cancelled' WHERE id = ?
         ''', (booking['id'],))
+        unindex_booking(conn, booking['id'])
     
-    # Free the slot
-    conn.execute('''
-        UPDATE parking_slots SET status = 'available' WHERE id = ?
-    ''', (slot_id,))
+    # Free the slot, unless another booking holds it, and offer it to the
+    # lot's waitlist
+    if release_slot(conn, slot_id) and booking:
+        offer_freed_slot(conn, booking['parking_lot_id'], slot_id)
     
+    store_response(conn, key, response)
+    audit('slot.force_release', 'slot', slot_id, {'booking_id': booking['id'] if booking else None}, conn=conn)
     conn.commit()
     conn.close()
-    
-    flash('Slot released successfully!', 'success')
-    return redirect(request.referrer or '/admin/dashboard')
+    return respond(response)
@@ -0,0 +1,122 @@
+from flask import Blueprint, request, redirect, session, flash, render_template, jsonify, send_file
+from database import get_db
+from utils.report_jobs import enqueue_job
+from datetime import date, datetime, timedelta
+import os
+
+report_bp = Blueprint('report', __name__)
+
+EXPORT_KINDS = {'bookings': 'bookings_csv', 'lots': 'lots_csv'}
+
+def require_admin():
+    if 'admin_logged_in' not in session:
+        flash('Admin access required!', 'error')
+        return redirect('/admin/login')
+    return None
+
+def job_status(job):
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'rows_written': job['rows_written'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'expires_at': job['expires_at'],
+        'download_url': f'/admin/reports/{job["id"]}/download' if job['status'] == 'done' else None,
+    }
+
+@report_bp.route('/admin/export-csv')
+def export_csv():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+
+    kind = EXPORT_KINDS.get(request.args.get('type', 'bookings'))
+    if not kind:
+        flash('Unknown export type!', 'error')
+        return redirect('/admin/dashboard')
+
+    conn = get_db()
+    job_id, created = enqueue_job(conn, kind, {}, session.get('admin_username'))
+    conn.close()
+
+    flash('Export queued, it will be ready to download here shortly.' if created
+          else 'The same export is already in progress.', 'success')
+    return redirect(f'/admin/reports#job-{job_id}')
+
+@report_bp.route('/admin/reports/revenue', methods=['POST'])
+def revenue_report():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+
+    try:
+        date_from = date.fromisoformat(request.form['date_from'])
+        date_to = date.fromisoformat(request.form['date_to'])
+    except (KeyError, ValueError):
+        flash('Invalid report dates!', 'error')
+        return redirect('/admin/reports')
+    if date_from > date_to:
+        flash('The report start date must not be after its end date!', 'error')
+        return redirect('/admin/reports')
+
+    conn = get_db()
+    job_id, created = enqueue_job(conn, 'revenue_report',
+                                  {'date_from': date_from.isoformat(), 'date_to': date_to.isoformat()},
+                                  session.get('admin_username'))
+    conn.close()
+
+    flash('Revenue report queued.' if created else 'The same report is already in progress.', 'success')
+    return redirect(f'/admin/reports#job-{job_id}')
+
+@report_bp.route('/admin/reports')
+def reports():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+
+    conn = get_db()
+    jobs = conn.execute('SELECT * FROM report_jobs ORDER BY id DESC LIMIT 50').fetchall()
+    conn.close()
+
+    today = datetime.now().date()
+    return render_template('admin/reports.html', jobs=jobs,
+                           default_from=(today - timedelta(days=90)).replace(day=1).isoformat(),
+                           default_to=today.isoformat())
+
+@report_bp.route('/admin/api/reports')
+def reports_api():
+    auth_check = require_admin()
+    if auth_check:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    ids = [int(job_id) for job_id in request.args.get('ids', '').split(',') if job_id.isdigit()]
+    if not ids:
+        return jsonify({'jobs': []})
+
+    conn = get_db()
+    jobs = conn.execute(f'SELECT * FROM report_jobs WHERE id IN ({", ".join("?" * len(ids))})',
+                        ids).fetchall()
+    conn.close()
+
+    return jsonify({'jobs': [job_status(job) for job in jobs]})
+
+@report_bp.route('/admin/reports/<int:job_id>/download')
+def download(job_id):
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+
+    conn = get_db()
+    job = conn.execute('SELECT * FROM report_jobs WHERE id = ?', (job_id,)).fetchone()
+    conn.close()
+
+    if not job or job['status'] != 'done' or not os.path.exists(job['result_path']):
+        flash('This report is not available for download!', 'error')
+        return redirect('/admin/reports')
+
+    return send_file(os.path.abspath(job['result_path']), mimetype='text/csv',
+                     as_attachment=True, download_name=job['filename'])
@@ -1,6 +1,10 @@
-from flask import Blueprint, request, redirect, session, flash, render_template_string, render_template
-from database import get_db
-from utils.booking_utils import auto_cancel_expired_bookings
+from flask import Blueprint, request, redirect, session, flash, render_template_string, render_template, current_app
+from database import get_lot_db, fan_out, fan_out_query, merge_sorted, SHARD
+from utils.booking_utils import auto_cancel_expired_bookings, activate_due_reservations
+from utils.lot_layout import resolve_level
+from utils.waitlist import queue_position
+from utils.idempotency import new_key
+from utils.geo import parse_coordinates, nearest_lots
 from datetime import datetime
 
 user_bp = Blueprint('user', __name__)
@@ -17,25 +21,39 @@ def dashboard():
     if auth_check:
         return auth_check
     
-    # Auto-cancel expired bookings
+    # Auto-cancel expired bookings, then start reservations that are due
     auto_cancel_expired_bookings()
-    
-    conn = get_db()
+    activate_due_reservations()
     
     # Get search parameters
     search_location = request.args.get('search_location', '')
     max_price = request.args.get('max_price', '')
+    try:
+        near = parse_coordinates(request.args.get('lat'), request.args.get('lon'))
+    except ValueError:
+        flash('Invalid location!', 'error')
+        near = (None, None)
     
-    # Build query with filters
+    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    # Closest lots with free space, from the spatial index
+    if near[0] is not None:
+        found = nearest_lots(near[0], near[1], current_app.config['NEAREST_LOTS_LIMIT'],
+                             float(max_price) if max_price else None)
+        lots = [dict(lot, total_slots=lot['slot_count'], available_slots=lot['available_count'],
+                     distance_km=distance) for distance, lot in found]
+        return render_template('user/dashboard.html', lots=lots, current_time=current_time,
+                               search_location='', max_price=max_price, near=near)
+    
+    # Build query with filters; slot counts come from the per-lot counters.
+    # Full lots are listed too so users can join their waitlist.
     query = '''
-        SELECT p.*,
-               COUNT(ps.id) as total_slots,
-               SUM(CASE WHEN ps.status = 'available' THEN 1 ELSE 0 END) as available_slots
+        SELECT p.id, p.name, p.location, p.price_per_hour,
+               p.slot_count as total_slots, p.available_count as available_slots
         FROM parking_lots p
-        LEFT JOIN parking_slots ps ON p.id = ps.parking_lot_id
-        WHERE p.deleted_at IS NULL
+        WHERE p.deleted_at IS NULL AND p.shard = ?
     '''
-    params = []
+    params = [SHARD]
     
     if search_location:
         query += ' AND (p.name LIKE ? OR p.location LIKE ?)'
@@ -45,19 +63,12 @@ def dashboard():
         query += ' AND p.price_per_hour <= ?'
         params.append(float(max_price))
     
-    query += '''
-        GROUP BY p.id
-        HAVING available_slots > 0
-        ORDER BY p.name
-    '''
+    query += ' ORDER BY p.name'
     
-    lots = conn.execute(query, params).fetchall()
-    conn.close()
-    
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    lots = fan_out_query(query, params, key=lambda lot: lot['name'])
     
     return render_template('user/dashboard.html', lots=lots, current_time=current_time,
-                         search_location=search_location, max_price=max_price)
+                         search_location=search_location, max_price=max_price, near=None)
 
 @user_bp.route('/my-bookings')
 def my_bookings():
@@ -70,8 +81,6 @@ def my_bookings():
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
     
-    conn = get_db()
-    
     # Build query with filters
     query = '''
         SELECT b.*, p.name as lot_name, p.location, ps.slot_number
@@ -94,13 +103,28 @@ def my_bookings():
         query += ' AND DATE(b.created_at) <= ?'
         params.append(date_to)
     
-    query += ' ORDER BY b.created_at DESC'
+    query += ' ORDER BY b.created_at DESC, b.id DESC'
     
-    bookings = conn.execute(query, params).fetchall()
-    conn.close()
+    bookings = fan_out_query(query, params, key=lambda b: (b['created_at'], b['id']), reverse=True)
     
-    return render_template('user/my_bookings.html', bookings=bookings,
-                         status_filter=status_filter, date_from=date_from, date_to=date_to)
+    # Open waitlist entries with their place in the queue
+    user_id = session['user_id']
+    def shard_waitlist(conn, shard):
+        entries = conn.execute('''
+            SELECT w.*, p.name as lot_name
+            FROM waitlist_entries w
+            JOIN parking_lots p ON w.parking_lot_id = p.id
+            WHERE w.user_id = ? AND w.status IN ('waiting', 'offered')
+            ORDER BY w.created_at, w.id
+        ''', (user_id,)).fetchall()
+        return [(entry, queue_position(conn, entry) if entry['status'] == 'waiting' else None)
+                for entry in entries]
+    
+    waitlist = merge_sorted(fan_out(shard_waitlist), key=lambda item: (item[0]['created_at'], item[0]['id']))
+    
+    return render_template('user/my_bookings.html', bookings=bookings, waitlist=waitlist,
+                         status_filter=status_filter, date_from=date_from, date_to=date_to,
+                         idempotency_key=new_key())
 
 @user_bp.route('/slot-map/<int:lot_id>')
 def user_slot_map(lot_id):
@@ -108,22 +132,28 @@ def user_slot_map(lot_id):
     if auth_check:
         return auth_check
     
-    conn = get_db()
+    conn = get_lot_db(lot_id)
     
     lot = conn.execute('SELECT * FROM parking_lots WHERE id = ? AND deleted_at IS NULL', (lot_id,)).fetchone()
     if not lot:
         flash('Parking lot not found!', 'error')
+        conn.close()
         return redirect('/dashboard')
     
-    slots = conn.execute('''
-        SELECT ps.*, 
-               CASE WHEN b.id IS NOT NULL THEN b.end_time ELSE NULL END as occupied_until
-        FROM parking_slots ps
-        LEFT JOIN bookings b ON ps.id = b.slot_id AND b.status = 'active'
-        WHERE ps.parking_lot_id = ?
-        ORDER BY ps.slot_number
-    ''', (lot_id,)).fetchall()
+    view = resolve_level(conn, lot_id, request.args.get('floor', type=int),
+                         request.args.get('zone', type=int))
+    
+    slots = []
+    if view['level'] == 'slots':
+        slots = conn.execute('''
+            SELECT ps.*, 
+                   CASE WHEN b.id IS NOT NULL THEN b.end_time ELSE NULL END as occupied_until
+            FROM parking_slots ps
+            LEFT JOIN bookings b ON ps.id = b.slot_id AND b.status = 'active'
+            WHERE ps.zone_id = ?
+            ORDER BY ps.slot_number
+        ''', (view['zone']['id'],)).fetchall()
     
     conn.close()
     
-    return render_template('user/slot_map.html', lot=lot, slots=slots)
+    return render_template('user/slot_map.html', lot=lot, slots=slots, view=view)
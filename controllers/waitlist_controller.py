@@ -0,0 +1,133 @@
+from flask import Blueprint, request, redirect, session, flash
+from database import get_lot_db, get_row_db
+from datetime import datetime
+from utils.waitlist import join_waitlist, leave_waitlist, accept_offer, release_offer
+from utils.bulk_booking import VEHICLE_TYPES
+
+waitlist_bp = Blueprint('waitlist', __name__)
+
+def require_login():
+    if 'logged_in' not in session:
+        flash('Please login first!', 'error')
+        return redirect('/login')
+    return None
+
+def get_user_entry(conn, entry_id, status):
+    return conn.execute('''
+        SELECT * FROM waitlist_entries WHERE id = ? AND user_id = ? AND status = ?
+    ''', (entry_id, session['user_id'], status)).fetchone()
+
+@waitlist_bp.route('/waitlist/join/<int:lot_id>', methods=['POST'])
+def join(lot_id):
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+    
+    try:
+        vehicle_number = request.form['vehicle_number'].strip()
+        vehicle_type = request.form['vehicle_type']
+        hours = int(request.form['hours'])
+    except (KeyError, ValueError):
+        vehicle_number = None
+    if not vehicle_number or vehicle_type not in VEHICLE_TYPES or not 1 <= hours <= 24:
+        flash('Enter a vehicle number, a vehicle type and from 1 to 24 hours to join the waitlist!', 'error')
+        return redirect(f'/book/{lot_id}')
+    
+    conn = get_lot_db(lot_id)
+    
+    # Lock before the checks so a double submit can't add two entries and a
+    # slot freed meanwhile can't be missed
+    conn.execute('BEGIN IMMEDIATE')
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ? AND deleted_at IS NULL', (lot_id,)).fetchone()
+    if not lot:
+        conn.rollback()
+        flash('Parking lot not found!', 'error')
+        conn.close()
+        return redirect('/dashboard')
+    
+    if lot['available_count'] > 0:
+        conn.rollback()
+        flash('Slots are available in this lot, book one directly!', 'success')
+        conn.close()
+        return redirect(f'/book/{lot_id}')
+    
+    entry_id = join_waitlist(conn, lot_id, session['user_id'], vehicle_number, vehicle_type, hours)
+    conn.commit()
+    conn.close()
+    
+    if entry_id:
+        flash(f'You are on the waitlist for {lot["name"]}!', 'success')
+    else:
+        flash('You are already on the waitlist for this lot!', 'error')
+    return redirect('/my-bookings')
+
+@waitlist_bp.route('/waitlist/<int:entry_id>/leave')
+def leave(entry_id):
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+    
+    conn = get_row_db(entry_id)
+    if conn is None:
+        flash('Waitlist entry not found!', 'error')
+        return redirect('/my-bookings')
+    conn.execute('BEGIN IMMEDIATE')
+    entry = get_user_entry(conn, entry_id, 'waiting')
+    if entry:
+        leave_waitlist(conn, entry)
+        conn.commit()
+        flash('You have left the waitlist.', 'success')
+    else:
+        conn.rollback()
+        flash('Waitlist entry not found!', 'error')
+    conn.close()
+    return redirect('/my-bookings')
+
+@waitlist_bp.route('/waitlist/<int:entry_id>/accept')
+def accept(entry_id):
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+    
+    conn = get_row_db(entry_id)
+    if conn is None:
+        flash('This offer is no longer available!', 'error')
+        return redirect('/my-bookings')
+    conn.execute('BEGIN IMMEDIATE')
+    entry = get_user_entry(conn, entry_id, 'offered')
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if entry and entry['offer_expires_at'] < now:
+        release_offer(conn, entry, 'expired')
+        conn.commit()
+        flash('This offer has expired!', 'error')
+    elif entry:
+        accept_offer(conn, entry)
+        conn.commit()
+        flash('Slot booked from the waitlist!', 'success')
+    else:
+        conn.rollback()
+        flash('This offer is no longer available!', 'error')
+    conn.close()
+    return redirect('/my-bookings')
+
+@waitlist_bp.route('/waitlist/<int:entry_id>/decline')
+def decline(entry_id):
+    auth_check = require_login()
+    if auth_check:
+        return auth_check
+    
+    conn = get_row_db(entry_id)
+    if conn is None:
+        flash('This offer is no longer available!', 'error')
+        return redirect('/my-bookings')
+    conn.execute('BEGIN IMMEDIATE')
+    entry = get_user_entry(conn, entry_id, 'offered')
+    if entry:
+        release_offer(conn, entry, 'declined')
+        conn.commit()
+        flash('Offer declined.', 'success')
+    else:
+        conn.rollback()
+        flash('This offer is no longer available!', 'error')
+    conn.close()
+    return redirect('/my-bookings')
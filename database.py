@@ -1,18 +1,130 @@
 import sqlite3
-from werkzeug.security import generate_password_hash
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import heapq
 
 DATABASE = 'parking_system.db'
+BUSY_TIMEOUT = 5.0  # seconds a connection waits for another's write lock
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+# Optional per-lot sharding. DATABASE is the catalog (users, lots, report
+# jobs, aggregates) and also shard 0; SHARDS are extra database files that
+# each hold whole lots: their floors, zones, slots, bookings, waitlists and
+# booking events, plus a copy of the lot row whose counters the slot
+# triggers keep up to date. Bookings never span lots, so each shard has its
+# own write lock and writes to different shards run in parallel. With no
+# extra shards every lot lives in DATABASE and nothing changes.
+#
+# Rows of per-lot tables created on shard k get ids from k * SHARD_ID_SPAN
+# up, so a booking, slot or waitlist entry id alone names its shard.
+SHARDS = []
+SHARD_ID_SPAN = 10 ** 12
+SHARDED_TABLES = ('parking_floors', 'parking_zones', 'parking_slots', 'bookings',
+                  'waitlist_entries', 'booking_events', 'price_tables', 'audit_log')
+
+_lot_shards = {}  # lot id -> shard; a lot never moves
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = get_db()
-    
-    # Create tables
+def get_db():
+    return connect(DATABASE)
+
+def configure(database, shards=(), busy_timeout=5.0):
+    """Point get_db() at the database file from the app config, and the
+    shard router at the extra shard files"""
+    global DATABASE, SHARDS, BUSY_TIMEOUT
+    DATABASE = database
+    SHARDS = list(shards)
+    BUSY_TIMEOUT = busy_timeout
+    _lot_shards.clear()
+
+def shard_paths():
+    return [DATABASE] + SHARDS
+
+def get_shard_db(shard):
+    """Connection to a shard, or None if no such shard is configured"""
+    paths = shard_paths()
+    if not 0 <= shard < len(paths):
+        return None
+    return connect(paths[shard])
+
+def shard_for_id(row_id):
+    """Shard of a booking, slot, zone, floor or waitlist entry id"""
+    return int(row_id) // SHARD_ID_SPAN
+
+def shard_for_lot(lot_id):
+    """Shard of a lot, from the catalog; unknown lots map to shard 0"""
+    if not SHARDS:
+        return 0
+    if lot_id not in _lot_shards:
+        conn = get_db()
+        row = conn.execute('SELECT shard FROM parking_lots WHERE id = ?', (lot_id,)).fetchone()
+        conn.close()
+        if row is None:
+            return 0
+        _lot_shards[lot_id] = row['shard']
+    return _lot_shards[lot_id]
+
+def get_lot_db(lot_id):
+    """Connection to the shard holding a lot's slots and bookings"""
+    return get_shard_db(shard_for_lot(lot_id))
+
+def get_row_db(row_id):
+    """Connection to the shard holding a booking, slot or waitlist entry, or
+    None if the id cannot belong to any configured shard"""
+    return get_shard_db(shard_for_id(row_id))
+
+def _run_on_shard(fn, shard):
+    conn = get_shard_db(shard)
+    try:
+        return fn(conn, shard)
+    finally:
+        conn.close()
+
+def fan_out(fn):
+    """Run ``fn(conn, shard)`` against every shard, in parallel threads when
+    there is more than one; returns the results in shard order. Each thread
+    runs in a copy of the caller's context, so fn still sees the Flask app."""
+    shards = range(len(shard_paths()))
+    if len(shards) == 1:
+        return [_run_on_shard(fn, 0)]
+    contexts = [contextvars.copy_context() for _ in shards]
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        return list(pool.map(lambda shard: contexts[shard].run(_run_on_shard, fn, shard), shards))
+
+def merge_sorted(results, key, reverse=False):
+    """Merge per-shard result lists that are each already sorted by key"""
+    return list(heapq.merge(*results, key=key, reverse=reverse))
+
+SHARD = object()  # stands for the shard number in fan_out_query params
+
+def fan_out_query(query, params=(), key=None, reverse=False):
+    """Run a read query on every shard and combine the rows, merging them by
+    key when each shard returns them sorted by it.
+
+    Lot rows must be filtered with ``p.shard = ?`` bound to SHARD: the
+    catalog is shard 0 and also lists lots whose counters live elsewhere.
+    """
+    def run(conn, shard):
+        return conn.execute(query, [shard if param is SHARD else param for param in params]).fetchall()
+
+    results = fan_out(run)
+    if key is None:
+        return [row for rows in results for row in rows]
+    return merge_sorted(results, key, reverse)
+
+def assign_shard(conn):
+    """Shard for a new lot: the extra shard holding the fewest lots, or 0"""
+    if not SHARDS:
+        return 0
+    counts = dict(conn.execute('''
+        SELECT shard, COUNT(*) FROM parking_lots WHERE shard > 0 GROUP BY shard
+    ''').fetchall())
+    return min(range(1, len(SHARDS) + 1), key=lambda shard: (counts.get(shard, 0), shard))
+
+def _migrate_v1(conn):
     conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -65,35 +177,576 @@ def init_db():
             FOREIGN KEY (slot_id) REFERENCES parking_slots (id)
         )
     ''')
+
+def _add_column(conn, table, column_def):
+    """ALTER TABLE ADD COLUMN, skipped if the column already exists"""
+    column = column_def.split()[0]
+    existing = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in existing:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column_def}')
+
+COUNTER_COLUMNS = (
+    'slot_count INTEGER NOT NULL DEFAULT 0',
+    'available_count INTEGER NOT NULL DEFAULT 0',
+    'occupied_count INTEGER NOT NULL DEFAULT 0',
+)
+
+def _slot_counter_updates(row, op):
+    """Trigger body adding (op '+') or removing (op '-') one slot row from
+    the counters of its lot, floor and zone"""
+    delta = (f"slot_count = slot_count {op} 1, "
+             f"available_count = available_count {op} ({row}.status = 'available'), "
+             f"occupied_count = occupied_count {op} ({row}.status = 'occupied')")
+    return f'''
+            UPDATE parking_lots SET {delta} WHERE id = {row}.parking_lot_id;
+            UPDATE parking_zones SET {delta} WHERE id = {row}.zone_id;
+            UPDATE parking_floors SET {delta}
+            WHERE id = (SELECT floor_id FROM parking_zones WHERE id = {row}.zone_id);
+    '''
+
+def _migrate_v2(conn):
+    """Floors and zones under each lot, with slot counters at every level"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS parking_floors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            parking_lot_id INTEGER NOT NULL,
+            level_number INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            slot_count INTEGER NOT NULL DEFAULT 0,
+            available_count INTEGER NOT NULL DEFAULT 0,
+            occupied_count INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (parking_lot_id) REFERENCES parking_lots (id)
+        )
+    ''')
     
-    # Insert sample data if tables are empty
-    cursor = conn.execute('SELECT COUNT(*) FROM parking_lots WHERE deleted_at IS NULL')
-    if cursor.fetchone()[0] == 0:
-        # Sample parking lots
-        lots = [
-            ('Downtown Plaza', 'Main Street, City Center', 25, 5.00),
-            ('Shopping Mall', 'Mall Avenue, Shopping District', 30, 3.50),
-            ('Airport Terminal', 'Airport Road, Terminal Building', 50, 8.00)
-        ]
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS parking_zones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            floor_id INTEGER NOT NULL,
+            parking_lot_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            slot_count INTEGER NOT NULL DEFAULT 0,
+            available_count INTEGER NOT NULL DEFAULT 0,
+            occupied_count INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (floor_id) REFERENCES parking_floors (id),
+            FOREIGN KEY (parking_lot_id) REFERENCES parking_lots (id)
+        )
+    ''')
+    
+    _add_column(conn, 'parking_slots', 'zone_id INTEGER NULL REFERENCES parking_zones (id)')
+    for column_def in COUNTER_COLUMNS:
+        _add_column(conn, 'parking_lots', column_def)
+    
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_floors_lot ON parking_floors (parking_lot_id, level_number)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_zones_floor ON parking_zones (floor_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_slots_zone ON parking_slots (zone_id, slot_number)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_slots_lot_status ON parking_slots (parking_lot_id, status)')
+    
+    # Existing lots become a single floor with a single zone
+    lots = conn.execute('''
+        SELECT id FROM parking_lots
+        WHERE id NOT IN (SELECT parking_lot_id FROM parking_floors)
+    ''').fetchall()
+    for lot in lots:
+        zone_ids = create_lot_levels(conn, lot[0], floors=1, zones_per_floor=1)
+        conn.execute('UPDATE parking_slots SET zone_id = ? WHERE parking_lot_id = ? AND zone_id IS NULL',
+                     (zone_ids[0], lot[0]))
+    
+    refresh_slot_counters(conn)
+    
+    # Counters follow every slot insert, delete and status change, whichever
+    # code path makes it
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS slot_counters_insert AFTER INSERT ON parking_slots
+        BEGIN {_slot_counter_updates('NEW', '+')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS slot_counters_delete AFTER DELETE ON parking_slots
+        BEGIN {_slot_counter_updates('OLD', '-')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS slot_counters_update AFTER UPDATE OF status, zone_id ON parking_slots
+        WHEN OLD.status IS NOT NEW.status OR OLD.zone_id IS NOT NEW.zone_id
+        BEGIN {_slot_counter_updates('OLD', '-')} {_slot_counter_updates('NEW', '+')} END
+    ''')
+
+def _migrate_v3(conn):
+    """Interval index over active and reserved bookings (see utils/availability.py)"""
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS booking_intervals USING rtree_i32(
+            id, start_ts, end_ts, lot_lo, lot_hi, +slot_id
+        )
+    ''')
+    
+    # Seconds since 2020-01-01, matching utils.availability.to_index_time
+    conn.execute('''
+        INSERT OR REPLACE INTO booking_intervals (id, start_ts, end_ts, lot_lo, lot_hi, slot_id)
+        SELECT id,
+               CAST(strftime('%s', start_time) AS INTEGER) - CAST(strftime('%s', '2020-01-01') AS INTEGER),
+               CAST(strftime('%s', end_time) AS INTEGER) - CAST(strftime('%s', '2020-01-01') AS INTEGER),
+               parking_lot_id, parking_lot_id, slot_id
+        FROM bookings WHERE status IN ('active', 'reserved')
+    ''')
+    
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bookings_status_start ON bookings (status, start_time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bookings_status_end ON bookings (status, end_time)')
+
+def _migrate_v4(conn):
+    """Per-lot waitlists (see utils/waitlist.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS waitlist_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            parking_lot_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            vehicle_number TEXT NOT NULL,
+            vehicle_type TEXT NOT NULL,
+            hours INTEGER NOT NULL,
+            tier INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'waiting',
+            booking_id INTEGER NULL,
+            offer_expires_at TIMESTAMP NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (parking_lot_id) REFERENCES parking_lots (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (booking_id) REFERENCES bookings (id)
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS waitlist_rank (
+            parking_lot_id INTEGER NOT NULL,
+            node INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (parking_lot_id, node)
+        ) WITHOUT ROWID
+    ''')
+    
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_waitlist_queue ON waitlist_entries (parking_lot_id, status, tier DESC, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_waitlist_user ON waitlist_entries (user_id, status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_waitlist_offers ON waitlist_entries (status, offer_expires_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bookings_user ON bookings (user_id, status)')
+
+def _migrate_v5(conn):
+    """Append-only booking event log and the aggregates built from it (see utils/booking_events.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS booking_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL,
+            parking_lot_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            old_status TEXT NULL,
+            new_status TEXT NOT NULL,
+            old_cost REAL NOT NULL DEFAULT 0,
+            new_cost REAL NOT NULL,
+            booked_on DATE NOT NULL,
+            occurred_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS event_consumers (
+            name TEXT PRIMARY KEY,
+            last_event_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS booking_status_counts (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS booking_daily_revenue (
+            day DATE PRIMARY KEY,
+            revenue REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Existing bookings enter the log as a single 'booked' event in their
+    # current state, so replaying the log reproduces today's totals
+    conn.execute('''
+        INSERT INTO booking_events (booking_id, parking_lot_id, user_id, event,
+                                    new_status, new_cost, booked_on, occurred_at)
+        SELECT id, parking_lot_id, user_id, 'booked', status, total_cost,
+               DATE(created_at), created_at
+        FROM bookings
+        WHERE id NOT IN (SELECT booking_id FROM booking_events)
+        ORDER BY id
+    ''')
+    
+    # Every insert and status or cost change of a booking is logged in the
+    # writer's own transaction, whichever code path makes it
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS booking_events_insert AFTER INSERT ON bookings
+        BEGIN
+            INSERT INTO booking_events (booking_id, parking_lot_id, user_id, event,
+                                        new_status, new_cost, booked_on)
+            VALUES (NEW.id, NEW.parking_lot_id, NEW.user_id, 'booked',
+                    NEW.status, NEW.total_cost, DATE(NEW.created_at));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS booking_events_update AFTER UPDATE OF status, total_cost ON bookings
+        WHEN OLD.status IS NOT NEW.status OR OLD.total_cost IS NOT NEW.total_cost
+        BEGIN
+            INSERT INTO booking_events (booking_id, parking_lot_id, user_id, event, old_status,
+                                        new_status, old_cost, new_cost, booked_on)
+            VALUES (NEW.id, NEW.parking_lot_id, NEW.user_id,
+                    CASE WHEN OLD.status IS NOT NEW.status THEN NEW.status ELSE 'repriced' END,
+                    OLD.status, NEW.status, OLD.total_cost, NEW.total_cost, DATE(NEW.created_at));
+        END
+    ''')
+    
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_booking_events_booking ON booking_events (booking_id, id)')
+
+def _migrate_v6(conn):
+    """Per-(lot, day) cache of hourly occupancy (see utils/occupancy.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS occupancy_days (
+            parking_lot_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            slot_count INTEGER NOT NULL,
+            computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (parking_lot_id, day)
+        ) WITHOUT ROWID
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS occupancy_hourly (
+            parking_lot_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            hour INTEGER NOT NULL,
+            slot_minutes INTEGER NOT NULL,
+            peak_occupied INTEGER NOT NULL,
+            PRIMARY KEY (parking_lot_id, day, hour)
+        ) WITHOUT ROWID
+    ''')
+    
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bookings_lot_start ON bookings (parking_lot_id, start_time)')
+
+def _migrate_v7(conn):
+    """Background report jobs (see utils/report_jobs.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS report_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            dedup_key TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            rows_written INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT NULL,
+            result_path TEXT NULL,
+            filename TEXT NULL,
+            error TEXT NULL,
+            requested_by TEXT NULL,
+            created_at TIMESTAMP NOT NULL,
+            started_at TIMESTAMP NULL,
+            heartbeat_at TIMESTAMP NULL,
+            finished_at TIMESTAMP NULL,
+            expires_at TIMESTAMP NULL
+        )
+    ''')
+    
+    # At most one queued or running job per distinct request
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_report_jobs_pending ON report_jobs (dedup_key)
+        WHERE status IN ('queued', 'running')
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_report_jobs_status ON report_jobs (status, id)')
+
+def _migrate_v8(conn):
+    """Shard column for lots (see the sharding notes at the top)"""
+    _add_column(conn, 'parking_lots', 'shard INTEGER NOT NULL DEFAULT 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_lots_shard ON parking_lots (shard, name)')
+
+def _migrate_v9(conn):
+    """Keyset pagination of a user's booking history (the JSON API)"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bookings_user_created ON bookings (user_id, created_at, id)')
+
+def _migrate_v10(conn):
+    """Precomputed demand price tables (see utils/pricing.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_tables (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            parking_lot_id INTEGER NOT NULL,
+            base_price REAL NOT NULL,
+            signature TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (parking_lot_id) REFERENCES parking_lots (id)
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_table_hours (
+            price_table_id INTEGER NOT NULL,
+            band INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            cumulative REAL NOT NULL,
+            PRIMARY KEY (price_table_id, band, hour)
+        ) WITHOUT ROWID
+    ''')
+    
+    _add_column(conn, 'parking_lots', 'price_table_id INTEGER NULL')
+    _add_column(conn, 'bookings', 'price_version INTEGER NULL')
+    _add_column(conn, 'bookings', 'price_band INTEGER NULL')
+
+def _migrate_v11(conn):
+    """Idempotency keys for booking requests (see utils/idempotency.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key BLOB PRIMARY KEY,
+            response TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expiry ON idempotency_keys (expires_at)')
+
+def _migrate_v12(conn):
+    """Audit trail (see utils/audit.py); every file has one for durable
+    entries written inside a shard's transactions"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP NOT NULL,
+            actor TEXT NOT NULL,
+            action TEXT NOT NULL,
+            target_type TEXT NOT NULL,
+            target_id INTEGER NULL,
+            details TEXT NULL
+        )
+    ''')
+    
+    # Newest-first keyset paging, overall and per action or actor
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_audit_log_created ON audit_log (created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_audit_log_action ON audit_log (action, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_audit_log_actor ON audit_log (actor, created_at, id)')
+
+def _migrate_v13(conn):
+    """Lot coordinates and their R*Tree index (see utils/geo.py)"""
+    _add_column(conn, 'parking_lots', 'latitude REAL NULL')
+    _add_column(conn, 'parking_lots', 'longitude REAL NULL')
+    
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS lot_locations USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS lot_locations_insert AFTER INSERT ON parking_lots
+        WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+        BEGIN
+            INSERT INTO lot_locations VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS lot_locations_update AFTER UPDATE OF latitude, longitude ON parking_lots
+        BEGIN
+            DELETE FROM lot_locations WHERE id = OLD.id;
+            INSERT INTO lot_locations
+            SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+        END
+    ''')
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# have run, so an up-to-date database costs a single pragma read at startup.
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+    _migrate_v8,
+    _migrate_v9,
+    _migrate_v10,
+    _migrate_v11,
+    _migrate_v12,
+    _migrate_v13,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def _init_file(path, shard):
+    conn = connect(path)
+    
+    if schema_version(conn) == SCHEMA_VERSION:
+        conn.close()
+        return 0
+    
+    # New files free space incrementally (flask db-maintain vacuum); this
+    # only takes effect before the first table is created
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
+    # Take the write lock before re-reading the version so that workers
+    # booting at the same time don't run the same migration twice
+    conn.isolation_level = None
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current = schema_version(conn)
+        for version in range(current + 1, SCHEMA_VERSION + 1):
+            MIGRATIONS[version - 1](conn)
+        # Start this shard's id ranges (shard 0 keeps plain ids)
+        for table in SHARDED_TABLES if shard else ():
+            conn.execute('''
+                INSERT INTO sqlite_sequence (name, seq)
+                SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+            ''', (table, shard * SHARD_ID_SPAN, table))
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    
+    return SCHEMA_VERSION - current
+
+def init_db():
+    """Bring the schema of the catalog and every shard up to date; returns
+    the number of migrations applied"""
+    return sum(_init_file(path, shard) for shard, path in enumerate(shard_paths()))
+
+def refresh_slot_counters(conn):
+    """Recompute every lot/floor/zone counter from the slot rows"""
+    for table, key in (('parking_lots', 'parking_lot_id'), ('parking_zones', 'zone_id')):
+        conn.execute(f'''
+            UPDATE {table} SET
+                slot_count = (SELECT COUNT(*) FROM parking_slots ps WHERE ps.{key} = {table}.id),
+                available_count = (SELECT COUNT(*) FROM parking_slots ps
+                                   WHERE ps.{key} = {table}.id AND ps.status = 'available'),
+                occupied_count = (SELECT COUNT(*) FROM parking_slots ps
+                                  WHERE ps.{key} = {table}.id AND ps.status = 'occupied')
+        ''')
+    conn.execute('''
+        UPDATE parking_floors SET
+            slot_count = (SELECT COALESCE(SUM(slot_count), 0) FROM parking_zones z WHERE z.floor_id = parking_floors.id),
+            available_count = (SELECT COALESCE(SUM(available_count), 0) FROM parking_zones z WHERE z.floor_id = parking_floors.id),
+            occupied_count = (SELECT COALESCE(SUM(occupied_count), 0) FROM parking_zones z WHERE z.floor_id = parking_floors.id)
+    ''')
+
+def create_lot_levels(conn, lot_id, floors=1, zones_per_floor=1):
+    """Create the floors and zones of a lot; returns zone ids, floor by floor"""
+    zone_ids = []
+    for level in range(floors):
+        floor_name = 'Ground Floor' if level == 0 else f'Level {level}'
+        cursor = conn.execute('''
+            INSERT INTO parking_floors (parking_lot_id, level_number, name)
+            VALUES (?, ?, ?)
+        ''', (lot_id, level, floor_name))
+        floor_id = cursor.lastrowid
         
-        for name, location, slots, price in lots:
+        for zone in range(zones_per_floor):
             cursor = conn.execute('''
-                INSERT INTO parking_lots (name, location, total_slots, price_per_hour)
-                VALUES (?, ?, ?, ?)
-            ''', (name, location, slots, price))
-            
-            lot_id = cursor.lastrowid
-            
-            # Create slots for each lot
-            for slot_num in range(1, slots + 1):
-                conn.execute('''
-                    INSERT INTO parking_slots (parking_lot_id, slot_number, status)
-                    VALUES (?, ?, 'available')
-                ''', (lot_id, slot_num))
+                INSERT INTO parking_zones (floor_id, parking_lot_id, name)
+                VALUES (?, ?, ?)
+            ''', (floor_id, lot_id, f'Zone {chr(ord("A") + zone)}'))
+            zone_ids.append(cursor.lastrowid)
+    return zone_ids
+
+def create_lot_slots(conn, lot_id, total_slots, floors=1, zones_per_floor=1):
+    """Create the floors, zones and slots of a new lot.
+
+    Slots are numbered 1..total_slots across the lot and split as evenly as
+    possible over the zones, lowest floor first.
+    """
+    zone_ids = create_lot_levels(conn, lot_id, floors, zones_per_floor)
+    per_zone, extra = divmod(total_slots, len(zone_ids))
+    
+    rows = []
+    slot_num = 1
+    for index, zone_id in enumerate(zone_ids):
+        for _ in range(per_zone + (1 if index < extra else 0)):
+            rows.append((lot_id, zone_id, slot_num))
+            slot_num += 1
+    
+    conn.executemany('''
+        INSERT INTO parking_slots (parking_lot_id, zone_id, slot_number, status)
+        VALUES (?, ?, ?, 'available')
+    ''', rows)
+
+# Catalog columns copied to a lot's row on its shard
+LOT_METADATA = ('name', 'location', 'total_slots', 'price_per_hour', 'created_at', 'deleted_at', 'shard',
+                'latitude', 'longitude')
+
+def create_lot(conn, name, location, total_slots, price_per_hour, floors=1, zones_per_floor=1,
+               latitude=None, longitude=None):
+    """Add a lot to the catalog and create its floors, zones and slots on
+    its shard. The caller commits conn; returns the new lot id."""
+    shard = assign_shard(conn)
+    cursor = conn.execute('''
+        INSERT INTO parking_lots (name, location, total_slots, price_per_hour, shard, latitude, longitude)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (name, location, total_slots, price_per_hour, shard, latitude, longitude))
+    lot_id = cursor.lastrowid
+
+    if shard == 0:
+        create_lot_slots(conn, lot_id, total_slots, floors, zones_per_floor)
+        return lot_id
+
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ?', (lot_id,)).fetchone()
+    shard_conn = get_shard_db(shard)
+    try:
+        shard_conn.execute(f'''
+            INSERT INTO parking_lots (id, {', '.join(LOT_METADATA)})
+            VALUES (?, {', '.join('?' * len(LOT_METADATA))})
+        ''', [lot_id] + [lot[column] for column in LOT_METADATA])
+        create_lot_slots(shard_conn, lot_id, total_slots, floors, zones_per_floor)
+        shard_conn.commit()
+    finally:
+        shard_conn.close()
+    return lot_id
+
+def sync_lot(conn, lot_id):
+    """Copy a lot's catalog row to its shard. Call it after the catalog
+    change has committed: the catalog is the source of truth, and
+    `flask db-maintain sync-lots` repairs a copy left behind if this fails."""
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ?', (lot_id,)).fetchone()
+    if lot is None or lot['shard'] == 0:
+        return
+
+    shard_conn = get_shard_db(lot['shard'])
+    try:
+        shard_conn.execute(f'''
+            UPDATE parking_lots SET {', '.join(f'{column} = ?' for column in LOT_METADATA)}
+            WHERE id = ?
+        ''', [lot[column] for column in LOT_METADATA] + [lot_id])
+        shard_conn.commit()
+    finally:
+        shard_conn.close()
+
+def seed_db():
+    """Insert the sample parking lots if there are none; returns the number of lots added"""
+    conn = get_db()
+    
+    cursor = conn.execute('SELECT COUNT(*) FROM parking_lots WHERE deleted_at IS NULL')
+    if cursor.fetchone()[0] > 0:
+        conn.close()
+        return 0
+    
+    # Sample parking lots
+    lots = [
+        ('Downtown Plaza', 'Main Street, City Center', 25, 5.00, 1, 1),
+        ('Shopping Mall', 'Mall Avenue, Shopping District', 30, 3.50, 1, 2),
+        ('Airport Terminal', 'Airport Road, Terminal Building', 50, 8.00, 2, 2)
+    ]
+    
+    # Create each lot with its floors, zones and slots
+    for name, location, slots, price, floors, zones in lots:
+        create_lot(conn, name, location, slots, price, floors, zones)
     
     conn.commit()
     conn.close()
-    print("Database initialized successfully!")
+    return len(lots)
 
 def execute_query(query, params=None):
     conn = get_db()
@@ -0,0 +1,23 @@
+import os
+import time
+
+# Import the app once in the master; workers inherit it through fork()
+# instead of each re-importing Flask, the controllers and the templates.
+wsgi_app = 'app:app'
+preload_app = True
+
+# Set the worker count with WEB_CONCURRENCY rather than --workers: the app
+# reads it too, to split the cores between the workers' password hashing
+# (PASSWORD_HASH_WORKERS per worker).
+workers = int(os.environ.get('WEB_CONCURRENCY') or 1)
+
+def pre_fork(server, worker):
+    worker.fork_started = time.perf_counter()
+
+def post_worker_init(worker):
+    elapsed = (time.perf_counter() - worker.fork_started) * 1000
+    worker.log.info('Worker %s ready %.1f ms after fork', worker.pid, elapsed)
+
+def when_ready(server):
+    app = server.app.wsgi()
+    server.log.info('App created in %.1f ms', app.config['BOOT_TIME_MS'])
@@ -0,0 +1,87 @@
+import hashlib
+import os
+import re
+import urllib.request
+
+import click
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+
+# Front-end libraries served from /assets. Each entry maps the name used in
+# templates to its path under static/ and the CDN it is fetched from.
+VENDOR_ASSETS = {
+    'bootstrap.css': ('vendor/bootstrap/css/bootstrap.min.css',
+                      'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css'),
+    'bootstrap.js': ('vendor/bootstrap/js/bootstrap.bundle.min.js',
+                     'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js'),
+    'fontawesome.css': ('vendor/fontawesome/css/all.min.css',
+                        'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css'),
+    'chart.js': ('vendor/chartjs/chart.umd.min.js',
+                 'https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js'),
+}
+
+# Font Awesome's stylesheet loads these through relative ../webfonts/ URLs
+FONTAWESOME_WEBFONTS = [
+    'fa-brands-400', 'fa-regular-400', 'fa-solid-900', 'fa-v4compatibility'
+]
+FONTAWESOME_WEBFONT_URL = 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/webfonts/'
+
+HASHED_NAME = re.compile(r'^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<ext>\.[A-Za-z0-9]+)$')
+
+_digests = {}
+
+def file_digest(path):
+    """Content hash of a file under static/, cached per (path, mtime)"""
+    full_path = os.path.join(STATIC_DIR, path)
+    mtime = os.path.getmtime(full_path)
+    cached = _digests.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    sha = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            sha.update(block)
+    digest = sha.hexdigest()[:12]
+    _digests[path] = (mtime, digest)
+    return digest
+
+def hashed_path(path):
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{file_digest(path)}{ext}'
+
+def split_hashed_path(filename):
+    """Return (original path, digest) for a hashed filename, or (filename, None)"""
+    directory, name = os.path.split(filename)
+    match = HASHED_NAME.match(name)
+    if not match:
+        return filename, None
+    return os.path.join(directory, match.group('stem') + match.group('ext')), match.group('digest')
+
+def asset_url(name):
+    """URL for a vendor asset: local content-hashed copy, or the CDN if it was never fetched"""
+    path, cdn_url = VENDOR_ASSETS[name]
+    if not os.path.exists(os.path.join(STATIC_DIR, path)):
+        return cdn_url
+    return '/assets/' + hashed_path(path)
+
+def _download(url, path):
+    full_path = os.path.join(STATIC_DIR, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with urllib.request.urlopen(url, timeout=30) as response, open(full_path, 'wb') as f:
+        f.write(response.read())
+    click.echo(f'  {path}')
+
+@click.command('fetch-assets')
+def fetch_assets_command():
+    """Download vendor CSS/JS/fonts into static/ so pages work without the CDN."""
+    click.echo('Fetching front-end assets:')
+    for path, url in VENDOR_ASSETS.values():
+        _download(url, path)
+
+    for font in FONTAWESOME_WEBFONTS:
+        for ext in ('.woff2', '.ttf'):
+            _download(FONTAWESOME_WEBFONT_URL + font + ext,
+                      f'vendor/fontawesome/webfonts/{font}{ext}')
+
+    click.echo('Assets saved to static/vendor.')
@@ -0,0 +1,128 @@
+from flask import current_app, session
+from datetime import datetime
+import database
+import threading
+import sqlite3
+import atexit
+import json
+import os
+
+# Audit trail of booking and admin actions. Events are buffered in memory
+# per worker process and written to the catalog in batches by a background
+# thread, once AUDIT_BATCH_SIZE are waiting or every AUDIT_FLUSH_SECONDS,
+# so an action costs a list append instead of another commit. Actions in
+# AUDIT_DURABLE_ACTIONS are instead written inside the caller's own
+# transaction (on the lot's shard, if that is where the change is), so the
+# entry commits or rolls back with the change it describes. Buffered events
+# are lost if the process is killed before the next flush.
+ACTIONS = ('booking.create', 'booking.bulk_create', 'booking.cancel', 'slot.force_release',
+           'lot.create', 'lot.edit', 'lot.delete', 'lot.restore')
+
+INSERT = '''
+    INSERT INTO audit_log (created_at, actor, action, target_type, target_id, details)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+_buffer = []
+_lock = threading.Lock()  # guards _buffer and writer start-up
+_flush_lock = threading.Lock()  # one batch in flight at a time
+_wake = threading.Event()
+_writer_pid = None
+_settings = {}
+
+def current_actor():
+    if session.get('admin_logged_in'):
+        return f'admin:{session.get("admin_username", "")}'
+    if session.get('logged_in'):
+        return f'user:{session.get("username", "")}'
+    return 'system'
+
+def audit(action, target_type, target_id, details=None, conn=None):
+    """Record an action by the current user or admin. Call it just before
+    committing the change; durable actions need the transaction's conn."""
+    # Milliseconds keep buffered and durable entries in the order they happened
+    row = (datetime.now().isoformat(' ', 'milliseconds'), current_actor(), action, target_type, target_id,
+           json.dumps(details, separators=(',', ':')) if details else None)
+    if conn is not None and action in current_app.config['AUDIT_DURABLE_ACTIONS']:
+        conn.execute(INSERT, row)
+        return
+
+    _start_writer()
+    with _lock:
+        _buffer.append(row)
+        full = len(_buffer) >= _settings['batch_size']
+    if full:
+        _wake.set()
+
+def _start_writer():
+    """Start this process's writer thread on first use (and again after a fork)"""
+    global _writer_pid
+    if _writer_pid == os.getpid():
+        return
+    with _lock:
+        if _writer_pid == os.getpid():
+            return
+        # The parent still owns, and will write, anything buffered before a fork
+        _buffer.clear()
+        config = current_app.config
+        _settings.update(batch_size=config['AUDIT_BATCH_SIZE'], interval=config['AUDIT_FLUSH_SECONDS'],
+                         buffer_max=config['AUDIT_BUFFER_MAX'], logger=current_app.logger)
+        threading.Thread(target=_run_writer, name='audit-writer', daemon=True).start()
+        _writer_pid = os.getpid()
+    atexit.register(flush_audit)
+
+def _run_writer():
+    while True:
+        _wake.wait(_settings['interval'])
+        _wake.clear()
+        flush_audit()
+
+def flush_audit():
+    """Write this worker's buffered events in one transaction; returns how many"""
+    with _flush_lock:
+        with _lock:
+            batch = _buffer[:]
+            _buffer.clear()
+        if not batch:
+            return 0
+
+        conn = database.get_db()
+        try:
+            conn.executemany(INSERT, batch)
+            conn.commit()
+        except sqlite3.Error as e:
+            # Keep the batch for the next attempt, dropping the oldest events
+            # if the catalog stays unavailable for long
+            with _lock:
+                _buffer[:0] = batch
+                dropped = max(0, len(_buffer) - _settings['buffer_max'])
+                del _buffer[:dropped]
+            _settings['logger'].warning('Audit flush of %d event(s) failed (%s); %d dropped',
+                                        len(batch), e, dropped)
+            return 0
+        finally:
+            conn.close()
+        return len(batch)
+
+def query_log(action=None, actor=None, before=None, limit=50):
+    """One page of entries from every shard, newest first. before is the
+    (created_at, id) of the last entry on the previous page. Returns
+    (entries, cursor of the next page or None)."""
+    query = 'SELECT * FROM audit_log WHERE 1=1'
+    params = []
+    if action:
+        query += ' AND action = ?'
+        params.append(action)
+    if actor:
+        query += ' AND actor = ?'
+        params.append(actor)
+    if before:
+        query += ' AND (created_at, id) < (?, ?)'
+        params.extend(before)
+    query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+
+    rows = database.fan_out_query(query, params, key=lambda row: (row['created_at'], row['id']), reverse=True)
+    entries = rows[:limit]
+    cursor = (entries[-1]['created_at'], entries[-1]['id']) if len(rows) > limit else None
+    return entries, cursor
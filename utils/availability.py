@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+# booking_intervals is an R*Tree (rtree_i32) over (time, lot) holding every
+# active or reserved booking, so "which slots of lot X are taken between T1
+# and T2" is a logarithmic index probe instead of a scan of bookings.
+# Times are stored as whole seconds since INDEX_EPOCH to fit in 32 bits.
+INDEX_EPOCH = datetime(2020, 1, 1)
+
+def to_index_time(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int((value - INDEX_EPOCH).total_seconds())
+
+def get_booking_window(start_value, hours):
+    """Start and end of a booking; an empty or past start means now. A start
+    with a UTC offset is converted to local time; raises ValueError if the
+    start is not an ISO datetime."""
+    now = datetime.now()
+    start_time = now
+    if start_value:
+        start_time = datetime.fromisoformat(start_value)
+        if start_time.tzinfo is not None:
+            start_time = start_time.astimezone().replace(tzinfo=None)
+        start_time = max(now, start_time)
+    return start_time, start_time + timedelta(hours=hours)
+
+def index_booking(conn, booking_id, lot_id, slot_id, start_time, end_time):
+    conn.execute('''
+        INSERT INTO booking_intervals (id, start_ts, end_ts, lot_lo, lot_hi, slot_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (booking_id, to_index_time(start_time), to_index_time(end_time), lot_id, lot_id, slot_id))
+
+def unindex_booking(conn, booking_id):
+    conn.execute('DELETE FROM booking_intervals WHERE id = ?', (booking_id,))
+
+def busy_slot_ids(conn, lot_id, start_time, end_time):
+    """Ids of the lot's slots with a booking overlapping [start_time, end_time)"""
+    rows = conn.execute('''
+        SELECT DISTINCT slot_id FROM booking_intervals
+        WHERE lot_lo <= ? AND lot_hi >= ? AND start_ts < ? AND end_ts > ?
+    ''', (lot_id, lot_id, to_index_time(end_time), to_index_time(start_time))).fetchall()
+    return {row[0] for row in rows}
+
+def is_slot_free(conn, lot_id, slot_id, start_time, end_time):
+    return conn.execute('''
+        SELECT 1 FROM booking_intervals
+        WHERE lot_lo <= ? AND lot_hi >= ? AND start_ts < ? AND end_ts > ? AND slot_id = ?
+        LIMIT 1
+    ''', (lot_id, lot_id, to_index_time(end_time), to_index_time(start_time), slot_id)).fetchone() is None
+
+def release_slot(conn, slot_id):
+    """Set a slot's status after the booking holding it ended; returns True
+    if it is now available. A booking can be made on the slot as soon as
+    the old one's end time passes, before the sweep expires it, so the slot
+    stays occupied (or held) while any other booking has it."""
+    holder = conn.execute('''
+        SELECT status FROM bookings WHERE slot_id = ? AND status IN ('active', 'held')
+        ORDER BY status = 'active' DESC LIMIT 1
+    ''', (slot_id,)).fetchone()
+    status = 'available' if holder is None else 'occupied' if holder['status'] == 'active' else 'held'
+    conn.execute('UPDATE parking_slots SET status = ? WHERE id = ? AND status != ?', (status, slot_id, status))
+    return holder is None
+
+def free_slots(conn, lot_id, start_time, end_time, zone_id=None):
+    """Slots of a lot (optionally one zone) free for the whole window"""
+    query = '''
+        SELECT * FROM parking_slots
+        WHERE parking_lot_id = ? AND status != 'maintenance'
+    '''
+    params = [lot_id]
+    if zone_id:
+        query += ' AND zone_id = ?'
+        params.append(zone_id)
+    query += ' ORDER BY slot_number'
+
+    busy = busy_slot_ids(conn, lot_id, start_time, end_time)
+    return [slot for slot in conn.execute(query, params).fetchall() if slot['id'] not in busy]
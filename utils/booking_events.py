@@ -0,0 +1,154 @@
+from collections import defaultdict
+import database
+
+# booking_events is an append-only log written by triggers on bookings (see
+# database._migrate_v5). The dashboard aggregates below are folded from it
+# incrementally: each consumer stores the id of the last event it applied in
+# event_consumers and only ever reads events after that offset. SQLite has a
+# single writer, so event ids become visible in commit order and an offset
+# can never skip over an event that commits later.
+#
+# With sharding each shard has its own log and writer, so the aggregates in
+# the catalog keep one offset per shard.
+AGGREGATES_CONSUMER = 'booking_aggregates'
+REVENUE_STATUSES = ('active', 'reserved', 'completed')
+BATCH_SIZE = 5000
+
+def _revenue(status, cost):
+    return cost if status in REVENUE_STATUSES else 0
+
+def _fold(events):
+    """Net change in status counts and daily revenue for a run of events"""
+    status_deltas = defaultdict(int)
+    revenue_deltas = defaultdict(float)
+    for event in events:
+        if event['old_status'] is not None:
+            status_deltas[event['old_status']] -= 1
+        status_deltas[event['new_status']] += 1
+        revenue_deltas[event['booked_on']] += (_revenue(event['new_status'], event['new_cost'])
+                                               - _revenue(event['old_status'], event['old_cost']))
+    return status_deltas, revenue_deltas
+
+def _consumer_name(shard):
+    return AGGREGATES_CONSUMER if shard == 0 else f'{AGGREGATES_CONSUMER}:{shard}'
+
+def _catch_up(conn):
+    applied = 0
+    for shard in range(len(database.shard_paths())):
+        if shard == 0:
+            applied += _catch_up_shard(conn, conn, shard)
+            continue
+        shard_conn = database.get_shard_db(shard)
+        try:
+            applied += _catch_up_shard(conn, shard_conn, shard)
+        finally:
+            shard_conn.close()
+    return applied
+
+def _catch_up_shard(conn, log_conn, shard):
+    consumer = _consumer_name(shard)
+    offset = conn.execute('SELECT last_event_id FROM event_consumers WHERE name = ?',
+                          (consumer,)).fetchone()
+    offset = offset[0] if offset else 0
+    applied = 0
+
+    while True:
+        events = log_conn.execute('''
+            SELECT id, old_status, new_status, old_cost, new_cost, booked_on
+            FROM booking_events WHERE id > ? ORDER BY id LIMIT ?
+        ''', (offset, BATCH_SIZE)).fetchall()
+        if not events:
+            break
+
+        status_deltas, revenue_deltas = _fold(events)
+        conn.executemany('''
+            INSERT INTO booking_status_counts (status, count) VALUES (?, ?)
+            ON CONFLICT(status) DO UPDATE SET count = count + excluded.count
+        ''', [item for item in status_deltas.items() if item[1]])
+        conn.executemany('''
+            INSERT INTO booking_daily_revenue (day, revenue) VALUES (?, ?)
+            ON CONFLICT(day) DO UPDATE SET revenue = revenue + excluded.revenue
+        ''', [item for item in revenue_deltas.items() if item[1]])
+        offset = events[-1]['id']
+        applied += len(events)
+
+    if applied:
+        conn.execute('''
+            INSERT INTO event_consumers (name, last_event_id) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET last_event_id = excluded.last_event_id
+        ''', (consumer, offset))
+    return applied
+
+def _has_new_events(conn):
+    """Whether any shard's log has moved past its offset, checked without locking"""
+    offsets = dict(conn.execute('''
+        SELECT name, last_event_id FROM event_consumers WHERE name = ? OR name LIKE ?
+    ''', (AGGREGATES_CONSUMER, f'{AGGREGATES_CONSUMER}:%')).fetchall())
+    for shard in range(len(database.shard_paths())):
+        log_conn = conn if shard == 0 else database.get_shard_db(shard)
+        try:
+            last_id = log_conn.execute('SELECT MAX(id) FROM booking_events').fetchone()[0]
+        finally:
+            if log_conn is not conn:
+                log_conn.close()
+        if (last_id or 0) > offsets.get(_consumer_name(shard), 0):
+            return True
+    return False
+
+def apply_new_events(conn):
+    """Fold events logged since the last run into the aggregates.
+
+    Checks for new events without locking first, so dashboard polls don't
+    queue for the write lock when nothing changed. Then takes the write lock
+    so two workers catching up at the same time can't apply the same events
+    twice. Returns the number of events applied.
+    """
+    if not _has_new_events(conn):
+        return 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        applied = _catch_up(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+def rebuild_aggregates(conn):
+    """Throw the aggregates away and replay the whole log in one transaction;
+    returns the number of events applied"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM booking_status_counts')
+        conn.execute('DELETE FROM booking_daily_revenue')
+        conn.execute('DELETE FROM event_consumers WHERE name = ? OR name LIKE ?',
+                     (AGGREGATES_CONSUMER, f'{AGGREGATES_CONSUMER}:%'))
+        applied = _catch_up(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+def get_status_counts(conn):
+    return {row['status']: row['count'] for row in conn.execute('''
+        SELECT status, count FROM booking_status_counts WHERE count != 0 ORDER BY status
+    ''')}
+
+def get_daily_revenue(conn, since):
+    return conn.execute('''
+        SELECT day, ROUND(revenue, 2) as revenue FROM booking_daily_revenue
+        WHERE day >= ? AND ROUND(revenue, 2) != 0 ORDER BY day
+    ''', (since,)).fetchall()
+
+def get_revenue(conn, since=None, until=None):
+    """Total revenue of bookings made between two dates (inclusive)"""
+    query = 'SELECT ROUND(COALESCE(SUM(revenue), 0), 2) FROM booking_daily_revenue WHERE 1=1'
+    params = []
+    if since:
+        query += ' AND day >= ?'
+        params.append(since)
+    if until:
+        query += ' AND day <= ?'
+        params.append(until)
+    return conn.execute(query, params).fetchone()[0]
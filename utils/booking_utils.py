@@ -1,15 +1,80 @@
-from database import get_db
+from database import get_db, fan_out
+from utils.availability import index_booking, unindex_booking, is_slot_free, release_slot
+from utils.waitlist import offer_freed_slot, expire_waitlist_offers
+from utils.booking_events import apply_new_events, get_status_counts, get_revenue
+from utils.pricing import quote
 from datetime import datetime
 
+def create_booking(conn, lot, slot_id, user_id, vehicle_number, vehicle_type, start_time, end_time, hours):
+    """Book a slot inside the caller's write transaction (BEGIN IMMEDIATE).
+
+    Returns ``(booking_id, slot)``, or None if the slot isn't in the lot or
+    isn't free for the whole window. Future bookings stay 'reserved' until
+    they start. The cost comes from the lot's demand price table and the
+    booking records which version it used.
+    """
+    slot = conn.execute('''
+        SELECT * FROM parking_slots 
+        WHERE id = ? AND parking_lot_id = ? AND status != 'maintenance'
+    ''', (slot_id, lot['id'])).fetchone()
+    if not slot or not is_slot_free(conn, lot['id'], slot_id, start_time, end_time):
+        return None
+    
+    starts_now = start_time <= datetime.now()
+    price = quote(conn, lot, start_time, hours, build=True)
+    cursor = conn.execute('''
+        INSERT INTO bookings (user_id, parking_lot_id, slot_id, vehicle_number, vehicle_type,
+                            start_time, end_time, total_cost, price_version, price_band, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, lot['id'], slot_id, vehicle_number, vehicle_type, start_time, end_time,
+          price['total_cost'], price['price_version'], price['band'], 'active' if starts_now else 'reserved'))
+    index_booking(conn, cursor.lastrowid, lot['id'], slot_id, start_time, end_time)
+    
+    if starts_now:
+        conn.execute("UPDATE parking_slots SET status = 'occupied' WHERE id = ?", (slot_id,))
+    
+    return cursor.lastrowid, slot
+
+def cancel_user_booking(conn, booking_id, user_id):
+    """Cancel a user's active or reserved booking inside the caller's write
+    transaction and pass a freed slot to the waitlist. Returns the booking
+    as it was, or None if there was nothing to cancel."""
+    booking = conn.execute('''
+        SELECT * FROM bookings 
+        WHERE id = ? AND user_id = ? AND status IN ('active', 'reserved')
+    ''', (booking_id, user_id)).fetchone()
+    if not booking:
+        return None
+    
+    conn.execute("UPDATE bookings SET status = 'cancelled' WHERE id = ?", (booking_id,))
+    unindex_booking(conn, booking_id)
+    
+    # Free up the slot (a reservation that hasn't started doesn't hold it)
+    if booking['status'] == 'active' and release_slot(conn, booking['slot_id']):
+        offer_freed_slot(conn, booking['parking_lot_id'], booking['slot_id'])
+    
+    return booking
+
 def auto_cancel_expired_bookings():
-    """Automatically cancel expired bookings and free up slots"""
-    conn = get_db()
+    """Automatically cancel expired bookings and free up slots, on every shard"""
+    return sum(fan_out(_cancel_expired_bookings))
+
+def _cancel_expired_bookings(conn, shard):
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    # Get expired but still active bookings
+    # Check without locking first so page loads don't queue for the write lock
+    pending = conn.execute('''
+        SELECT EXISTS (SELECT 1 FROM bookings WHERE end_time < ? AND status IN ('active', 'reserved'))
+            OR EXISTS (SELECT 1 FROM waitlist_entries WHERE status = 'offered' AND offer_expires_at < ?)
+    ''', (now, now)).fetchone()[0]
+    if not pending:
+        return 0
+    conn.execute('BEGIN IMMEDIATE')
+    
+    # Get expired but still active (or never started) bookings
     expired_bookings = conn.execute('''
-        SELECT id, slot_id FROM bookings 
-        WHERE end_time < ? AND status = 'active'
+        SELECT id, parking_lot_id, slot_id, status FROM bookings 
+        WHERE end_time < ? AND status IN ('active', 'reserved')
     ''', (now,)).fetchall()
     
     for booking in expired_bookings:
@@ -18,42 +83,67 @@ def auto_cancel_expired_bookings():
         
         # Cancel booking
         conn.execute("UPDATE bookings SET status = 'expired' WHERE id = ?", (booking_id,))
+        unindex_booking(conn, booking_id)
         
-        # Free the slot
-        conn.execute("UPDATE parking_slots SET status = 'available' WHERE id = ?", (slot_id,))
+        # Free the slot, unless it has been booked again since the end
+        # time passed, and offer it to the lot's waitlist
+        if booking['status'] == 'active' and release_slot(conn, slot_id):
+            offer_freed_slot(conn, booking['parking_lot_id'], slot_id)
+    
+    # Pass on slots whose waitlist offer was not taken up in time
+    expire_waitlist_offers(conn)
     
     conn.commit()
-    conn.close()
     
     return len(expired_bookings)
 
+def activate_due_reservations():
+    """Turn reservations whose start time has arrived into active bookings and occupy their slots"""
+    return sum(fan_out(_activate_due_reservations))
+
+def _activate_due_reservations(conn, shard):
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    pending = conn.execute('''
+        SELECT EXISTS (SELECT 1 FROM bookings WHERE start_time <= ? AND status = 'reserved')
+    ''', (now,)).fetchone()[0]
+    if not pending:
+        return 0
+    conn.execute('BEGIN IMMEDIATE')
+    
+    due_bookings = conn.execute('''
+        SELECT id, slot_id FROM bookings 
+        WHERE start_time <= ? AND status = 'reserved'
+    ''', (now,)).fetchall()
+    
+    for booking in due_bookings:
+        conn.execute("UPDATE bookings SET status = 'active' WHERE id = ?", (booking['id'],))
+        conn.execute("UPDATE parking_slots SET status = 'occupied' WHERE id = ?", (booking['slot_id'],))
+    
+    conn.commit()
+    
+    return len(due_bookings)
+
 def get_booking_statistics():
-    """Get booking statistics for dashboard"""
+    """Get booking statistics for dashboard, from the event-log aggregates"""
     conn = get_db()
+    apply_new_events(conn)
     
     stats = {}
+    status_counts = get_status_counts(conn)
     
     # Total bookings
-    stats['total_bookings'] = conn.execute('SELECT COUNT(*) FROM bookings').fetchone()[0]
+    stats['total_bookings'] = sum(status_counts.values())
     
     # Active bookings
-    stats['active_bookings'] = conn.execute(
-        'SELECT COUNT(*) FROM bookings WHERE status = "active"'
-    ).fetchone()[0]
+    stats['active_bookings'] = status_counts.get('active', 0)
     
     # Today's revenue
     today = datetime.now().strftime('%Y-%m-%d')
-    stats['today_revenue'] = conn.execute('''
-        SELECT COALESCE(SUM(total_cost), 0) FROM bookings 
-        WHERE DATE(created_at) = ? AND status IN ('active', 'completed')
-    ''', (today,)).fetchone()[0]
+    stats['today_revenue'] = get_revenue(conn, since=today, until=today)
     
     # This month's revenue
-    this_month = datetime.now().strftime('%Y-%m')
-    stats['month_revenue'] = conn.execute('''
-        SELECT COALESCE(SUM(total_cost), 0) FROM bookings 
-        WHERE strftime('%Y-%m', created_at) = ? AND status IN ('active', 'completed')
-    ''', (this_month,)).fetchone()[0]
+    stats['month_revenue'] = get_revenue(conn, since=datetime.now().strftime('%Y-%m-01'), until=today)
     
     conn.close()
     return stats
@@ -0,0 +1,133 @@
+from utils.availability import busy_slot_ids, get_booking_window, to_index_time
+from utils.pricing import quote
+from datetime import datetime
+
+VEHICLE_TYPES = ('car', 'motorcycle', 'truck', 'van')
+
+def validate_vehicle(item):
+    """Returns (vehicle_number, vehicle_type, start_time, end_time, hours) or raises ValueError"""
+    if not isinstance(item, dict):
+        raise ValueError('each vehicle must be an object')
+
+    vehicle_number = str(item.get('vehicle_number') or '').strip()
+    if not vehicle_number:
+        raise ValueError('vehicle_number is required')
+
+    vehicle_type = item.get('vehicle_type', 'car')
+    if vehicle_type not in VEHICLE_TYPES:
+        raise ValueError(f'vehicle_type must be one of {", ".join(VEHICLE_TYPES)}')
+
+    hours = item.get('hours')
+    if not isinstance(hours, int) or isinstance(hours, bool) or not 1 <= hours <= 24:
+        raise ValueError('hours must be an integer from 1 to 24')
+
+    try:
+        start_time, end_time = get_booking_window(item.get('start_time'), hours)
+    except (TypeError, ValueError):
+        raise ValueError('start_time must be an ISO 8601 date-time')
+
+    return vehicle_number, vehicle_type, start_time, end_time, hours
+
+def book_many(conn, lot, user_id, vehicles, best_effort=False):
+    """Allocate one slot per vehicle in a lot, inside the caller's write transaction.
+
+    Each vehicle gets the lowest-numbered slot that is free for its window,
+    taking into account both existing bookings (interval index) and the
+    vehicles allocated earlier in the same batch. Bookings, index entries and
+    slot updates are then written with one executemany each.
+
+    Returns ``(results, booked)``: one result dict per vehicle in request
+    order, and whether anything should be committed. In all-or-nothing mode a
+    single failure means nothing is booked.
+    """
+    lot_id = lot['id']
+    slot_rows = conn.execute('''
+        SELECT id, slot_number FROM parking_slots
+        WHERE parking_lot_id = ? AND status != 'maintenance'
+        ORDER BY slot_number
+    ''', (lot_id,)).fetchall()
+
+    busy_by_window = {}
+    claimed = {}  # slot_id -> [(start, end)] allocated in this batch
+    results = []
+    allocations = []
+
+    for index, item in enumerate(vehicles):
+        result = {'index': index, 'vehicle_number': item.get('vehicle_number') if isinstance(item, dict) else None}
+        results.append(result)
+        try:
+            vehicle_number, vehicle_type, start_time, end_time, hours = validate_vehicle(item)
+        except ValueError as e:
+            result.update(status='failed', error=str(e))
+            continue
+
+        # Vehicles in a fleet request usually share a window, so probe the
+        # index once per distinct (start, end) rather than once per vehicle
+        window = (to_index_time(start_time), to_index_time(end_time))
+        if window not in busy_by_window:
+            busy_by_window[window] = busy_slot_ids(conn, lot_id, start_time, end_time)
+        busy = busy_by_window[window]
+
+        slot = None
+        for candidate in slot_rows:
+            if candidate['id'] in busy:
+                continue
+            if any(s < end_time and e > start_time for s, e in claimed.get(candidate['id'], ())):
+                continue
+            slot = candidate
+            break
+
+        if slot is None:
+            result.update(status='failed', error='no slot free for the requested time')
+            continue
+
+        claimed.setdefault(slot['id'], []).append((start_time, end_time))
+        starts_now = start_time <= datetime.now()
+        # Priced at the lot's demand before the batch, like separate bookings made at once
+        price = quote(conn, lot, start_time, hours, build=True)
+        allocations.append((result, slot, vehicle_number, vehicle_type, start_time, end_time,
+                            price, 'active' if starts_now else 'reserved'))
+
+    failed = len(allocations) < len(vehicles)
+    if not allocations or (failed and not best_effort):
+        for result in results:
+            if result.get('status') is None:
+                result.update(status='failed', error='not booked because another vehicle failed')
+        return results, False
+
+    # The caller holds the write lock, so the next AUTOINCREMENT ids are ours
+    # to assign; that lets the index rows be written in the same batch
+    next_id = conn.execute('''
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'bookings'), 0),
+                   COALESCE((SELECT MAX(id) FROM bookings), 0)) + 1
+    ''').fetchone()[0]
+
+    booking_rows, interval_rows, occupied_slots = [], [], []
+    for offset, (result, slot, vehicle_number, vehicle_type, start_time, end_time,
+                 price, status) in enumerate(allocations):
+        booking_id = next_id + offset
+        booking_rows.append((booking_id, user_id, lot_id, slot['id'], vehicle_number, vehicle_type,
+                             start_time, end_time, price['total_cost'], price['price_version'],
+                             price['band'], status))
+        interval_rows.append((booking_id, to_index_time(start_time), to_index_time(end_time),
+                              lot_id, lot_id, slot['id']))
+        if status == 'active':
+            occupied_slots.append((slot['id'],))
+        result.update(status=status, booking_id=booking_id, slot_id=slot['id'],
+                      slot_number=slot['slot_number'],
+                      start_time=start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                      end_time=end_time.strftime('%Y-%m-%d %H:%M:%S'),
+                      total_cost=price['total_cost'])
+
+    conn.executemany('''
+        INSERT INTO bookings (id, user_id, parking_lot_id, slot_id, vehicle_number, vehicle_type,
+                              start_time, end_time, total_cost, price_version, price_band, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', booking_rows)
+    conn.executemany('''
+        INSERT INTO booking_intervals (id, start_ts, end_ts, lot_lo, lot_hi, slot_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', interval_rows)
+    conn.executemany("UPDATE parking_slots SET status = 'occupied' WHERE id = ?", occupied_slots)
+
+    return results, True
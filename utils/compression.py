@@ -0,0 +1,166 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+class _GzipEncoder:
+    def __init__(self, level):
+        # wbits=31 -> gzip container
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        # Sync flush pushes out everything so far without ending the stream
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+class _BrotliEncoder:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+def _accepts(accept_encoding, coding):
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip().lower() != coding:
+            continue
+        params = params.replace(' ', '')
+        return params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+class CompressionMiddleware:
+    """WSGI middleware that gzip/brotli-encodes text responses.
+
+    Responses with a Content-Length below ``min_size`` are passed through
+    untouched. Responses without a Content-Length (streamed generators) are
+    compressed chunk by chunk and flushed after each chunk, so clients still
+    receive data as it is produced.
+    """
+
+    def __init__(self, app, min_size=500, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def _negotiate(self, environ):
+        accept = environ.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is not None and _accepts(accept, 'br'):
+            return 'br'
+        if _accepts(accept, 'gzip'):
+            return 'gzip'
+        return None
+
+    def _should_compress(self, status, headers):
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+
+        header_map = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in header_map:
+            return False
+        if 'no-transform' in header_map.get('cache-control', ''):
+            return False
+
+        content_type = header_map.get('content-type', '').split(';')[0].strip().lower()
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+
+        length = header_map.get('content-length')
+        if length is not None and int(length) < self.min_size:
+            return False
+        return True
+
+    def __call__(self, environ, start_response):
+        encoding = self._negotiate(environ)
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self._passthrough_vary(environ, start_response)
+
+        state = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            state['status'] = status
+            state['headers'] = headers
+            state['exc_info'] = exc_info
+            return state.setdefault('written', []).append
+
+        app_iter = self.app(environ, capture_start_response)
+        return self._encode(app_iter, state, encoding, start_response)
+
+    def _passthrough_vary(self, environ, start_response):
+        def vary_start_response(status, headers, exc_info=None):
+            if self._should_compress(status, headers):
+                headers = _add_vary(headers)
+            return start_response(status, headers, exc_info)
+        return self.app(environ, vary_start_response)
+
+    def _encode(self, app_iter, state, encoding, start_response):
+        try:
+            chunks = iter(app_iter)
+            # start_response may be deferred until the first chunk is produced
+            first = next(chunks, None) if 'status' not in state else None
+            pending = state.pop('written', [])
+            if first is not None:
+                pending.append(first)
+
+            status, headers = state['status'], state['headers']
+            if not self._should_compress(status, headers):
+                start_response(status, headers, state.get('exc_info'))
+                yield from pending
+                yield from chunks
+                return
+
+            headers = [(name, _weak_etag(value) if name.lower() == 'etag' else value)
+                       for name, value in _add_vary(headers)
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', encoding))
+            start_response(status, headers, state.get('exc_info'))
+
+            encoder = _BrotliEncoder(self.level) if encoding == 'br' else _GzipEncoder(self.level)
+            for chunk in pending:
+                data = encoder.compress(chunk)
+                if data:
+                    yield data
+            for chunk in chunks:
+                data = encoder.compress(chunk) + encoder.flush()
+                if data:
+                    yield data
+            yield encoder.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+def _add_vary(headers):
+    headers = list(headers)
+    for index, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if 'accept-encoding' not in value.lower():
+                headers[index] = (name, value + ', Accept-Encoding')
+            return headers
+    headers.append(('Vary', 'Accept-Encoding'))
+    return headers
+
+def _weak_etag(value):
+    # The encoded body differs byte-for-byte, so a strong validator no longer holds
+    return value if value.startswith('W/') else 'W/' + value
@@ -0,0 +1,279 @@
+import database
+from flask import current_app
+from contextlib import contextmanager
+import sqlite3
+import click
+import time
+import os
+
+# Housekeeping for the SQLite files (catalog, shards and the rate-limit
+# store), meant to run from cron while the app is serving. Every step gets a
+# time limit: lock waits give up after it (busy timeout) and statements are
+# interrupted when it runs out (progress handler), so a step never holds the
+# write lock, or a read lock that stalls commits, for longer than that.
+# Writes are split into short transactions with pauses in between so
+# bookings can get the lock.
+VACUUM_PAUSE = 0.05  # seconds between incremental vacuum steps
+
+def _targets():
+    """(label, path, shard) of every database file that exists"""
+    targets = [('catalog' if shard == 0 else f'shard {shard}', path, shard)
+               for shard, path in enumerate(database.shard_paths())]
+    targets.append(('rate limits', current_app.config['RATE_LIMIT_DATABASE'], None))
+    return [target for target in targets if os.path.exists(target[1])]
+
+def _connect(path, seconds):
+    conn = sqlite3.connect(path, timeout=seconds, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+@contextmanager
+def _time_limit(conn, seconds):
+    """Interrupt the statement running on conn once seconds have passed"""
+    deadline = time.monotonic() + seconds
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    try:
+        yield
+    finally:
+        conn.set_progress_handler(None, 0)
+
+def _pragma(conn, name):
+    return conn.execute(f'PRAGMA {name}').fetchone()[0]
+
+def analyze(conn, seconds, analysis_limit):
+    """Refresh the planner statistics; analysis_limit caps the rows sampled
+    per index (0 reads them all). Returns the seconds taken."""
+    started = time.monotonic()
+    conn.execute(f'PRAGMA analysis_limit = {int(analysis_limit)}')
+    with _time_limit(conn, seconds):
+        conn.execute('ANALYZE')
+    return time.monotonic() - started
+
+def incremental_vacuum(conn, seconds, step_pages):
+    """Return free pages to the filesystem a few at a time until none are
+    left or time runs out. Returns the pages freed, or None when the file
+    isn't in incremental auto-vacuum mode."""
+    if _pragma(conn, 'auto_vacuum') != 2:
+        return None
+
+    deadline = time.monotonic() + seconds
+    freed = 0
+    while time.monotonic() < deadline:
+        before = _pragma(conn, 'freelist_count')
+        if not before:
+            break
+        # execute() would only step the pragma once, freeing a single page
+        try:
+            conn.executescript(f'BEGIN IMMEDIATE; PRAGMA incremental_vacuum({int(step_pages)}); COMMIT;')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        freed += before - _pragma(conn, 'freelist_count')
+        time.sleep(VACUUM_PAUSE)
+    return freed
+
+def enable_incremental_vacuum(conn, seconds):
+    """Switch a file to incremental auto-vacuum. This needs a full VACUUM,
+    which holds the write lock and rewrites the whole file."""
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    with _time_limit(conn, seconds):
+        conn.execute('VACUUM')
+
+def checkpoint(conn, mode):
+    """Checkpoint the WAL; returns (busy, wal pages, pages checkpointed), or
+    None when the file isn't in WAL mode"""
+    if _pragma(conn, 'journal_mode') != 'wal':
+        return None
+    return tuple(conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+
+def check(conn, seconds, full=False, shard=0):
+    """Integrity and foreign key problems, as lists of messages. Raises
+    OperationalError if the check runs out of time."""
+    with _time_limit(conn, seconds):
+        integrity = [row[0] for row in conn.execute('PRAGMA integrity_check' if full else 'PRAGMA quick_check')]
+        foreign_keys = conn.execute('PRAGMA foreign_key_check').fetchall()
+    # Users only exist in the catalog, so shard bookings always point outside
+    if shard:
+        foreign_keys = [row for row in foreign_keys if row['parent'] != 'users']
+    return ([] if integrity == ['ok'] else integrity,
+            [f'{row["table"]} row {row["rowid"]} has no {row["parent"]}' for row in foreign_keys])
+
+def size_report(conn, path, seconds, top=10):
+    """File size, free pages and the largest tables and indexes with their
+    unused space"""
+    page_size = _pragma(conn, 'page_size')
+    report = {
+        'file_bytes': os.path.getsize(path),
+        'wal_bytes': os.path.getsize(path + '-wal') if os.path.exists(path + '-wal') else 0,
+        'page_size': page_size,
+        'pages': _pragma(conn, 'page_count'),
+        'free_pages': _pragma(conn, 'freelist_count'),
+        'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}[_pragma(conn, 'auto_vacuum')],
+        'journal_mode': _pragma(conn, 'journal_mode'),
+        'objects': None,
+    }
+    try:
+        with _time_limit(conn, seconds):
+            report['objects'] = conn.execute('''
+                SELECT name, COUNT(*) as pages, SUM(pgsize) as bytes, SUM(unused) as unused
+                FROM dbstat GROUP BY name ORDER BY bytes DESC LIMIT ?
+            ''', (top,)).fetchall()
+    except sqlite3.OperationalError:
+        pass  # no dbstat, or out of time: the totals above still stand
+    return report
+
+def sync_lots(catalog, conn, shard):
+    """Copy catalog lot rows to a shard where its copy differs, e.g. when a
+    sync failed after the catalog change committed. Returns the lots updated."""
+    columns = ', '.join(database.LOT_METADATA)
+    query = f'SELECT id, {columns} FROM parking_lots WHERE shard = ?'
+    copies = {row[0]: tuple(row) for row in conn.execute(query, (shard,))}
+    stale = [tuple(row) for row in catalog.execute(query, (shard,))
+             if row[0] in copies and tuple(row) != copies[row[0]]]
+    if stale:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(f'''
+            UPDATE parking_lots SET {', '.join(f'{column} = ?' for column in database.LOT_METADATA)}
+            WHERE id = ?
+        ''', [row[1:] + row[:1] for row in stale])
+        conn.execute('COMMIT')
+    return len(stale)
+
+def _megabytes(size):
+    return f'{size / 1024 / 1024:.1f} MB'
+
+def _each_target(seconds, step):
+    """Run step(conn, label, path, shard) on every file, reporting instead of
+    raising when one runs out of time or can't get the lock"""
+    for label, path, shard in _targets():
+        conn = _connect(path, seconds)
+        try:
+            step(conn, label, path, shard)
+        except sqlite3.OperationalError as e:
+            click.echo(f'{label}: stopped, {e} (time limit {seconds:g}s)')
+        finally:
+            conn.close()
+
+def _seconds(seconds):
+    return seconds or current_app.config['DB_MAINTENANCE_SECONDS']
+
+@click.group('db-maintain')
+def db_maintain_command():
+    """Database housekeeping that is safe to run while the app is live."""
+
+@db_maintain_command.command('analyze')
+@click.option('--seconds', type=float, help='Time limit per file (default: DB_MAINTENANCE_SECONDS).')
+@click.option('--limit', type=int, default=None, help='Rows sampled per index, 0 for all (default: DB_ANALYSIS_LIMIT).')
+def analyze_command(seconds, limit):
+    """Refresh query planner statistics (sampled ANALYZE)."""
+    seconds = _seconds(seconds)
+    limit = current_app.config['DB_ANALYSIS_LIMIT'] if limit is None else limit
+
+    def step(conn, label, path, shard):
+        click.echo(f'{label}: statistics refreshed in {analyze(conn, seconds, limit):.2f}s')
+    _each_target(seconds, step)
+
+@db_maintain_command.command('vacuum')
+@click.option('--seconds', type=float, help='Time limit per file (default: DB_MAINTENANCE_SECONDS).')
+@click.option('--pages', type=int, default=None, help='Pages freed per step (default: DB_VACUUM_STEP_PAGES).')
+@click.option('--enable-incremental', is_flag=True,
+              help='Switch files to incremental auto-vacuum with one full VACUUM. Blocks writes while it runs.')
+def vacuum_command(seconds, pages, enable_incremental):
+    """Return free pages to the filesystem in short steps."""
+    seconds = _seconds(seconds)
+    pages = pages or current_app.config['DB_VACUUM_STEP_PAGES']
+
+    def step(conn, label, path, shard):
+        if enable_incremental and _pragma(conn, 'auto_vacuum') != 2:
+            enable_incremental_vacuum(conn, seconds)
+            click.echo(f'{label}: switched to incremental auto-vacuum')
+            return
+        freed = incremental_vacuum(conn, seconds, pages)
+        if freed is None:
+            click.echo(f'{label}: not in incremental auto-vacuum mode, run with --enable-incremental '
+                       'during a quiet period')
+        else:
+            left = _pragma(conn, 'freelist_count')
+            click.echo(f'{label}: freed {freed} page(s), {left} free page(s) left')
+    _each_target(seconds, step)
+
+@db_maintain_command.command('checkpoint')
+@click.option('--seconds', type=float, help='Longest wait for readers and writers (default: DB_MAINTENANCE_SECONDS).')
+@click.option('--mode', type=click.Choice(['passive', 'full', 'restart', 'truncate']), default='passive',
+              help='passive never waits; truncate also empties the WAL file.')
+def checkpoint_command(seconds, mode):
+    """Copy WAL contents back into the database files."""
+    def step(conn, label, path, shard):
+        result = checkpoint(conn, mode.upper())
+        if result is None:
+            click.echo(f'{label}: not in WAL mode')
+        else:
+            busy, wal_pages, done = result
+            click.echo(f'{label}: {done} of {wal_pages} WAL page(s) checkpointed'
+                       + (' (busy, try again later)' if busy else ''))
+    _each_target(_seconds(seconds), step)
+
+@db_maintain_command.command('check')
+@click.option('--seconds', type=float, help='Time limit per file (default: DB_MAINTENANCE_SECONDS).')
+@click.option('--full', is_flag=True, help='integrity_check instead of the faster quick_check.')
+def check_command(seconds, full):
+    """Check integrity and foreign keys; exits 1 if problems are found."""
+    problems = []
+
+    def step(conn, label, path, shard):
+        integrity, foreign_keys = check(conn, seconds, full, shard)
+        for message in integrity + foreign_keys:
+            click.echo(f'{label}: {message}')
+        problems.extend(integrity + foreign_keys)
+        if not integrity and not foreign_keys:
+            click.echo(f'{label}: ok')
+    seconds = _seconds(seconds)
+    _each_target(seconds, step)
+    if problems:
+        raise SystemExit(1)
+
+@db_maintain_command.command('report')
+@click.option('--seconds', type=float, help='Time limit for the per-table breakdown (default: DB_MAINTENANCE_SECONDS).')
+@click.option('--top', type=int, default=10, help='Largest tables and indexes to list.')
+def report_command(seconds, top):
+    """Show file sizes, free space and the largest tables and indexes."""
+    def step(conn, label, path, shard):
+        report = size_report(conn, path, _seconds(seconds), top)
+        free = report['free_pages'] / report['pages'] if report['pages'] else 0
+        click.echo(f'{label} ({path}): {_megabytes(report["file_bytes"])}, '
+                   f'{report["pages"]} pages of {report["page_size"]} bytes, '
+                   f'{report["free_pages"]} free ({free:.1%}), auto_vacuum={report["auto_vacuum"]}, '
+                   f'journal_mode={report["journal_mode"]}'
+                   + (f', WAL {_megabytes(report["wal_bytes"])}' if report['wal_bytes'] else ''))
+        for row in report['objects'] or []:
+            unused = row['unused'] / row['bytes'] if row['bytes'] else 0
+            click.echo(f'  {row["name"]:<40} {row["pages"]:>8} pages {_megabytes(row["bytes"]):>10} '
+                       f'{unused:>6.1%} unused')
+        if report['objects'] is None:
+            click.echo('  per-table breakdown unavailable (no dbstat, or out of time)')
+    _each_target(_seconds(seconds), step)
+
+@db_maintain_command.command('sync-lots')
+@click.option('--seconds', type=float, help='Longest wait for a shard\'s write lock (default: DB_MAINTENANCE_SECONDS).')
+def sync_lots_command(seconds):
+    """Repair shard copies of lot rows that differ from the catalog."""
+    seconds = _seconds(seconds)
+    catalog = _connect(database.DATABASE, seconds)
+
+    def step(conn, label, path, shard):
+        if shard:
+            click.echo(f'{label}: {sync_lots(catalog, conn, shard)} lot(s) re-synced')
+    try:
+        _each_target(seconds, step)
+    finally:
+        catalog.close()
+
+@db_maintain_command.command('routine')
+@click.pass_context
+def routine_command(ctx):
+    """Lot re-sync, analyze, incremental vacuum and a passive checkpoint, for cron."""
+    ctx.invoke(sync_lots_command)
+    ctx.invoke(analyze_command)
+    ctx.invoke(vacuum_command)
+    ctx.invoke(checkpoint_command)
@@ -0,0 +1,70 @@
+from flask import current_app
+import database
+import math
+
+# Nearest-lot search. Lot coordinates are indexed in the lot_locations
+# R*Tree on every shard (kept in step with parking_lots by triggers), so a
+# bounding-box probe costs O(log n) plus the lots inside the box. A search
+# probes a box around the driver, keeps the lots with free slots and within
+# the price limit, and doubles the box until it holds k lots inside its
+# inscribed circle (so no closer lot can be outside it) or reaches
+# NEAREST_MAX_KM.
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+def parse_coordinates(latitude, longitude):
+    """(latitude, longitude) as floats from form or query strings; (None,
+    None) when both are empty. Raises ValueError if they are invalid."""
+    if latitude in (None, '') and longitude in (None, ''):
+        return None, None
+    latitude, longitude = float(latitude), float(longitude)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('latitude must be within ±90 and longitude within ±180')
+    return latitude, longitude
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def _box(latitude, longitude, radius_km):
+    """(min_lat, max_lat, min_lon, max_lon) enclosing a circle; boxes that
+    would cross a pole or the antimeridian are widened to all longitudes"""
+    dlat = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(latitude))
+    dlon = radius_km / (KM_PER_DEGREE * cos_lat) if cos_lat > 1e-9 else 360
+    min_lat, max_lat = max(-90.0, latitude - dlat), min(90.0, latitude + dlat)
+    if dlon >= 180 or longitude - dlon < -180 or longitude + dlon > 180 or max_lat == 90 or min_lat == -90:
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, longitude - dlon, longitude + dlon
+
+def nearest_lots(latitude, longitude, k, max_price=None, max_km=None):
+    """Up to k open lots with free slots nearest to a point, closest first,
+    as (distance_km, lot row) pairs"""
+    max_km = max_km or current_app.config['NEAREST_MAX_KM']
+    radius = min(current_app.config['NEAREST_START_KM'], max_km)
+
+    while True:
+        query = '''
+            SELECT p.* FROM lot_locations l
+            JOIN parking_lots p ON p.id = l.id
+            WHERE l.min_lat <= ? AND l.max_lat >= ? AND l.min_lon <= ? AND l.max_lon >= ?
+              AND p.shard = ? AND p.deleted_at IS NULL AND p.available_count > 0
+        '''
+        min_lat, max_lat, min_lon, max_lon = _box(latitude, longitude, radius)
+        params = [max_lat, min_lat, max_lon, min_lon, database.SHARD]
+        if max_price is not None:
+            query += ' AND p.price_per_hour <= ?'
+            params.append(max_price)
+
+        found = []
+        for lot in database.fan_out_query(query, params):
+            distance = distance_km(latitude, longitude, lot['latitude'], lot['longitude'])
+            if distance <= radius:
+                found.append((distance, lot))
+        found.sort(key=lambda item: (item[0], item[1]['id']))
+
+        if len(found) >= k or radius >= max_km:
+            return found[:k]
+        radius = min(radius * 2, max_km)
@@ -0,0 +1,63 @@
+from flask import request, flash, redirect, jsonify, current_app
+import hashlib
+import json
+import time
+import uuid
+
+# Idempotency keys for booking, cancellation and force release. A client
+# sends the same Idempotency-Key header (or idempotency_key form field) with
+# every retry of one request. The first attempt to change anything records
+# its response in idempotency_keys, in the same transaction and on the same
+# shard as the booking change, so a repeat is answered from that row without
+# touching bookings. A repeat of a request still in flight blocks on the
+# shard's write lock (BEGIN IMMEDIATE) until the first commits, then finds
+# the stored response. Requests that fail change nothing, are not recorded
+# and may be retried with the same key.
+#
+# Rows are keyed by a 16-byte digest of actor, method, path and key, and
+# expire after IDEMPOTENCY_KEY_TTL_HOURS; each insert drops a few expired rows.
+PURGE_BATCH = 50
+
+def new_key():
+    """A fresh key for a page to send with its forms"""
+    return uuid.uuid4().hex
+
+def request_key(actor):
+    """Digest naming this request for actor (e.g. 'user:3'), or None when the
+    client sent no key"""
+    key = request.headers.get('Idempotency-Key') or request.values.get('idempotency_key')
+    if not key:
+        return None
+    return hashlib.sha256(f'{actor}\n{request.method} {request.path}\n{key}'.encode()).digest()[:16]
+
+def stored_response(conn, key):
+    """The recorded response for a key, or None"""
+    if key is None:
+        return None
+    row = conn.execute('''
+        SELECT response FROM idempotency_keys WHERE key = ? AND expires_at > ?
+    ''', (key, int(time.time()))).fetchone()
+    return json.loads(row['response']) if row else None
+
+def store_response(conn, key, response):
+    """Record a response inside the request's write transaction"""
+    if key is None:
+        return
+    now = int(time.time())
+    conn.execute('''
+        DELETE FROM idempotency_keys
+        WHERE key IN (SELECT key FROM idempotency_keys WHERE expires_at <= ? LIMIT ?)
+    ''', (now, PURGE_BATCH))
+    conn.execute('''
+        INSERT OR REPLACE INTO idempotency_keys (key, response, expires_at) VALUES (?, ?, ?)
+    ''', (key, json.dumps(response, separators=(',', ':')),
+          now + current_app.config['IDEMPOTENCY_KEY_TTL_HOURS'] * 3600))
+
+def respond(response):
+    """Flask response for a recorded response: a flash message and redirect
+    ({'flash': [message, category], 'redirect': url}) or JSON ({'body', 'status'})"""
+    if 'flash' in response:
+        flash(*response['flash'])
+    if 'redirect' in response:
+        return redirect(response['redirect'])
+    return jsonify(response['body']), response['status']
@@ -0,0 +1,50 @@
+def resolve_level(conn, lot_id, floor_id=None, zone_id=None):
+    """Work out which level of a lot's floor/zone hierarchy to show.
+
+    Only the rows of that level are loaded: floor counters for the lot view,
+    zone counters for a floor, and nothing else for a zone (the caller loads
+    its slots). A level with a single child is skipped, so single-floor lots
+    open on their zones and single-zone lots open straight on their slots.
+
+    Returns a dict with ``level`` ('floors', 'zones' or 'slots') and the
+    ``floor``/``zone`` rows picked plus the ``floors``/``zones`` listed.
+    """
+    view = {'level': 'floors', 'floor': None, 'zone': None, 'floors': [], 'zones': []}
+
+    if zone_id is not None:
+        zone = conn.execute('''
+            SELECT * FROM parking_zones WHERE id = ? AND parking_lot_id = ?
+        ''', (zone_id, lot_id)).fetchone()
+        if zone:
+            view['zone'] = zone
+            view['floor'] = conn.execute('SELECT * FROM parking_floors WHERE id = ?',
+                                         (zone['floor_id'],)).fetchone()
+            view['level'] = 'slots'
+            return view
+
+    if floor_id is None:
+        floors = conn.execute('''
+            SELECT * FROM parking_floors WHERE parking_lot_id = ? ORDER BY level_number
+        ''', (lot_id,)).fetchall()
+        if len(floors) != 1:
+            view['floors'] = floors
+            return view
+        floor = floors[0]
+    else:
+        floor = conn.execute('''
+            SELECT * FROM parking_floors WHERE id = ? AND parking_lot_id = ?
+        ''', (floor_id, lot_id)).fetchone()
+        if not floor:
+            return resolve_level(conn, lot_id)
+
+    view['floor'] = floor
+    zones = conn.execute('''
+        SELECT * FROM parking_zones WHERE floor_id = ? ORDER BY name
+    ''', (floor['id'],)).fetchall()
+    if len(zones) == 1:
+        view['zone'] = zones[0]
+        view['level'] = 'slots'
+    else:
+        view['zones'] = zones
+        view['level'] = 'zones'
+    return view
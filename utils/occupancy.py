@@ -0,0 +1,202 @@
+import database
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+try:
+    import numpy
+except ImportError:  # numpy is optional; the pure-Python sweep gives the same result
+    numpy = None
+
+# Hourly occupancy per lot, cached per (lot, day) in occupancy_days and
+# occupancy_hourly. Only finished days are cached, and a finished day never
+# changes: bookings can't start in the past, and a cancellation only cuts a
+# booking short from the moment it happens. So a refresh only sweeps days
+# that aren't in the cache yet.
+#
+# A slot counts as occupied from a booking's start until its end, or until it
+# was cancelled if that came first (the cancel time comes from
+# booking_events). Waitlist holds, and reservations cancelled before they
+# started, never occupied anything.
+MINUTES_PER_DAY = 24 * 60
+
+def _minutes_since(origin, value):
+    return int((datetime.fromisoformat(value) - origin).total_seconds() // 60)
+
+def _stream_intervals(conn, lot_id, first_day, days):
+    """Yield each booking's occupied (start, end) in minutes since first_day"""
+    origin = datetime.combine(first_day, datetime.min.time())
+    range_end = origin + timedelta(days=days)
+    rows = conn.execute('''
+        SELECT b.start_time, b.end_time, b.status,
+               datetime(e.occurred_at, 'localtime') as cancelled_at
+        FROM bookings b
+        LEFT JOIN booking_events e ON e.booking_id = b.id AND e.event = 'cancelled'
+                                   AND e.old_status = 'active'
+        WHERE b.parking_lot_id = ? AND b.start_time < ? AND b.end_time > ?
+        AND b.status IN ('active', 'completed', 'expired', 'cancelled')
+    ''', (lot_id, range_end.strftime('%Y-%m-%d %H:%M:%S'), origin.strftime('%Y-%m-%d %H:%M:%S')))
+    for row in rows:
+        if row['status'] == 'cancelled' and row['cancelled_at'] is None:
+            continue
+        end = row['end_time']
+        if row['cancelled_at'] is not None:
+            end = min(end, row['cancelled_at'])
+        yield _minutes_since(origin, row['start_time']), _minutes_since(origin, end)
+
+def _sweep(intervals, days):
+    """Per hour: total occupied slot-minutes and peak concurrent occupancy.
+
+    One pass over the sorted interval endpoints; the occupancy between two
+    consecutive endpoints is constant, so each segment is added to the
+    hours it covers.
+    """
+    horizon = days * MINUTES_PER_DAY
+    deltas = defaultdict(int)
+    for start, end in intervals:
+        start, end = max(start, 0), min(end, horizon)
+        if start < end:
+            deltas[start] += 1
+            deltas[end] -= 1
+
+    slot_minutes = [0] * (days * 24)
+    peaks = [0] * (days * 24)
+    occupied = 0
+    previous = 0
+    for point in sorted(deltas) + [horizon]:
+        minute = previous
+        while minute < point:
+            hour = minute // 60
+            segment_end = min(point, (hour + 1) * 60)
+            slot_minutes[hour] += occupied * (segment_end - minute)
+            peaks[hour] = max(peaks[hour], occupied)
+            minute = segment_end
+        occupied += deltas.get(point, 0)
+        previous = point
+    return slot_minutes, peaks
+
+def _sweep_numpy(intervals, days):
+    """Same as _sweep, as a cumulative sum over a per-minute grid"""
+    horizon = days * MINUTES_PER_DAY
+    bounds = numpy.fromiter((v for interval in intervals for v in interval), dtype=numpy.int64)
+    starts = numpy.clip(bounds[0::2], 0, horizon)
+    ends = numpy.clip(bounds[1::2], 0, horizon)
+    keep = starts < ends
+    grid = numpy.zeros(horizon + 1, dtype=numpy.int64)
+    numpy.add.at(grid, starts[keep], 1)
+    numpy.add.at(grid, ends[keep], -1)
+    per_minute = numpy.cumsum(grid[:-1]).reshape(days * 24, 60)
+    return per_minute.sum(axis=1).tolist(), per_minute.max(axis=1).tolist()
+
+def _sweep_lot(job):
+    """Process-pool entry point: hourly occupancy of one lot over a run of
+    days, read from the lot's shard"""
+    shard_path, lot_id, first_day, days = job
+    conn = database.connect(shard_path)
+    slot_count = conn.execute('SELECT slot_count FROM parking_lots WHERE id = ?', (lot_id,)).fetchone()[0]
+    intervals = _stream_intervals(conn, lot_id, first_day, days)
+    slot_minutes, peaks = (_sweep_numpy if numpy else _sweep)(intervals, days)
+    conn.close()
+    return lot_id, first_day, slot_count, slot_minutes, peaks
+
+def refresh_occupancy(conn, lot_ids, first_day, last_day, workers=1, parallel_min_days=0):
+    """Sweep and cache every (lot, day) in the range that isn't cached yet.
+
+    Lots are swept in a process pool when there are at least
+    ``parallel_min_days`` lot-days to compute. Returns the number of
+    lot-days computed.
+    """
+    last_day = min(last_day, date.today() - timedelta(days=1))
+    jobs = []
+    missing = {}
+    for lot_id in lot_ids:
+        cached = {row[0] for row in conn.execute('''
+            SELECT day FROM occupancy_days WHERE parking_lot_id = ? AND day BETWEEN ? AND ?
+        ''', (lot_id, first_day.isoformat(), last_day.isoformat()))}
+        days = [first_day + timedelta(days=n) for n in range((last_day - first_day).days + 1)]
+        missing[lot_id] = [day for day in days if day.isoformat() not in cached]
+        if missing[lot_id]:
+            start = missing[lot_id][0]
+            shard_path = database.shard_paths()[database.shard_for_lot(lot_id)]
+            jobs.append((shard_path, lot_id, start, (missing[lot_id][-1] - start).days + 1))
+
+    total_days = sum(len(days) for days in missing.values())
+    if not jobs:
+        return 0
+
+    if workers > 1 and len(jobs) > 1 and total_days >= parallel_min_days:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = list(pool.map(_sweep_lot, jobs))
+    else:
+        results = [_sweep_lot(job) for job in jobs]
+
+    day_rows, hour_rows = [], []
+    for lot_id, start, slot_count, slot_minutes, peaks in results:
+        for day in missing[lot_id]:
+            offset = (day - start).days * 24
+            day_rows.append((lot_id, day.isoformat(), slot_count))
+            for hour in range(24):
+                if slot_minutes[offset + hour]:
+                    hour_rows.append((lot_id, day.isoformat(), hour,
+                                      slot_minutes[offset + hour], peaks[offset + hour]))
+
+    conn.executemany('''
+        INSERT OR REPLACE INTO occupancy_hourly (parking_lot_id, day, hour, slot_minutes, peak_occupied)
+        VALUES (?, ?, ?, ?, ?)
+    ''', hour_rows)
+    conn.executemany('''
+        INSERT OR REPLACE INTO occupancy_days (parking_lot_id, day, slot_count) VALUES (?, ?, ?)
+    ''', day_rows)
+    conn.commit()
+    return total_days
+
+def occupancy_report(conn, lot_id, first_day, last_day):
+    """Weekday x hour heatmap, daily utilization and the busiest hour of a lot.
+
+    Utilization is occupied slot-time over available slot-time, in percent.
+    """
+    days = conn.execute('''
+        SELECT day, slot_count FROM occupancy_days
+        WHERE parking_lot_id = ? AND day BETWEEN ? AND ? ORDER BY day
+    ''', (lot_id, first_day.isoformat(), last_day.isoformat())).fetchall()
+    hours = defaultdict(dict)
+    for row in conn.execute('''
+        SELECT day, hour, slot_minutes, peak_occupied FROM occupancy_hourly
+        WHERE parking_lot_id = ? AND day BETWEEN ? AND ?
+    ''', (lot_id, first_day.isoformat(), last_day.isoformat())):
+        hours[row['day']][row['hour']] = row
+
+    heat_minutes = [[0] * 24 for _ in range(7)]
+    heat_capacity = [[0] * 24 for _ in range(7)]
+    daily = []
+    peak = None
+    for day in days:
+        weekday = date.fromisoformat(day['day']).weekday()
+        capacity = day['slot_count'] * 60
+        day_minutes = 0
+        day_peak = 0
+        for hour in range(24):
+            row = hours[day['day']].get(hour)
+            heat_capacity[weekday][hour] += capacity
+            if row is None:
+                continue
+            heat_minutes[weekday][hour] += row['slot_minutes']
+            day_minutes += row['slot_minutes']
+            day_peak = max(day_peak, row['peak_occupied'])
+            if peak is None or row['peak_occupied'] > peak['occupied']:
+                peak = {'day': day['day'], 'hour': hour, 'occupied': row['peak_occupied'],
+                        'utilization': _percent(row['peak_occupied'], day['slot_count'])}
+        daily.append({'day': day['day'],
+                      'average_utilization': _percent(day_minutes, capacity * 24),
+                      'peak_occupied': day_peak,
+                      'peak_utilization': _percent(day_peak, day['slot_count'])})
+
+    return {
+        'heatmap': [[_percent(heat_minutes[weekday][hour], heat_capacity[weekday][hour])
+                     for hour in range(24)] for weekday in range(7)],
+        'daily': daily,
+        'peak': peak,
+    }
+
+def _percent(part, whole):
+    return round(100.0 * part / whole, 1) if whole else 0.0
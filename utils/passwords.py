@@ -0,0 +1,61 @@
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+import threading
+
+# Werkzeug's defaults for the parts of a method string that may be omitted
+_SCRYPT_DEFAULTS = ['32768', '8', '1']
+
+_hash_slots = None
+_queue_slots = None
+_lock = threading.Lock()
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many requests are already waiting to hash"""
+
+def canonical_method(method):
+    """Expand 'pbkdf2' / 'scrypt' shorthands to the form stored in the hash"""
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        parts += ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)][len(parts) - 1:]
+    elif parts[0] == 'scrypt':
+        parts += _SCRYPT_DEFAULTS[len(parts) - 1:]
+    return ':'.join(parts)
+
+def _get_slots():
+    global _hash_slots, _queue_slots
+    if _hash_slots is None:
+        with _lock:
+            if _hash_slots is None:
+                config = current_app.config
+                _queue_slots = threading.BoundedSemaphore(config['PASSWORD_HASH_QUEUE_LIMIT'])
+                _hash_slots = threading.BoundedSemaphore(config['PASSWORD_HASH_WORKERS'])
+    return _hash_slots, _queue_slots
+
+def _run(func, *args):
+    """Run a hashing call in the request's thread, at most
+    PASSWORD_HASH_WORKERS at a time in this worker process.
+
+    The KDFs release the GIL, so capping concurrent calls caps how many
+    cores a worker spends on hashing; the queue semaphore caps how many
+    requests may wait for a turn before new ones are turned away.
+    """
+    hash_slots, queue_slots = _get_slots()
+    if not queue_slots.acquire(timeout=current_app.config['PASSWORD_HASH_QUEUE_TIMEOUT']):
+        raise PasswordHasherBusy()
+    try:
+        with hash_slots:
+            return func(*args)
+    finally:
+        queue_slots.release()
+
+def hash_password(password):
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    return _run(generate_password_hash, password, method)
+
+def verify_password(stored_hash, password):
+    return _run(check_password_hash, stored_hash, password)
+
+def needs_rehash(stored_hash):
+    """True if the hash was made with a different scheme or work factor than configured"""
+    stored_method = stored_hash.split('$', 1)[0]
+    return stored_method != canonical_method(current_app.config['PASSWORD_HASH_METHOD'])
@@ -0,0 +1,142 @@
+import database
+from flask import current_app
+from datetime import datetime, timedelta
+import click
+import json
+
+# Demand pricing. The hourly price of a lot is its base price times a
+# demand multiplier (from the lot's occupancy band) times a time-of-day
+# multiplier. Each lot has a precomputed, immutable price table on its
+# shard: for every band, the cumulative price of the hours from midnight
+# over two days, so the cost of a booking is the difference of two
+# entries. The band comes from the lot's occupied and slot counters, which
+# the slot triggers already keep current, so a quote never scans anything.
+#
+# A table is rebuilt, under a new id, whenever the base price or the
+# pricing settings change; bookings record the table id (price_version)
+# and band they were charged with.
+TABLE_HOURS = 48
+
+_tables = {}  # price table id -> {'signature': ..., 'cumulative': {band: [...]}}
+
+def _settings():
+    config = current_app.config
+    if not config['PRICING_ENABLED']:
+        return ((0.0, 1.0),), (1.0,) * 24
+    return tuple(map(tuple, config['PRICING_OCCUPANCY_BANDS'])), tuple(config['PRICING_HOUR_MULTIPLIERS'])
+
+def _signature(base_price):
+    bands, hours = _settings()
+    return json.dumps([base_price, bands, hours])
+
+def _cumulative(base_price):
+    """band -> cumulative price before each hour of a two-day span"""
+    bands, hour_multipliers = _settings()
+    tables = {}
+    for band, (_, demand) in enumerate(bands):
+        total = 0.0
+        cumulative = [0.0]
+        for hour in range(TABLE_HOURS):
+            total += round(base_price * demand * hour_multipliers[hour % 24], 2)
+            cumulative.append(round(total, 2))
+        tables[band] = cumulative
+    return tables
+
+def build_price_table(conn, lot):
+    """Write a new price table for a lot and make it current; the caller commits"""
+    cumulative = _cumulative(lot['price_per_hour'])
+    cursor = conn.execute('''
+        INSERT INTO price_tables (parking_lot_id, base_price, signature) VALUES (?, ?, ?)
+    ''', (lot['id'], lot['price_per_hour'], _signature(lot['price_per_hour'])))
+    conn.executemany('''
+        INSERT INTO price_table_hours (price_table_id, band, hour, cumulative) VALUES (?, ?, ?, ?)
+    ''', [(cursor.lastrowid, band, hour, value)
+          for band, values in cumulative.items() for hour, value in enumerate(values)])
+    conn.execute('UPDATE parking_lots SET price_table_id = ? WHERE id = ?', (cursor.lastrowid, lot['id']))
+    return cursor.lastrowid
+
+def _load(conn, table_id):
+    """A price table, cached per process (tables never change once written)"""
+    if table_id not in _tables:
+        table = conn.execute('SELECT signature FROM price_tables WHERE id = ?', (table_id,)).fetchone()
+        if table is None:
+            return None
+        cumulative = {}
+        for row in conn.execute('''
+            SELECT band, hour, cumulative FROM price_table_hours WHERE price_table_id = ? ORDER BY band, hour
+        ''', (table_id,)):
+            cumulative.setdefault(row['band'], []).append(row['cumulative'])
+        _tables[table_id] = {'signature': table['signature'], 'cumulative': cumulative}
+    return _tables[table_id]
+
+def current_table(conn, lot):
+    """The lot's price table if it matches its base price and the current
+    settings, else None"""
+    if not lot['price_table_id']:
+        return None
+    table = _load(conn, lot['price_table_id'])
+    if table is None or table['signature'] != _signature(lot['price_per_hour']):
+        return None
+    return table
+
+def demand_band(lot, start_time=None):
+    """Occupancy band of a lot; reservations beyond the surge horizon are
+    priced at PRICING_FUTURE_BAND since today's occupancy says little about them"""
+    bands, _ = _settings()
+    horizon = timedelta(hours=current_app.config['PRICING_SURGE_HORIZON_HOURS'])
+    if start_time is not None and start_time > datetime.now() + horizon:
+        return min(current_app.config['PRICING_FUTURE_BAND'], len(bands) - 1)
+    occupancy = lot['occupied_count'] / lot['slot_count'] if lot['slot_count'] else 0
+    return max(band for band, (threshold, _) in enumerate(bands) if occupancy >= threshold or band == 0)
+
+def quote(conn, lot, start_time, hours, build=False):
+    """Price of booking a lot for whole hours from start_time.
+
+    With ``build`` (inside a write transaction) a missing or outdated price
+    table is rebuilt first, so the quote is always stamped with a version;
+    read-only callers get the same figure computed directly, without one.
+    Returns {'total_cost', 'price_per_hour', 'price_version', 'band'}.
+    """
+    band = demand_band(lot, start_time)
+    table = current_table(conn, lot)
+    version = lot['price_table_id'] if table else None
+    if table is None and build:
+        # The caller's lot row may predate a rebuild made under the same lock
+        lot = conn.execute('SELECT * FROM parking_lots WHERE id = ?', (lot['id'],)).fetchone()
+        table = current_table(conn, lot)
+        version = lot['price_table_id'] if table else build_price_table(conn, lot)
+        table = table or _load(conn, version)
+    cumulative = table['cumulative'][band] if table else _cumulative(lot['price_per_hour'])[band]
+
+    # Any 24 hours in a row cost a full day's total, cumulative[24]
+    days, hours_left = divmod(max(hours, 0), 24)
+    start_hour = start_time.hour
+    total = round(days * cumulative[24] + cumulative[start_hour + hours_left] - cumulative[start_hour], 2)
+    return {'total_cost': total, 'price_per_hour': round(total / hours, 2) if hours > 0 else 0.0,
+            'price_version': version, 'band': band}
+
+def refresh_price_tables(conn, shard):
+    """Rebuild the outdated price tables of the lots on one shard; returns how many"""
+    lots = conn.execute('''
+        SELECT * FROM parking_lots WHERE deleted_at IS NULL AND shard = ?
+    ''', (shard,)).fetchall()
+    stale = [lot for lot in lots if current_table(conn, lot) is None]
+    for lot in stale:
+        build_price_table(conn, lot)
+    conn.commit()
+    return len(stale)
+
+def refresh_lot_prices(lot_id):
+    """Bring one lot's price table up to date, e.g. after its base price changed"""
+    conn = database.get_lot_db(lot_id)
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ?', (lot_id,)).fetchone()
+    if lot and current_table(conn, lot) is None:
+        build_price_table(conn, lot)
+        conn.commit()
+    conn.close()
+
+@click.command('refresh-prices')
+def refresh_prices_command():
+    """Rebuild lot price tables after the pricing settings changed."""
+    rebuilt = sum(database.fan_out(refresh_price_tables))
+    click.echo(f'Rebuilt {rebuilt} price table(s).')
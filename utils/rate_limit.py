@@ -0,0 +1,152 @@
+from flask import current_app, make_response, request, jsonify
+import math
+import random
+import sqlite3
+import time
+
+_initialized = set()
+
+def get_limiter_db():
+    """Connection to the rate-limit store, shared by all gunicorn workers.
+
+    Buckets live in their own SQLite file so that admission checks never
+    queue behind booking writes on the main database.
+    """
+    path = current_app.config['RATE_LIMIT_DATABASE']
+    conn = sqlite3.connect(path, timeout=current_app.config['RATE_LIMIT_LOCK_TIMEOUT'],
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # Losing bucket state on a crash only means a fresh burst allowance
+    conn.execute('PRAGMA synchronous = OFF')
+
+    if path not in _initialized:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limit_counters (
+                scope TEXT PRIMARY KEY,
+                admitted INTEGER NOT NULL DEFAULT 0,
+                rejected INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        _initialized.add(path)
+
+    return conn
+
+def _refill(row, capacity, rate, now):
+    if row is None:
+        return capacity
+    return min(capacity, row['tokens'] + (now - row['updated_at']) * rate)
+
+def take_tokens(scope, buckets):
+    """Take tokens from every bucket, or from none of them.
+
+    ``buckets`` is a list of (key, capacity, refill_per_second, tokens to
+    take). Returns ``(allowed, retry_after_seconds)``.
+    """
+    now = time.time()
+    conn = get_limiter_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        levels = []
+        retry_after = 0.0
+        for key, capacity, rate, tokens in buckets:
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?', (key,)
+            ).fetchone()
+            level = _refill(row, capacity, rate, now)
+            if level < tokens:
+                retry_after = max(retry_after, (tokens - level) / rate)
+            levels.append((key, level, tokens))
+
+        allowed = retry_after == 0
+        if allowed:
+            levels = [(key, level - tokens, tokens) for key, level, tokens in levels]
+
+        conn.executemany('''
+            INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+        ''', [(key, level, now) for key, level, _ in levels])
+
+        # Buckets untouched for longer than the TTL have refilled completely,
+        # so dropping them is equivalent to keeping them
+        if random.random() < 0.01:
+            conn.execute('DELETE FROM rate_limit_buckets WHERE updated_at < ?',
+                         (now - current_app.config['RATE_LIMIT_BUCKET_TTL'],))
+
+        column = 'admitted' if allowed else 'rejected'
+        conn.execute(f'''
+            INSERT INTO rate_limit_counters (scope, {column}) VALUES (?, 1)
+            ON CONFLICT(scope) DO UPDATE SET {column} = {column} + 1
+        ''', (scope,))
+        conn.execute('COMMIT')
+    except sqlite3.OperationalError:
+        # Limiter store is locked or unavailable: fail open rather than
+        # turning admission control into an outage
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        current_app.logger.warning('Rate limiter unavailable, admitting %s request', scope)
+        return True, 0
+    finally:
+        conn.close()
+
+    return allowed, retry_after
+
+def too_many_requests(retry_after):
+    message = 'Too many requests. Please wait a moment and try again.'
+    # API clients get JSON, like every other error from those endpoints
+    if request.path.startswith('/api/'):
+        response = make_response(jsonify({'error': message}), 429)
+    else:
+        response = make_response(message, 429)
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def admit_booking(user_id, lot_id):
+    """Returns a 429 response if the user or the lot is over its booking rate"""
+    config = current_app.config
+    if not config['RATE_LIMIT_ENABLED']:
+        return None
+
+    allowed, retry_after = take_tokens('book', [
+        (f'book:user:{user_id}', config['BOOKING_USER_BURST'], config['BOOKING_USER_RATE'], 1),
+        (f'book:lot:{lot_id}', config['BOOKING_LOT_BURST'], config['BOOKING_LOT_RATE'], 1),
+    ])
+    return None if allowed else too_many_requests(retry_after)
+
+def admit_bulk_booking(user_id, lot_id, vehicles):
+    """Returns a 429 response if a fleet booking would put the user over
+    their bulk rate (one token per vehicle) or the lot over its booking
+    rate (one token per request, as it is one transaction)"""
+    config = current_app.config
+    if not config['RATE_LIMIT_ENABLED']:
+        return None
+
+    allowed, retry_after = take_tokens('bulk', [
+        (f'bulk:user:{user_id}', config['BULK_BOOKING_USER_BURST'], config['BULK_BOOKING_USER_RATE'], vehicles),
+        (f'book:lot:{lot_id}', config['BOOKING_LOT_BURST'], config['BOOKING_LOT_RATE'], 1),
+    ])
+    return None if allowed else too_many_requests(retry_after)
+
+def admit_cancellation(user_id):
+    """Returns a 429 response if the user is cancelling faster than allowed"""
+    config = current_app.config
+    if not config['RATE_LIMIT_ENABLED']:
+        return None
+
+    allowed, retry_after = take_tokens('cancel', [
+        (f'cancel:user:{user_id}', config['CANCEL_USER_BURST'], config['CANCEL_USER_RATE'], 1),
+    ])
+    return None if allowed else too_many_requests(retry_after)
+
+def get_rate_limit_counters():
+    conn = get_limiter_db()
+    rows = conn.execute('SELECT scope, admitted, rejected FROM rate_limit_counters ORDER BY scope').fetchall()
+    conn.close()
+    return {row['scope']: {'admitted': row['admitted'], 'rejected': row['rejected']} for row in rows}
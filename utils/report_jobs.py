@@ -0,0 +1,274 @@
+import database
+from flask import current_app
+from datetime import date, datetime, timedelta
+import multiprocessing
+import click
+import socket
+import json
+import csv
+import os
+import time
+
+# A small job queue kept in the report_jobs table. Web workers only insert a
+# row and poll it; `flask run-jobs` runs a pool of worker processes that
+# claim queued jobs one at a time, write the result to a file under
+# REPORTS_DIR and record progress as they go. Identical requests made while
+# a job is still queued or running share that job (the unique index on
+# dedup_key), and results are deleted once they expire.
+CHUNK_SIZE = 1000
+MAX_ATTEMPTS = 3
+TIMESTAMP = '%Y-%m-%d %H:%M:%S'
+
+REVENUE_STATUSES = ('active', 'reserved', 'completed')
+
+def _now():
+    return datetime.now().strftime(TIMESTAMP)
+
+def _export_bookings(conn, params):
+    """Every booking, newest first, read in short keyset-paginated chunks so
+    the export never holds a read lock for long. Higher shards hold higher
+    ids, so walking the shards from the last one keeps the id order."""
+    total = sum(database.fan_out(
+        lambda shard_conn, shard: shard_conn.execute('SELECT COUNT(*) FROM bookings').fetchone()[0]))
+    yield ['ID', 'Username', 'Email', 'Parking Lot', 'Location', 'Slot',
+           'Vehicle Number', 'Vehicle Type', 'Start Time', 'End Time', 'Cost', 'Status'], total
+
+    for shard in reversed(range(len(database.shard_paths()))):
+        shard_conn = conn if shard == 0 else database.get_shard_db(shard)
+        try:
+            last_id = None
+            while True:
+                rows = shard_conn.execute('''
+                    SELECT b.id, b.user_id, p.name as lot_name, p.location,
+                           ps.slot_number, b.vehicle_number, b.vehicle_type,
+                           b.start_time, b.end_time, b.total_cost, b.status
+                    FROM bookings b
+                    JOIN parking_lots p ON b.parking_lot_id = p.id
+                    JOIN parking_slots ps ON b.slot_id = ps.id
+                    WHERE b.id < COALESCE(?, 9223372036854775807)
+                    ORDER BY b.id DESC
+                    LIMIT ?
+                ''', (last_id, CHUNK_SIZE)).fetchall()
+                if not rows:
+                    break
+                # Users live in the catalog
+                user_ids = sorted({row['user_id'] for row in rows})
+                users = {user['id']: user for user in conn.execute(f'''
+                    SELECT id, username, email FROM users WHERE id IN ({', '.join('?' * len(user_ids))})
+                ''', user_ids)}
+                yield [[row['id'], users[row['user_id']]['username'], users[row['user_id']]['email']]
+                       + list(row)[2:] for row in rows if row['user_id'] in users], len(rows)
+                last_id = rows[-1]['id']
+        finally:
+            if shard_conn is not conn:
+                shard_conn.close()
+
+def _export_lots(conn, params):
+    rows = database.fan_out_query('''
+        SELECT p.id, p.name, p.location, p.total_slots, p.price_per_hour,
+               p.slot_count as actual_slots,
+               p.available_count as available,
+               p.occupied_count as occupied
+        FROM parking_lots p
+        WHERE p.deleted_at IS NULL AND p.shard = ?
+        ORDER BY p.id
+    ''', [database.SHARD], key=lambda lot: lot['id'])
+    yield ['ID', 'Name', 'Location', 'Total Slots', 'Price/Hour',
+           'Actual Slots', 'Available', 'Occupied'], len(rows)
+    yield rows, None
+
+def _month_starts(first, last):
+    month = first.replace(day=1)
+    while month <= last:
+        yield month
+        month = (month + timedelta(days=32)).replace(day=1)
+
+def _revenue_report(conn, params):
+    """Bookings and revenue per month and lot, one month per query on each shard"""
+    first = date.fromisoformat(params['date_from'])
+    last = date.fromisoformat(params['date_to'])
+    months = list(_month_starts(first, last))
+    yield ['Month', 'Parking Lot', 'Bookings', 'Revenue'], len(months)
+
+    placeholders = ', '.join('?' * len(REVENUE_STATUSES))
+    for month in months:
+        month_end = (month + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        rows = database.fan_out_query(f'''
+            SELECT strftime('%Y-%m', b.created_at) as month, p.name, COUNT(*) as bookings,
+                   ROUND(SUM(b.total_cost), 2) as revenue
+            FROM bookings b
+            JOIN parking_lots p ON b.parking_lot_id = p.id
+            WHERE DATE(b.created_at) BETWEEN ? AND ? AND b.status IN ({placeholders})
+            GROUP BY p.id
+            ORDER BY p.name
+        ''', [max(month, first).isoformat(), min(month_end, last).isoformat(), *REVENUE_STATUSES],
+            key=lambda row: row['name'])
+        yield rows, 1
+
+# kind -> (builder, download filename prefix). A builder first yields
+# (header, total work units), then (rows, units done) per chunk; units done
+# of None means one per row.
+JOB_KINDS = {
+    'bookings_csv': (_export_bookings, 'bookings_export'),
+    'lots_csv': (_export_lots, 'parking_lots_export'),
+    'revenue_report': (_revenue_report, 'revenue_report'),
+}
+
+def enqueue_job(conn, kind, params, requested_by=None):
+    """Queue a job; returns ``(job_id, created)``. An identical job that is
+    still queued or running is returned instead of queueing a new one."""
+    params = json.dumps(params, sort_keys=True)
+    dedup_key = f'{kind}:{params}'
+    # One write transaction, so a duplicate can't finish between the
+    # ignored insert and the lookup
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO report_jobs (kind, params, dedup_key, requested_by, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (kind, params, dedup_key, requested_by, _now()))
+        if cursor.rowcount:
+            job_id, created = cursor.lastrowid, True
+        else:
+            job_id, created = conn.execute('''
+                SELECT id FROM report_jobs WHERE dedup_key = ? AND status IN ('queued', 'running')
+            ''', (dedup_key,)).fetchone()[0], False
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return job_id, created
+
+def claim_job(conn, worker):
+    """Atomically move the oldest queued job to running; returns it or None"""
+    now = _now()
+    job = conn.execute('''
+        UPDATE report_jobs
+        SET status = 'running', worker = ?, attempts = attempts + 1,
+            started_at = ?, heartbeat_at = ?, progress = 0, rows_written = 0
+        WHERE id = (SELECT id FROM report_jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+        RETURNING *
+    ''', (worker, now, now)).fetchone()
+    conn.commit()
+    return job
+
+def _update_job(conn, job_id, **fields):
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    conn.execute(f'UPDATE report_jobs SET {assignments} WHERE id = ?', list(fields.values()) + [job_id])
+    conn.commit()
+
+def run_job(conn, job, reports_dir, result_ttl_hours):
+    """Build one job's result file, recording progress after every chunk"""
+    builder, prefix = JOB_KINDS[job['kind']]
+    params = json.loads(job['params'])
+    os.makedirs(reports_dir, exist_ok=True)
+    path = os.path.join(reports_dir, f'job_{job["id"]}.csv')
+    partial = path + '.part'
+
+    rows_written = 0
+    done = 0
+    try:
+        with open(partial, 'w', newline='') as f:
+            writer = csv.writer(f)
+            chunks = builder(conn, params)
+            header, total = next(chunks)
+            writer.writerow(header)
+            for rows, units in chunks:
+                writer.writerows(rows)
+                rows_written += len(rows)
+                done += len(rows) if units is None else units
+                _update_job(conn, job['id'], rows_written=rows_written, heartbeat_at=_now(),
+                            progress=min(99, 100 * done // total) if total else 99)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    finished = datetime.now()
+    _update_job(conn, job['id'], status='done', progress=100, result_path=path,
+                filename=f'{prefix}_{finished:%Y%m%d_%H%M%S}.csv',
+                finished_at=finished.strftime(TIMESTAMP),
+                expires_at=(finished + timedelta(hours=result_ttl_hours)).strftime(TIMESTAMP))
+
+def requeue_stale_jobs(conn, stale_seconds):
+    """Retry running jobs whose worker stopped reporting progress"""
+    cutoff = (datetime.now() - timedelta(seconds=stale_seconds)).strftime(TIMESTAMP)
+    conn.execute('''
+        UPDATE report_jobs SET status = 'failed', error = 'worker stopped responding', finished_at = ?
+        WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?
+    ''', (_now(), cutoff, MAX_ATTEMPTS))
+    requeued = conn.execute('''
+        UPDATE report_jobs SET status = 'queued', worker = NULL
+        WHERE status = 'running' AND heartbeat_at < ?
+    ''', (cutoff,)).rowcount
+    conn.commit()
+    return requeued
+
+def cleanup_expired_results(conn):
+    """Delete result files past their expiry; returns how many were removed"""
+    expired = conn.execute('''
+        SELECT id, result_path FROM report_jobs WHERE status = 'done' AND expires_at < ?
+    ''', (_now(),)).fetchall()
+    for job in expired:
+        if job['result_path'] and os.path.exists(job['result_path']):
+            os.remove(job['result_path'])
+        conn.execute("UPDATE report_jobs SET status = 'expired', result_path = NULL WHERE id = ?",
+                     (job['id'],))
+    conn.commit()
+    return len(expired)
+
+def work(settings, drain=False):
+    """Worker process loop: claim, run, repeat. With ``drain`` the loop ends
+    once the queue is empty instead of waiting for more jobs."""
+    database.configure(settings['database'], settings['shards'])
+    conn = database.get_db()
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    next_housekeeping = 0
+
+    while True:
+        if time.monotonic() >= next_housekeeping:
+            requeue_stale_jobs(conn, settings['stale_seconds'])
+            cleanup_expired_results(conn)
+            next_housekeeping = time.monotonic() + 60
+
+        job = claim_job(conn, worker)
+        if job is None:
+            if drain:
+                break
+            time.sleep(settings['poll_interval'])
+            continue
+
+        try:
+            run_job(conn, job, settings['reports_dir'], settings['result_ttl_hours'])
+        except Exception as e:
+            conn.rollback()
+            _update_job(conn, job['id'], status='failed', error=str(e), finished_at=_now())
+
+    conn.close()
+
+@click.command('run-jobs')
+@click.option('--workers', type=int, default=None, help='Worker processes (default: REPORT_WORKERS).')
+@click.option('--drain', is_flag=True, help='Exit once the queue is empty.')
+def run_jobs_command(workers, drain):
+    """Run background report jobs until interrupted."""
+    config = current_app.config
+    settings = {
+        'database': config['DATABASE_URL'],
+        'shards': config['DATABASE_SHARDS'],
+        'reports_dir': os.path.abspath(config['REPORTS_DIR']),
+        'result_ttl_hours': config['REPORT_RESULT_TTL_HOURS'],
+        'poll_interval': config['REPORT_POLL_INTERVAL'],
+        'stale_seconds': config['REPORT_STALE_SECONDS'],
+    }
+    workers = workers or config['REPORT_WORKERS']
+    click.echo(f'Running report jobs with {workers} worker(s).')
+
+    processes = [multiprocessing.Process(target=work, args=(settings, drain)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,155 @@
+from flask import current_app
+from database import fan_out, SHARD_ID_SPAN
+from utils.availability import index_booking, unindex_booking, is_slot_free, release_slot
+from utils.pricing import quote
+from datetime import datetime, timedelta
+
+# Waiters are served by loyalty tier (higher first), then first come first
+# served. The head of a lot's queue is one probe of idx_waitlist_queue.
+#
+# Queue positions come from a Fenwick tree per lot kept in waitlist_rank:
+# every waiting entry adds 1 at _position(tier, id), which sorts the same way
+# as the queue (ids are taken within their shard's id range), so "how many are ahead of me" is a prefix sum over at most
+# ~45 tree nodes instead of a COUNT over everyone waiting.
+MAX_TIER = 3
+TICKET_BITS = 40
+TREE_SIZE = (MAX_TIER + 1) << TICKET_BITS
+
+def _position(tier, entry_id):
+    return ((MAX_TIER - tier) << TICKET_BITS) + entry_id % SHARD_ID_SPAN
+
+def _fenwick_add(conn, lot_id, position, delta):
+    nodes = []
+    while position <= TREE_SIZE:
+        nodes.append((lot_id, position, delta))
+        position += position & -position
+    conn.executemany('''
+        INSERT INTO waitlist_rank (parking_lot_id, node, count) VALUES (?, ?, ?)
+        ON CONFLICT(parking_lot_id, node) DO UPDATE SET count = count + excluded.count
+    ''', nodes)
+
+def _fenwick_prefix(conn, lot_id, position):
+    nodes = []
+    while position > 0:
+        nodes.append(position)
+        position &= position - 1
+    placeholders = ', '.join('?' * len(nodes))
+    return conn.execute(f'''
+        SELECT COALESCE(SUM(count), 0) FROM waitlist_rank
+        WHERE parking_lot_id = ? AND node IN ({placeholders})
+    ''', [lot_id] + nodes).fetchone()[0]
+
+def loyalty_tier(conn, user_id):
+    """One tier per WAITLIST_LOYALTY_STEP finished bookings (on any shard),
+    capped at MAX_TIER"""
+    finished = sum(fan_out(lambda shard_conn, shard: shard_conn.execute('''
+        SELECT COUNT(*) FROM bookings WHERE user_id = ? AND status IN ('completed', 'expired')
+    ''', (user_id,)).fetchone()[0]))
+    return min(MAX_TIER, finished // current_app.config['WAITLIST_LOYALTY_STEP'])
+
+def join_waitlist(conn, lot_id, user_id, vehicle_number, vehicle_type, hours):
+    """Add a user to a lot's waitlist; returns the entry id, or None if already waiting"""
+    existing = conn.execute('''
+        SELECT id FROM waitlist_entries
+        WHERE parking_lot_id = ? AND user_id = ? AND status IN ('waiting', 'offered')
+    ''', (lot_id, user_id)).fetchone()
+    if existing:
+        return None
+
+    tier = loyalty_tier(conn, user_id)
+    cursor = conn.execute('''
+        INSERT INTO waitlist_entries (parking_lot_id, user_id, vehicle_number, vehicle_type,
+                                      hours, tier, status)
+        VALUES (?, ?, ?, ?, ?, ?, 'waiting')
+    ''', (lot_id, user_id, vehicle_number, vehicle_type, hours, tier))
+    _fenwick_add(conn, lot_id, _position(tier, cursor.lastrowid), 1)
+    return cursor.lastrowid
+
+def leave_waitlist(conn, entry):
+    conn.execute("UPDATE waitlist_entries SET status = 'cancelled' WHERE id = ?", (entry['id'],))
+    _fenwick_add(conn, entry['parking_lot_id'], _position(entry['tier'], entry['id']), -1)
+
+def queue_position(conn, entry):
+    """1-based place in the lot's queue of a waiting entry"""
+    return _fenwick_prefix(conn, entry['parking_lot_id'], _position(entry['tier'], entry['id']))
+
+def offer_freed_slot(conn, lot_id, slot_id):
+    """Offer a just-freed slot to the first waiter it fits, in the caller's
+    transaction.
+
+    The offer is a 'held' booking covering the hold and then the waiter's
+    requested hours, so the interval index keeps everyone else off the slot
+    until the waiter accepts or the hold runs out. Waiters whose hours would
+    run into an upcoming reservation on the slot are skipped, keeping their
+    place. Nothing is charged for the hold: the booking is priced and starts
+    when the offer is accepted. Returns the entry offered the slot, if any.
+    """
+    now = datetime.now()
+    hold_until = now + timedelta(minutes=current_app.config['WAITLIST_HOLD_MINUTES'])
+    entries = conn.execute('''
+        SELECT * FROM waitlist_entries
+        WHERE parking_lot_id = ? AND status = 'waiting'
+        ORDER BY tier DESC, id
+    ''', (lot_id,))
+    # Queue order; most waiters fit, so this rarely reads past the head
+    entry = next((entry for entry in entries
+                  if is_slot_free(conn, lot_id, slot_id, now, hold_until + timedelta(hours=entry['hours']))), None)
+    if not entry:
+        return None
+
+    end_time = hold_until + timedelta(hours=entry['hours'])
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ?', (lot_id,)).fetchone()
+    price = quote(conn, lot, now, entry['hours'], build=True)
+    cursor = conn.execute('''
+        INSERT INTO bookings (user_id, parking_lot_id, slot_id, vehicle_number, vehicle_type,
+                              start_time, end_time, total_cost, price_version, price_band, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'held')
+    ''', (entry['user_id'], lot_id, slot_id, entry['vehicle_number'], entry['vehicle_type'],
+          now, end_time, price['total_cost'], price['price_version'], price['band']))
+    index_booking(conn, cursor.lastrowid, lot_id, slot_id, now, end_time)
+    conn.execute("UPDATE parking_slots SET status = 'held' WHERE id = ?", (slot_id,))
+
+    conn.execute('''
+        UPDATE waitlist_entries
+        SET status = 'offered', booking_id = ?, offer_expires_at = ?
+        WHERE id = ?
+    ''', (cursor.lastrowid, hold_until, entry['id']))
+    _fenwick_add(conn, lot_id, _position(entry['tier'], entry['id']), -1)
+    return entry
+
+def accept_offer(conn, entry):
+    """Turn a held slot into an active booking of the waiter's hours from
+    now, priced now; the hold already covers that window"""
+    booking = conn.execute('SELECT * FROM bookings WHERE id = ?', (entry['booking_id'],)).fetchone()
+    lot = conn.execute('SELECT * FROM parking_lots WHERE id = ?', (booking['parking_lot_id'],)).fetchone()
+    now = datetime.now()
+    end_time = now + timedelta(hours=entry['hours'])
+    price = quote(conn, lot, now, entry['hours'], build=True)
+    conn.execute('''
+        UPDATE bookings
+        SET status = 'active', start_time = ?, end_time = ?, total_cost = ?, price_version = ?, price_band = ?
+        WHERE id = ?
+    ''', (now, end_time, price['total_cost'], price['price_version'], price['band'], booking['id']))
+    unindex_booking(conn, booking['id'])
+    index_booking(conn, booking['id'], lot['id'], booking['slot_id'], now, end_time)
+    conn.execute("UPDATE parking_slots SET status = 'occupied' WHERE id = ?", (booking['slot_id'],))
+    conn.execute("UPDATE waitlist_entries SET status = 'accepted' WHERE id = ?", (entry['id'],))
+
+def release_offer(conn, entry, status):
+    """End an offer (status 'declined' or 'expired') and pass the slot on"""
+    booking = conn.execute('SELECT slot_id FROM bookings WHERE id = ?', (entry['booking_id'],)).fetchone()
+    conn.execute("UPDATE bookings SET status = 'cancelled' WHERE id = ?", (entry['booking_id'],))
+    unindex_booking(conn, entry['booking_id'])
+    conn.execute('UPDATE waitlist_entries SET status = ? WHERE id = ?', (status, entry['id']))
+    if release_slot(conn, booking['slot_id']):
+        offer_freed_slot(conn, entry['parking_lot_id'], booking['slot_id'])
+
+def expire_waitlist_offers(conn):
+    """Release offers whose hold has run out; the caller commits"""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    expired = conn.execute('''
+        SELECT * FROM waitlist_entries WHERE status = 'offered' AND offer_expires_at < ?
+    ''', (now,)).fetchall()
+    for entry in expired:
+        release_offer(conn, entry, 'expired')
+    return len(expired)